@@ -1,7 +1,28 @@
-import sqlite3
-from flask import Flask, render_template, request, redirect, session, url_for
-from werkzeug.security import generate_password_hash, check_password_hash
-import math
+from flask import Flask, Response, render_template, request, redirect, session, stream_with_context, url_for
+
+from assets import init_app as init_assets
+from backup import backup_status, export_ndjson_gz, init_app as init_backup, start_backup
+from catalog import get_catalog, init_app as init_catalog
+from changes import changes_since, compact_changes, init_app as init_changes
+from clusters import MAX_CLUSTER_ZOOM, map_features, stream_feature_collection
+from database import close_db, get_db, init_app
+from derived_tags import derive_tags
+from geo import nearest_spots, parse_bbox, spots_in_box, spots_nearby
+from leaderboard import MAX_LIMIT, board_name, top_spots
+from metrics import init_app as init_metrics, render as render_metrics, scraper_allowed
+from opening_hours import requested_slot
+from passwords import (HashingUnavailable, check_password, clear_login_failures, hash_password,
+                       init_app as init_passwords, login_retry_after, needs_rehash,
+                       record_login_failure)
+from recommend import init_app as init_recommend, recommended_spots, schedule_update, similar_spots
+from response_cache import cached, init_app as init_response_cache
+from search import highlight
+from spot_query import (BadFilter, parse_fields, parse_ids, spot_fields, spot_page,
+                        spot_summaries, spot_with_reviews)
+from startup import init_app as init_startup
+from suggest import init_app as init_suggest, suggestions
+from tags import COMPUTED_BITS, TAGS, TAG_KEYS, has_tag, tag_labels, tags_from_form
+from write_queue import execute_write, init_app as init_write_queue
 
 # Flask app setup
 app = Flask(__name__)
@@ -9,12 +30,62 @@ app = Flask(__name__)
 # Secret key used for session cookies
 app.secret_key = "dev-secret-change-later"
 
-# Database helper - open a connection to the SQLite database and return it
+# Spots per page on /spots and /api/spots (callers can ask for up to the max)
+app.config["SPOTS_PAGE_SIZE"] = 50
+app.config["SPOTS_PAGE_SIZE_MAX"] = 200
 
-def get_db():
-    connection = sqlite3.connect("spots.db")
-    connection.row_factory = sqlite3.Row
-    return connection
+# Reviews shown on a spot page; older ones are fetched from /api/spots/<id>/reviews
+app.config["REVIEWS_PAGE_SIZE"] = 20
+
+# Database - get_db() borrows a pooled connection for the current request and
+# returns it to the pool automatically when the request ends
+
+init_app(app)
+
+# Per-route and per-query timings, served at /metrics (see metrics.py)
+init_metrics(app)
+
+# GET pages are cached per worker until the data they show changes (see response_cache.py)
+init_response_cache(app)
+
+# Reviews and favorites can be committed in batches by one writer thread (see write_queue.py)
+init_write_queue(app)
+
+# Password hashing runs in a small process pool, and failed logins are throttled (see passwords.py)
+init_passwords(app)
+
+# "Similar spots" and "for you" lists, updated in the background after writes (see recommend.py)
+init_recommend(app)
+
+# Spot lists read a memory-mapped snapshot of the spots shared by every worker (see catalog.py)
+init_catalog(app)
+
+# Fingerprinted, precompressed static files and gzip for large pages (see assets.py)
+init_assets(app)
+
+# Search box suggestions from an in-memory prefix index of spot names (see suggest.py)
+init_suggest(app)
+
+# Browsers keep a copy of the spots and fetch only what changed (see changes.py)
+init_changes(app)
+
+# Templates compiled once into a cache on disk, and new workers warmed up early (see startup.py)
+init_startup(app)
+
+# Online backups and NDJSON exports that don't hold up writers (see backup.py)
+init_backup(app)
+
+# Shown when the hashing pool is full: the server is busy, not the user's fault
+HASHING_BUSY = ("Too many people are logging in right now, please try again in a moment", 503,
+                {"Retry-After": "1"})
+
+# Jinja filter that renders search snippets with the matched words highlighted
+app.add_template_filter(highlight)
+
+# Tags are stored as bits in spots.tag_bits; templates list them from tags.TAGS
+app.add_template_filter(tag_labels)
+app.add_template_global(has_tag)
+app.add_template_global(TAGS, "TAGS")
 
 # Registration (Harvard email required, username & email must be unique, password hashed)
 
@@ -44,7 +115,6 @@ def register():
             (email,),
         ).fetchone()
         if exists_email:
-            db.close()
             return render_template("register.html", error="Email already registered.")
 
         # Check that username is not already taken
@@ -53,19 +123,22 @@ def register():
             (username,),
         ).fetchone()
         if exists_username:
-            db.close()
             return render_template("register.html", error="Username already taken.")
 
-        # Hash the password
-        hashed = generate_password_hash(password)
+        # Hash the password, giving the connection back to the pool while that runs
+        close_db()
+        try:
+            hashed = hash_password(password)
+        except HashingUnavailable:
+            return HASHING_BUSY
 
         # Insert the new user into the database
+        db = get_db()
         db.execute(
             "INSERT INTO users (email, username, hash) VALUES (?, ?, ?)",
             (email, username, hashed),
         )
         db.commit()
-        db.close()
 
         # After successfully registering, send the user to the login page
         return redirect(url_for("login"))
@@ -81,20 +154,45 @@ def login():
         username = request.form.get("username")
         password = request.form.get("password")
 
+        # Too many recent failures for this username or address: don't even hash
+        retry_after = login_retry_after(username, request.remote_addr)
+        if retry_after:
+            return "Too many failed logins, please try again later", 429, {"Retry-After": str(retry_after)}
+
         db = get_db()
         user = db.execute(
             "SELECT id, username, hash, is_admin FROM users WHERE username = ?",
             (username,),
         ).fetchone()
-        db.close()
 
         # If there is no user with that username, show error
         if user is None:
+            record_login_failure(username, request.remote_addr)
             return "Invalid username or password", 400
 
-        # Check that the entered password matches the stored hash
-        if not check_password_hash(user["hash"], password):
-            return "Invalid username or password", 400
+        # Check that the entered password matches the stored hash, giving the
+        # connection back to the pool while that runs
+        close_db()
+        try:
+            if not check_password(user["hash"], password):
+                record_login_failure(username, request.remote_addr)
+                return "Invalid username or password", 400
+
+        except HashingUnavailable:
+            return HASHING_BUSY
+        clear_login_failures(username)
+
+        # Hashes made with older settings are upgraded while we have the password.
+        # The password is already checked, so a busy pool only puts that off
+        if needs_rehash(user["hash"]):
+            try:
+                new_hash = hash_password(password)
+            except HashingUnavailable:
+                app.logger.warning("Could not rehash the password of user %s", user["id"])
+            else:
+                db = get_db()
+                db.execute("UPDATE users SET hash = ? WHERE id = ?", (new_hash, user["id"]))
+                db.commit()
 
         # Save user info in the session 
         session["user_id"] = user["id"]
@@ -117,138 +215,261 @@ def logout():
 # Home page showing top rated spots
 
 @app.route("/")
+@cached("spots", "ratings")
 def index():
+    # Top 5 of the precomputed overall leaderboard (Bayesian ranking, see leaderboard.py),
+    # read from the memory-mapped catalog when it is up to date
     db = get_db()
-    spots = db.execute(
-        """
-        SELECT
-            spots.id,
-            spots.name,
-            spots.category,
-            ROUND(AVG(reviews.rating), 1) AS avg_rating,
-            COUNT(reviews.id) AS review_count
-        FROM spots
-        LEFT JOIN reviews ON reviews.spot_id = spots.id
-        GROUP BY spots.id
-        HAVING review_count > 0
-        ORDER BY avg_rating DESC, review_count DESC
-        LIMIT 5
-        """
-    ).fetchall()
+    catalog = get_catalog(db)
+    spots = catalog.top_rated(5) if catalog is not None else top_spots(db, "all", 5)
 
-    db.close()
     return render_template("index.html", spots=spots)
 
 
-# Spots list and map (includes filters for text query, min rating, and tags)
+# Spots list and map (includes filters for text query, min rating, tags and opening hours)
+
+def open_filter_slot():
+    """The quarter hour an "open now" filter means, so cached pages move on with the clock."""
+    try:
+        return requested_slot(request.args)
+    except ValueError:
+        return None
+
 
 @app.route("/spots")
+@cached("spots", "reviews", vary=open_filter_slot)
 def spots():
    
     # Require login
     if not session.get("user_id"):
         return redirect(url_for("login"))
 
-    # Query parameters from the URL (search box)
-    q = request.args.get("q")          
-    min_rating = request.args.get("min_rating") 
+    db = get_db()
+
+    # Only the first page is rendered here; the page fetches the rest from /api/spots
+    try:
+        rows, next_cursor = spot_page(db, request.args, app.config["SPOTS_PAGE_SIZE"])
+    except BadFilter as error:
+        return str(error), 400
+
+    # Without filters the map shows every spot, so it loads precomputed clusters
+    # for the visible area from /api/spots.geojson instead of inlined markers
+    filtered = any(
+        request.args.get(key) for key in ["q", "min_rating", "open_now", "open_at", *TAG_KEYS]
+    )
+
+    # Build data for the map (JSON sent to the front end)
+    spot_data = [spot_fields(s) for s in rows] if filtered else []
+
+    return render_template(
+        "spots.html",
+        spots=rows,
+        spot_data=spot_data,
+        next_cursor=next_cursor,
+        clustered_map=not filtered,
+        max_cluster_zoom=MAX_CLUSTER_ZOOM,
+    )
+
+
+# Paginated JSON version of /spots - same filters, keyset cursor, selectable fields
+
+@app.route("/api/spots")
+def api_spots():
+
+    if not session.get("user_id"):
+        return {"error": "Login required"}, 401
+
+    limit = request.args.get("limit", app.config["SPOTS_PAGE_SIZE"], type=int)
+    limit = max(1, min(limit, app.config["SPOTS_PAGE_SIZE_MAX"]))
+
+    try:
+        fields = parse_fields(request.args.get("fields"))
+        rows, next_cursor = spot_page(get_db(), request.args, limit, request.args.get("cursor"))
+    except ValueError as error:
+        return {"error": str(error)}, 400
+
+    return {
+        "spots": [spot_fields(row, fields) for row in rows],
+        "next_cursor": next_cursor,
+    }
 
-    # Tag filters (checkboxes)
-    late_night = request.args.get("late_night")
-    fine_dining = request.args.get("fine_dining")
-    health_conscious = request.args.get("health_conscious")
-    affordable = request.args.get("affordable")
-    sweet_treat = request.args.get("sweet_treat")
-    close_tag = request.args.get("close")
+
+# Spatial API for the map - spots near a point, or inside the visible bounding box
+
+def spot_json(row, distance=None):
+    spot = {
+        "id": row["id"],
+        "name": row["name"],
+        "category": row["category"],
+        "latitude": row["latitude"],
+        "longitude": row["longitude"],
+        "avg_rating": row["avg_rating"],
+        "review_count": row["review_count"],
+    }
+    if distance is not None:
+        spot["distance_km"] = round(distance, 3)
+    return spot
+
+
+@app.route("/api/spots/nearby")
+def api_spots_nearby():
+
+    if not session.get("user_id"):
+        return {"error": "Login required"}, 401
+
+    lat = request.args.get("lat", type=float)
+    lon = request.args.get("lon", type=float)
+    radius = request.args.get("radius", type=float)  # kilometres
+    limit = max(1, min(request.args.get("limit", 50, type=int), 500))
+
+    if lat is None or lon is None:
+        return {"error": "lat and lon are required"}, 400
+    if radius is not None and radius <= 0:
+        return {"error": "radius must be positive"}, 400
 
     db = get_db()
 
-    # Base query selects spots and aggregated rating info
-    query = """
-        SELECT
-            spots.id,
-            spots.name,
-            spots.category,
-            spots.latitude,
-            spots.longitude,
-            spots.late_night,
-            spots.fine_dining,
-            spots.health_conscious,
-            spots.affordable,
-            spots.sweet_treat,
-            spots.close,
-            ROUND(AVG(reviews.rating), 1) AS avg_rating,
-            COUNT(reviews.id) AS review_count
-        FROM spots
-        LEFT JOIN reviews ON reviews.spot_id = spots.id
-    """
-
-    conditions = []
-    params = []
-
-    # Text search - matches name or category using LIKE
-    if q:
-        conditions.append("(spots.name LIKE ? OR spots.category LIKE ?)")
-        like_term = f"%{q}%"
-        params.extend([like_term, like_term])
-
-    # Tag filters - each checked box means we restrict to spots where that flag is 1
-    if late_night:
-        conditions.append("spots.late_night = 1")
-    if fine_dining:
-        conditions.append("spots.fine_dining = 1")
-    if health_conscious:
-        conditions.append("spots.health_conscious = 1")
-    if affordable:
-        conditions.append("spots.affordable = 1")
-    if sweet_treat:
-        conditions.append("spots.sweet_treat = 1")
-    if close_tag:
-        conditions.append("spots.close = 1")
-
-    # If there are any filters, add a WHERE clause
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
-
-    # Group by spot so we can use AVG and COUNT on reviews
-    query += " GROUP BY spots.id"
-
-    # Minimum rating filter is a HAVING on the aggregated avg_rating
-    if min_rating:
-        query += " HAVING avg_rating >= ?"
-        params.append(float(min_rating))
-
-    # Order alphabetically by spot name
-    query += " ORDER BY spots.name"
-
-    rows = db.execute(query, params).fetchall()
-    db.close()
+    # Without a radius this is a k-nearest-neighbour search for the closest `limit` spots
+    if radius is None:
+        found = nearest_spots(db, lat, lon, limit)
+    else:
+        found = spots_nearby(db, lat, lon, radius, limit)
 
-    # Build data for the map (JSON sent to the front end)
-    spot_data = []
-    for s in rows:
-        spot_data.append({
-            "id": s["id"],
-            "name": s["name"],
-            "category": s["category"],
-            "latitude": s["latitude"],
-            "longitude": s["longitude"],
-            "avg_rating": s["avg_rating"],
-            "review_count": s["review_count"],
-            "late_night": s["late_night"],
-            "fine_dining": s["fine_dining"],
-            "health_conscious": s["health_conscious"],
-            "affordable": s["affordable"],
-            "sweet_treat": s["sweet_treat"],
-            "close": s["close"],
-        })
-
-    return render_template("spots.html", spots=rows, spot_data=spot_data)
+    return {"spots": [spot_json(row, distance) for row, distance in found]}
+
+
+@app.route("/api/spots/within")
+def api_spots_within():
+
+    if not session.get("user_id"):
+        return {"error": "Login required"}, 401
+
+    # bbox is west,south,east,north - the order Leaflet's getBounds().toBBoxString() uses
+    try:
+        min_lat, max_lat, min_lon, max_lon = parse_bbox(request.args.get("bbox"))
+    except ValueError:
+        return {"error": "bbox must be west,south,east,north"}, 400
+
+    limit = max(1, min(request.args.get("limit", 500, type=int), 5000))
+
+    db = get_db()
+    rows = spots_in_box(db, min_lat, max_lat, min_lon, max_lon, limit)
+
+    return {"spots": [spot_json(row) for row in rows]}
+
+
+# Summaries of many spots at once, e.g. for the ids a page already has
+
+@app.route("/api/spots/batch")
+def api_spots_batch():
+
+    if not session.get("user_id"):
+        return {"error": "Login required"}, 401
+
+    try:
+        spot_ids = parse_ids(request.args.get("ids"))
+    except ValueError as error:
+        return {"error": str(error)}, 400
+
+    rows = spot_summaries(get_db(), spot_ids)
+
+    return {"spots": [spot_json(row) for row in rows]}
+
+
+# Map markers as GeoJSON - precomputed clusters for the viewport and zoom level,
+# streamed feature by feature instead of built up as one big string
+
+@app.route("/api/spots.geojson")
+def api_spots_geojson():
+
+    if not session.get("user_id"):
+        return {"error": "Login required"}, 401
+
+    try:
+        min_lat, max_lat, min_lon, max_lon = parse_bbox(request.args.get("bbox"))
+    except ValueError:
+        return {"error": "bbox must be west,south,east,north"}, 400
+
+    zoom = request.args.get("zoom", type=int)
+    if zoom is None or zoom < 0:
+        return {"error": "zoom is required"}, 400
+
+    # The body is sent after the view's teardown has already given its connection
+    # back to the pool, so the stream borrows its own once it starts
+    def features():
+        yield from map_features(get_db(), zoom, min_lat, max_lat, min_lon, max_lon)
+
+    return Response(
+        stream_with_context(stream_feature_collection(features())),
+        mimetype="application/geo+json",
+    )
+
+
+# Spot changes since a cursor, for the copy of the spot list the browser keeps
+
+@app.route("/api/changes")
+def api_changes():
+
+    if not session.get("user_id"):
+        return {"error": "Login required"}, 401
+
+    since = request.args.get("since", 0, type=int)
+    if since < 0:
+        return {"error": "since must be a cursor from an earlier response"}, 400
+    limit = request.args.get("limit", app.config["CHANGES_PAGE_SIZE"], type=int)
+
+    return changes_since(get_db(), since, limit)
+
+
+# Leaderboards - best spots overall, in one category or with one tag
+
+@app.route("/api/leaderboard")
+def api_leaderboard():
+
+    try:
+        board = board_name(request.args.get("category"), request.args.get("tag"))
+    except KeyError:
+        return {"error": "Unknown tag"}, 400
+
+    limit = max(1, min(request.args.get("limit", 10, type=int), MAX_LIMIT))
+
+    rows = top_spots(get_db(), board, limit)
+
+    return {
+        "board": board,
+        "spots": [
+            {
+                "id": row["id"],
+                "name": row["name"],
+                "category": row["category"],
+                "avg_rating": row["avg_rating"],
+                "review_count": row["review_count"],
+                "score": round(row["score"], 3),
+            }
+            for row in rows
+        ],
+    }
+
+
+# Search box suggestions, asked for on every keystroke - answered from memory
+
+@app.route("/api/suggest")
+def api_suggest():
+
+    if not session.get("user_id"):
+        return {"error": "Login required"}, 401
+
+    limit = request.args.get("limit", app.config["SUGGEST_LIMIT"], type=int)
+    results = suggestions(request.args.get("q", ""), limit)
+
+    # Typing and deleting a letter asks again for the same prefix
+    return {"suggestions": results}, 200, {"Cache-Control": "max-age=60"}
 
 
 # Spot detail page - list basic info and ratings and reviews
 
 @app.route("/spot/<int:spot_id>")
+@cached("spots", "reviews", "favorites:{user_id}", "recommendations", "similar_spots:{spot_id}")
 def spot_detail(spot_id):
     
     # Require login
@@ -256,65 +477,11 @@ def spot_detail(spot_id):
         return redirect(url_for("login"))
 
     db = get_db()
-    # Load the spot, including tag flags
-    spot = db.execute(
-        """
-        SELECT
-            id,
-            name,
-            category,
-            latitude,
-            longitude,
-            late_night,
-            fine_dining,
-            health_conscious,
-            affordable,
-            sweet_treat,
-            close
-        FROM spots
-        WHERE id = ?
-        """,
-        (spot_id,),
-    ).fetchone()
 
-    # Load all reviews for this spot with the review author's username
-    reviews = db.execute(
-        """
-        SELECT reviews.rating,
-               reviews.text,
-               users.username
-        FROM reviews
-        LEFT JOIN users ON reviews.user_id = users.id
-        WHERE reviews.spot_id = ?
-        ORDER BY reviews.id DESC
-        """,
-        (spot_id,),
-    ).fetchall()
-
-    # Calculate average rating and total review count for the spot
-    avg_row = db.execute(
-        """
-        SELECT ROUND(AVG(rating), 1) AS avg_rating,
-               COUNT(*) AS review_count
-        FROM reviews
-        WHERE spot_id = ?
-        """,
-        (spot_id,),
-    ).fetchone()
-
-    avg_rating = avg_row["avg_rating"]
-    review_count = avg_row["review_count"]
-
-    # Check if the current user has this spot in favorites
-    is_favorite = False
-    if session.get("user_id") and spot is not None:
-        fav = db.execute(
-            "SELECT 1 FROM favorites WHERE user_id = ? AND spot_id = ?",
-            (session["user_id"], spot_id),
-        ).fetchone()
-        is_favorite = fav is not None
-
-    db.close()
+    # The spot, its rating stats, the favorite flag and the newest reviews, in one query
+    spot, reviews, next_cursor = spot_with_reviews(
+        db, spot_id, session["user_id"], app.config["REVIEWS_PAGE_SIZE"]
+    )
 
     if spot is None:
         return "Spot not found", 404
@@ -323,10 +490,44 @@ def spot_detail(spot_id):
         "spot_detail.html",
         spot=spot,
         reviews=reviews,
-        is_favorite=is_favorite,
-        avg_rating=avg_rating,
-        review_count=review_count,
+        next_cursor=next_cursor,
+        is_favorite=spot["is_favorite"],
+        avg_rating=spot["avg_rating"],
+        review_count=spot["review_count"],
+        similar=similar_spots(db, spot_id),
+    )
+
+
+# Older reviews of a spot, a page at a time, for the "Load more reviews" button
+
+@app.route("/api/spots/<int:spot_id>/reviews")
+def api_spot_reviews(spot_id):
+
+    if not session.get("user_id"):
+        return {"error": "Login required"}, 401
+
+    limit = request.args.get("limit", app.config["REVIEWS_PAGE_SIZE"], type=int)
+    limit = max(1, min(limit, app.config["SPOTS_PAGE_SIZE_MAX"]))
+    before = request.args.get("before", type=int)
+
+    spot, reviews, next_cursor = spot_with_reviews(
+        get_db(), spot_id, session["user_id"], limit, before
     )
+    if spot is None:
+        return {"error": "Spot not found"}, 404
+
+    return {
+        "reviews": [
+            {
+                "id": review["review_id"],
+                "rating": review["rating"],
+                "text": review["text"],
+                "username": review["username"],
+            }
+            for review in reviews
+        ],
+        "next_cursor": next_cursor,
+    }
 
 # Add review for a spot
 
@@ -338,13 +539,11 @@ def add_review(spot_id):
     rating = request.form.get("rating")
     text = request.form.get("text")
 
-    db = get_db()
-    db.execute(
+    execute_write(
         "INSERT INTO reviews (spot_id, rating, text, user_id) VALUES (?, ?, ?, ?)",
         (spot_id, rating, text, session["user_id"]),
     )
-    db.commit()
-    db.close()
+    schedule_update()
 
     return redirect(f"/spot/{spot_id}")
 
@@ -371,38 +570,21 @@ def add_spot():
         lat = float(latitude_raw) if latitude_raw else None
         lon = float(longitude_raw) if longitude_raw else None
 
-        # Tag flags from checkboxes (presence of key in form means checked)
-        late_night = 1 if request.form.get("late_night") else 0
-        fine_dining = 1 if request.form.get("fine_dining") else 0
-        health_conscious = 1 if request.form.get("health_conscious") else 0
-        affordable = 1 if request.form.get("affordable") else 0
-        sweet_treat = 1 if request.form.get("sweet_treat") else 0
+        # Tag bits from checkboxes (presence of key in form means checked)
+        tag_bits = tags_from_form(request.form)
 
         # Insert the new spot into the database
         db = get_db()
-        db.execute(
+        cursor = db.execute(
             """
-            INSERT INTO spots
-                (name, category, latitude, longitude,
-                 late_night, fine_dining, health_conscious,
-                 affordable, sweet_treat, close)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO spots (name, category, latitude, longitude, tag_bits)
+            VALUES (?, ?, ?, ?, ?)
             """,
-            (
-                name,
-                category,
-                lat,
-                lon,
-                late_night,
-                fine_dining,
-                health_conscious,
-                affordable,
-                sweet_treat,
-                close_flag,
-            ),
+            (name, category, lat, lon, tag_bits),
         )
+        # Computed tags such as "close" come from the coordinates (see derived_tags.py)
+        derive_tags(db, [cursor.lastrowid])
         db.commit()
-        db.close()
 
         # Redirect back to the full spots list
         return redirect("/spots")
@@ -424,55 +606,48 @@ def edit_spot(spot_id):
     if request.method == "POST":
         name = request.form.get("name")
         category = request.form.get("category")
-        latitude = request.form.get("latitude")
-        longitude = request.form.get("longitude")
+        latitude_raw = request.form.get("latitude")
+        longitude_raw = request.form.get("longitude")
 
-        # Checkbox logic for tag flags
-        late_night = 1 if request.form.get("late_night") else 0
-        fine_dining = 1 if request.form.get("fine_dining") else 0
-        health_conscious = 1 if request.form.get("health_conscious") else 0
-        affordable = 1 if request.form.get("affordable") else 0
-        sweet_treat = 1 if request.form.get("sweet_treat") else 0
-        close_tag = 1 if request.form.get("close") else 0
+        # Convert latitude and longitude to float (blank means no location)
+        latitude = float(latitude_raw) if latitude_raw else None
+        longitude = float(longitude_raw) if longitude_raw else None
+
+        # Checkbox logic for tag bits
+        tag_bits = tags_from_form(request.form)
 
         if not name:
-            db.close()
             return "Name is required", 400
 
+        old = db.execute(
+            "SELECT tag_bits, tags_removed FROM spots WHERE id = ?", (spot_id,)
+        ).fetchone()
+        if old is None:
+            return "Spot not found", 404
+
+        # A tag the admin unticks stays off even if the OSM data implies it,
+        # until it is ticked again (computed tags aren't the admin's to set)
+        tags_removed = (old["tags_removed"] | old["tag_bits"]) & ~tag_bits & ~COMPUTED_BITS
+
         # Update the spot with the new data
         db.execute(
             """
             UPDATE spots
-            SET name = ?, category = ?, latitude = ?, longitude = ?,
-                late_night = ?, fine_dining = ?, health_conscious = ?,
-                affordable = ?, sweet_treat = ?, close = ?
+            SET name = ?, category = ?, latitude = ?, longitude = ?, tag_bits = ?, tags_removed = ?
             WHERE id = ?
             """,
-            (
-                name,
-                category,
-                latitude,
-                longitude,
-                late_night,
-                fine_dining,
-                health_conscious,
-                affordable,
-                sweet_treat,
-                close_tag,
-                spot_id,
-            ),
+            (name, category, latitude, longitude, tag_bits, tags_removed, spot_id),
         )
+        derive_tags(db, [spot_id])
         db.commit()
-        db.close()
 
         return redirect(f"/spot/{spot_id}")
 
     # Load the existing spot data into the form (GET)
     spot = db.execute(
-        "SELECT id, name, category, latitude, longitude FROM spots WHERE id = ?",
+        "SELECT id, name, category, latitude, longitude, tag_bits FROM spots WHERE id = ?",
         (spot_id,),
     ).fetchone()
-    db.close()
 
     if spot is None:
         return "Spot not found", 404
@@ -489,14 +664,15 @@ def delete_spot(spot_id):
 
     db = get_db()
 
-    # Remove reviews for this spot first
+    # Remove the spot, then its reviews (both deletes commit together)
+    db.execute("DELETE FROM spots WHERE id = ?", (spot_id,))
     db.execute("DELETE FROM reviews WHERE spot_id = ?", (spot_id,))
 
-    # Remove the spot itself
-    db.execute("DELETE FROM spots WHERE id = ?", (spot_id,))
+    # Deleting is what leaves tombstones in the change log, so old ones are pruned here
+    compact_changes(db)
 
     db.commit()
-    db.close()
+    schedule_update()
 
     return redirect("/spots")
 
@@ -504,6 +680,7 @@ def delete_spot(spot_id):
 # My Reviews
 
 @app.route("/my-reviews")
+@cached("spots", "reviews:{user_id}")
 def my_reviews():
 
     if not session.get("user_id"):
@@ -526,7 +703,6 @@ def my_reviews():
         """,
         (session["user_id"],),
     ).fetchall()
-    db.close()
 
     return render_template("my_reviews.html", reviews=reviews)
 
@@ -539,13 +715,11 @@ def favorite_spot(spot_id):
     if not session.get("user_id"):
         return redirect(url_for("login"))
 
-    db = get_db()
-    db.execute(
+    execute_write(
         "INSERT OR IGNORE INTO favorites (user_id, spot_id) VALUES (?, ?)",
         (session["user_id"], spot_id),
     )
-    db.commit()
-    db.close()
+    schedule_update()
 
     return redirect(f"/spot/{spot_id}")
 
@@ -557,19 +731,18 @@ def unfavorite_spot(spot_id):
     if not session.get("user_id"):
         return redirect(url_for("login"))
 
-    db = get_db()
-    db.execute(
+    execute_write(
         "DELETE FROM favorites WHERE user_id = ? AND spot_id = ?",
         (session["user_id"], spot_id),
     )
-    db.commit()
-    db.close()
+    schedule_update()
 
     return redirect(f"/spot/{spot_id}")
 
 # Show favorites
 
 @app.route("/favorites")
+@cached("spots", "favorites:{user_id}", "recommendations", "recommendations:{user_id}")
 def favorites():
 
     if not session.get("user_id"):
@@ -586,9 +759,57 @@ def favorites():
         """,
         (session["user_id"],),
     ).fetchall()
-    db.close()
 
-    return render_template("favorites.html", spots=spots)
+    return render_template(
+        "favorites.html",
+        spots=spots,
+        recommended=recommended_spots(db, session["user_id"]),
+    )
+
+
+# Backups (admin only): list them, or start one in the background
+
+@app.route("/admin/backups", methods=["GET", "POST"])
+def admin_backups():
+
+    if not session.get("is_admin"):
+        return {"error": "Access denied"}, 403
+
+    if request.method == "POST":
+        if not start_backup():
+            return {"error": "A backup is already running"}, 409
+        return {"started": True}, 202
+
+    return backup_status(app.config)
+
+
+# Spots, reviews and favorites as gzipped NDJSON (admin only), streamed from one snapshot
+
+@app.route("/admin/export.ndjson.gz")
+def admin_export():
+
+    if not session.get("is_admin"):
+        return {"error": "Access denied"}, 403
+
+    # Like the GeoJSON stream, the body borrows its own connection once it starts
+    def chunks():
+        yield from export_ndjson_gz(get_db(), app.config["EXPORT_COMPRESS_LEVEL"])
+
+    return Response(
+        stream_with_context(chunks()),
+        mimetype="application/gzip",
+        headers={"Content-Disposition": "attachment; filename=harvardeats.ndjson.gz"},
+    )
+
+
+# Prometheus metrics for this worker process
+
+@app.route("/metrics")
+def metrics():
+    # Query names and timings are for admins and the configured scraper only
+    if not (session.get("is_admin") or scraper_allowed()):
+        return {"error": "Access denied"}, 403
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
 
 # Local development entry point
@@ -0,0 +1,252 @@
+"""Fingerprint and precompress the static files, and fetch the vendored Leaflet.
+
+Usage: python assets.py [build | vendor]
+
+build (run after every deploy, before restarting the workers) copies each file
+under static/ to static/dist/ with a hash of its contents in the name
+(styles.css -> styles.3f2a9c1be0.css), next to .gz and, if the brotli package
+is installed, .br versions of the text files. static/dist/manifest.json maps the
+original names to the copies, and url_for('static', filename=...) then links to
+the copy, which is served with a year-long immutable Cache-Control and in the
+best encoding the browser accepts. Without a manifest the plain files are
+served as before.
+
+vendor downloads Leaflet into static/vendor/leaflet/ so pages stop loading it
+from unpkg.com; commit the files it writes.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import urllib.request
+
+from flask import current_app, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # optional; without it only .gz copies are made
+    brotli = None
+
+DEFAULTS = {
+    "COMPRESS_MIN_SIZE": 1024,   # bytes; smaller responses aren't worth compressing
+    "COMPRESS_LEVEL": 6,
+    "COMPRESS_MIMETYPES": ["text/html", "application/json", "application/geo+json"],
+}
+
+DIST = "dist"
+MANIFEST = "manifest.json"
+HASH_LENGTH = 10
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# Worth compressing; images and fonts are compressed already
+TEXT_EXTENSIONS = {".css", ".js", ".svg", ".json", ".txt", ".map", ".html"}
+
+LEAFLET_VERSION = "1.9.4"
+LEAFLET_URL = f"https://unpkg.com/leaflet@{LEAFLET_VERSION}/dist/"
+LEAFLET_FILES = [
+    "leaflet.js",
+    "leaflet.css",
+    "images/layers.png",
+    "images/layers-2x.png",
+    "images/marker-icon.png",
+    "images/marker-icon-2x.png",
+    "images/marker-shadow.png",
+]
+LEAFLET_DIR = "vendor/leaflet"
+
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+?)\1\s*\)""")
+
+
+def fingerprinted(path, data):
+    stem, extension = posixpath.splitext(path)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{extension}"
+
+
+def rewrite_css_urls(css_path, text, manifest):
+    """Point url(...) references in a stylesheet at the fingerprinted copies."""
+    directory = posixpath.dirname(css_path)
+
+    def replace(match):
+        quote, target = match.groups()
+        # Leave data: URIs, other sites and absolute paths alone
+        if re.match(r"(?:[a-z][a-z0-9+.-]*:|//|#|/)", target, re.IGNORECASE):
+            return match.group(0)
+        path, suffix = re.match(r"([^?#]*)(.*)", target).groups()
+        source = posixpath.normpath(posixpath.join(directory, path))
+        if source not in manifest:
+            return match.group(0)
+        new_path = posixpath.relpath(manifest[source], posixpath.join(DIST, directory))
+        return f"url({quote}{new_path}{suffix}{quote})"
+
+    return CSS_URL_RE.sub(replace, text)
+
+
+def build(static_folder):
+    """Write static/dist/ and its manifest; returns the manifest."""
+    dist = os.path.join(static_folder, DIST)
+    sources = []
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and
+                         os.path.join(root, d) != dist)
+        for name in sorted(files):
+            if not name.startswith("."):
+                path = os.path.relpath(os.path.join(root, name), static_folder)
+                sources.append(path.replace(os.sep, "/"))
+    # Stylesheets last, so the files they refer to already have their new names
+    sources.sort(key=lambda path: (path.endswith(".css"), path))
+
+    manifest = {}
+    written = set()
+    for path in sources:
+        with open(os.path.join(static_folder, path), "rb") as f:
+            data = f.read()
+        if path.endswith(".css"):
+            data = rewrite_css_urls(path, data.decode(), manifest).encode()
+        target = fingerprinted(path, data)
+        manifest[path] = posixpath.join(DIST, target)
+
+        variants = {target: data}
+        if posixpath.splitext(path)[1] in TEXT_EXTENSIONS:
+            # mtime=0 keeps the .gz bytes the same from build to build
+            variants[target + ".gz"] = gzip.compress(data, 9, mtime=0)
+            if brotli is not None:
+                variants[target + ".br"] = brotli.compress(data)
+        for name, content in variants.items():
+            if name != target and len(content) >= len(data):
+                continue
+            output = os.path.join(dist, *name.split("/"))
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            # Fingerprinted names never change contents, so existing files are kept
+            if not os.path.exists(output):
+                with open(output + ".tmp", "wb") as f:
+                    f.write(content)
+                os.replace(output + ".tmp", output)
+            written.add(name)
+
+    # Drop copies of files that have since changed or gone
+    for root, _, files in os.walk(dist):
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), dist).replace(os.sep, "/")
+            if path != MANIFEST and path not in written:
+                os.remove(os.path.join(root, name))
+
+    with open(os.path.join(dist, MANIFEST + ".tmp"), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(os.path.join(dist, MANIFEST + ".tmp"), os.path.join(dist, MANIFEST))
+    return manifest
+
+
+def vendor(static_folder):
+    """Download Leaflet into static/vendor/leaflet/."""
+    for name in LEAFLET_FILES:
+        output = os.path.join(static_folder, *LEAFLET_DIR.split("/"), *name.split("/"))
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with urllib.request.urlopen(LEAFLET_URL + name, timeout=30) as response:
+            data = response.read()
+        with open(output, "wb") as f:
+            f.write(data)
+        print(f"{output} ({len(data)} bytes)")
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def fingerprint_static_urls(endpoint, values):
+    """url_defaults hook: url_for('static', filename=...) links to the fingerprinted copy."""
+    if endpoint == "static" and "filename" in values:
+        target = current_app.extensions["asset_manifest"].get(values["filename"])
+        if target is not None:
+            values["filename"] = target
+
+
+def serve_asset(filename):
+    """A fingerprinted file from static/dist/, precompressed when the browser allows."""
+    dist = os.path.join(current_app.static_folder, DIST)
+    chosen, encoding = filename, None
+    for candidate, suffix in [("br", ".br"), ("gzip", ".gz")]:
+        path = safe_join(dist, filename + suffix)
+        if request.accept_encodings[candidate] and path and os.path.isfile(path):
+            chosen, encoding = filename + suffix, candidate
+            break
+
+    # Typed by the file it is a compressed copy of, not as an archive
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = send_from_directory(dist, chosen, mimetype=mimetype, max_age=31536000)
+    if encoding:
+        response.content_encoding = encoding
+    response.headers["Cache-Control"] = IMMUTABLE
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def leaflet_url(name):
+    """The vendored Leaflet file if `assets.py vendor` has fetched it, else unpkg's copy."""
+    local = os.path.join(current_app.static_folder, *LEAFLET_DIR.split("/"), name)
+    if os.path.isfile(local):
+        return url_for("static", filename=f"{LEAFLET_DIR}/{name}")
+    return LEAFLET_URL + name
+
+
+def compress_response(response):
+    """after_request hook: gzip HTML and JSON bodies above COMPRESS_MIN_SIZE."""
+    config = current_app.config
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in config["COMPRESS_MIMETYPES"]
+        or not request.accept_encodings["gzip"]
+    ):
+        return response
+    data = response.get_data()
+    if len(data) < config["COMPRESS_MIN_SIZE"]:
+        return response
+
+    response.set_data(gzip.compress(data, config["COMPRESS_LEVEL"]))
+    response.content_encoding = "gzip"
+    response.vary.add("Accept-Encoding")
+    # Different bytes than the uncompressed page, so the ETag can only be a weak match
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.extensions["asset_manifest"] = load_manifest(app.static_folder)
+    app.url_defaults(fingerprint_static_urls)
+    app.add_url_rule(f"{app.static_url_path}/{DIST}/<path:filename>", "asset", serve_asset)
+    app.jinja_env.globals["leaflet_url"] = leaflet_url
+    app.after_request(compress_response)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", nargs="?", choices=["build", "vendor"], default="build")
+    parser.add_argument("--static", default=os.path.join(os.path.dirname(__file__) or ".", "static"))
+    args = parser.parse_args()
+
+    if args.command == "vendor":
+        vendor(args.static)
+    else:
+        manifest = build(args.static)
+        for source, target in sorted(manifest.items()):
+            print(f"{source} -> {target}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+"""Back up the database while the site keeps running, and export it for analytics.
+
+Usage: python backup.py [--db spots.db] backup [--dir backups]
+       python backup.py [--db spots.db] export [--out export.ndjson.gz]
+
+backup copies the database with SQLite's online backup API into
+<BACKUP_DIR>/<name>-<UTC time>.db and keeps the newest BACKUP_KEEP copies.
+Copying the file by hand can catch a commit half written; this can't. The
+copy is made BACKUP_STEP_PAGES pages at a time with a BACKUP_STEP_PAUSE sleep
+between steps, so the disk is shared with the site and no lock is held for
+long. The source connection holds one read transaction for the whole copy, so
+every step reads the same snapshot: in WAL mode writers carry on meanwhile,
+and their commits don't make the backup start over (which, on a busy site,
+it otherwise does after every commit). The WAL can't be checkpointed past
+that snapshot until the copy is done, so it grows a little during a backup.
+The copy is finished in a temporary file, checked and renamed into place, so
+a file with the final name is always a whole backup. Run it hourly from cron;
+admins can also start one from POST /admin/backups.
+
+export writes the spots, reviews and favorites as gzip-compressed NDJSON, one
+object per line with a "type" of "spot", "review" or "favorite". All three are
+read in one read transaction, so they come from the same moment even while
+reviews are being added. Rows are streamed, never all held in memory. The
+same stream is served to admins at /admin/export.ndjson.gz.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+from flask import current_app
+
+from database import connect
+from tags import TAGS
+
+try:
+    import fcntl
+except ImportError:  # Windows: no file locks, so workers may each start a backup
+    fcntl = None
+
+DB_PATH = "spots.db"
+
+DEFAULTS = {
+    "BACKUP_DIR": None,             # default: backups/ next to the database
+    "BACKUP_KEEP": 48,              # newest backups kept; two days of hourly ones
+    "BACKUP_STEP_PAGES": 256,       # pages copied per step (1 MB with 4 KB pages)
+    "BACKUP_STEP_PAUSE": 0.01,      # seconds to sleep between steps
+    "BACKUP_CHECK": True,           # run PRAGMA quick_check on the copy before keeping it
+    "EXPORT_COMPRESS_LEVEL": 6,
+}
+
+# Rows fetched per round trip while exporting, and compressed together
+EXPORT_BATCH = 1000
+# Compressed bytes gathered before a chunk is handed on
+EXPORT_CHUNK = 64 * 1024
+
+# SQLite writes each line itself with json_object, which is several times
+# faster than building a dict per row and encoding it in Python. A spot's tags
+# are listed by key, from the bit numbers in :tags.
+EXPORT_QUERIES = [
+    """
+    SELECT json_object(
+        'type', 'spot',
+        'id', id,
+        'name', name,
+        'category', category,
+        'latitude', latitude,
+        'longitude', longitude,
+        'tags', (SELECT json_group_array(key) FROM json_each(:tags) WHERE spots.tag_bits >> value & 1),
+        'cuisine', cuisine,
+        'brand', brand,
+        'osm_id', osm_id,
+        'opening_hours', opening_hours
+    )
+    FROM spots
+    ORDER BY id
+    """,
+    """
+    SELECT json_object(
+        'type', 'review',
+        'id', id,
+        'spot_id', spot_id,
+        'user_id', user_id,
+        'rating', rating,
+        'text', text,
+        'created_at', created_at
+    )
+    FROM reviews
+    ORDER BY id
+    """,
+    """
+    SELECT json_object('type', 'favorite', 'user_id', user_id, 'spot_id', spot_id)
+    FROM favorites
+    ORDER BY user_id, spot_id
+    """,
+]
+
+
+class BackupRunning(Exception):
+    """Another process or thread is already backing up into the same directory."""
+
+
+def backup_dir(config):
+    directory = config.get("BACKUP_DIR")
+    if directory:
+        return directory
+    return os.path.join(os.path.dirname(os.path.abspath(config["DATABASE"])), "backups")
+
+
+def _settings(config):
+    settings = dict(DEFAULTS)
+    if config:
+        settings.update({key: config[key] for key in DEFAULTS if key in config})
+    return settings
+
+
+def copy_database(path, target, config=None):
+    """Copy the database at `path` into the new file `target`, a few pages at a time.
+
+    Returns (pages copied, seconds taken).
+    """
+    settings = _settings(config)
+    pause = settings["BACKUP_STEP_PAUSE"]
+
+    # Called after each step; the sleep lets the site's reads and writes have the disk
+    def progress(status, remaining, total):
+        if remaining and pause:
+            time.sleep(pause)
+
+    start = time.perf_counter()
+    source = connect(path, config)
+    # The copy goes through this connection's page cache; keep it small
+    source.execute("PRAGMA cache_size = -2048")
+    copy = sqlite3.connect(target)
+    try:
+        # A file that is thrown away if anything goes wrong needs no journal
+        copy.execute("PRAGMA journal_mode = OFF")
+        copy.execute("PRAGMA synchronous = OFF")
+        # Pin one snapshot for every step (see the module docstring)
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        source.backup(copy, pages=settings["BACKUP_STEP_PAGES"], progress=progress)
+        pages = copy.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        source.rollback()
+        source.close()
+        copy.close()
+
+    # The copy has the source's WAL flag; a backup should be a single file
+    copy = sqlite3.connect(target)
+    try:
+        copy.execute("PRAGMA journal_mode = DELETE")
+        if settings["BACKUP_CHECK"]:
+            result = copy.execute("PRAGMA quick_check").fetchone()[0]
+            if result != "ok":
+                raise sqlite3.DatabaseError(f"The backup failed its check: {result}")
+    finally:
+        copy.close()
+    with open(target, "rb") as f:
+        os.fsync(f.fileno())
+    return pages, time.perf_counter() - start
+
+
+def list_backups(directory, name):
+    """This database's finished backups in `directory`, newest first."""
+    prefix = os.path.splitext(name)[0] + "-"
+    try:
+        files = [
+            entry for entry in os.scandir(directory)
+            if entry.is_file() and entry.name.startswith(prefix) and entry.name.endswith(".db")
+        ]
+    except FileNotFoundError:
+        return []
+    # The UTC time in the name sorts in the order the backups were made
+    return sorted(files, key=lambda entry: entry.name, reverse=True)
+
+
+def backup(config, logger=None):
+    """Make a new backup of config["DATABASE"] and prune old ones; returns its path.
+
+    Raises BackupRunning if one is already in progress for this directory.
+    """
+    settings = _settings(config)
+    path = config["DATABASE"]
+    directory = backup_dir(config)
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.basename(path)
+
+    with open(os.path.join(directory, ".lock"), "a") as lock:
+        # One backup at a time, whichever worker or cron job asked for it
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise BackupRunning(directory) from None
+
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        target = os.path.join(directory, f"{os.path.splitext(name)[0]}-{stamp}.db")
+        partial = target + ".partial"
+        if os.path.exists(partial):
+            os.remove(partial)
+        try:
+            pages, seconds = copy_database(path, partial, config)
+            os.replace(partial, target)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+        for old in list_backups(directory, name)[settings["BACKUP_KEEP"]:]:
+            os.remove(old.path)
+
+    if logger is not None:
+        logger.info("Backed up %s to %s (%d pages) in %.1fs", path, target, pages, seconds)
+    return target
+
+
+def backup_status(config):
+    """The /admin/backups body: whether a backup is running and the ones kept."""
+    directory = backup_dir(config)
+    backups = []
+    for entry in list_backups(directory, os.path.basename(config["DATABASE"])):
+        stat = entry.stat()
+        backups.append({
+            "name": entry.name,
+            "bytes": stat.st_size,
+            "finished_at": datetime.fromtimestamp(stat.st_mtime, timezone.utc).isoformat(),
+        })
+    return {"running": is_running(config), "directory": directory, "backups": backups}
+
+
+def is_running(config):
+    """True if a backup holds the lock of this database's backup directory."""
+    if fcntl is None:
+        return False
+    try:
+        lock = open(os.path.join(backup_dir(config), ".lock"), "a")
+    except FileNotFoundError:
+        return False
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        return False
+
+
+_backups = {}
+_backups_lock = threading.Lock()
+
+
+def start_backup(app=None):
+    """Back up in a background thread of this worker; False if one is already running."""
+    app = app or current_app._get_current_object()
+    with _backups_lock:
+        thread = _backups.get(app)
+        if (thread is not None and thread.is_alive()) or is_running(app.config):
+            return False
+
+        def run():
+            try:
+                backup(app.config, app.logger)
+            except BackupRunning:
+                pass
+            except Exception:
+                app.logger.exception("Backing up the database failed")
+
+        thread = threading.Thread(target=run, name="backup", daemon=True)
+        _backups[app] = thread
+        thread.start()
+    return True
+
+
+def export_lines(db):
+    """Every spot, review and favorite as lists of NDJSON lines, read from one snapshot."""
+    params = {"tags": json.dumps({tag.key: tag.bit for tag in TAGS})}
+    db.execute("BEGIN")
+    try:
+        for sql in EXPORT_QUERIES:
+            cursor = db.cursor()
+            cursor.row_factory = None
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH)
+                if not rows:
+                    break
+                yield [row[0] for row in rows]
+    finally:
+        db.rollback()
+
+
+def export_ndjson_gz(db, level=6):
+    """export_lines gzip-compressed, in chunks of about EXPORT_CHUNK bytes."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    pending = []
+    size = 0
+    for lines in export_lines(db):
+        data = compressor.compress(("\n".join(lines) + "\n").encode())
+        pending.append(data)
+        size += len(data)
+        if size >= EXPORT_CHUNK:
+            yield b"".join(pending)
+            pending = []
+            size = 0
+    pending.append(compressor.flush())
+    yield b"".join(pending)
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=DB_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    backup_parser = commands.add_parser("backup", help="make an online backup")
+    backup_parser.add_argument("--dir", help="where to keep backups (default: backups/ next to the db)")
+    backup_parser.add_argument("--keep", type=int, default=DEFAULTS["BACKUP_KEEP"])
+    backup_parser.add_argument("--step-pages", type=int, default=DEFAULTS["BACKUP_STEP_PAGES"])
+    backup_parser.add_argument("--step-pause", type=float, default=DEFAULTS["BACKUP_STEP_PAUSE"])
+    export_parser = commands.add_parser("export", help="export spots, reviews and favorites")
+    export_parser.add_argument("--out", default="export.ndjson.gz")
+    export_parser.add_argument("--level", type=int, default=DEFAULTS["EXPORT_COMPRESS_LEVEL"])
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} not found")
+
+    if args.command == "backup":
+        config = {
+            "DATABASE": args.db,
+            "BACKUP_DIR": args.dir,
+            "BACKUP_KEEP": args.keep,
+            "BACKUP_STEP_PAGES": args.step_pages,
+            "BACKUP_STEP_PAUSE": args.step_pause,
+        }
+        start = time.perf_counter()
+        try:
+            target = backup(config)
+        except BackupRunning:
+            raise SystemExit("A backup is already running")
+        print(f"Backed up {args.db} to {target} ({os.path.getsize(target) / 1e6:.1f} MB) "
+              f"in {time.perf_counter() - start:.1f}s")
+        return
+
+    db = connect(args.db)
+    start = time.perf_counter()
+    partial = args.out + ".partial"
+    with open(partial, "wb") as f:
+        for chunk in export_ndjson_gz(db, args.level):
+            f.write(chunk)
+    os.replace(partial, args.out)
+    db.close()
+    print(f"Exported {args.db} to {args.out} ({os.path.getsize(args.out) / 1e6:.1f} MB) "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
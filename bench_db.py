@@ -0,0 +1,111 @@
+"""Compare a fresh sqlite3.connect per request with the pooled WAL connections.
+
+Usage: python bench_db.py [--threads 8] [--seconds 5] [--spots 500] [--reviews 20000]
+                          [--write-ratio 0.1]
+
+Builds a throwaway database from schema.sql, then runs the same read/write mix
+(mostly short spot lookups, some review inserts) both ways and prints
+requests per second for each.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from database import ConnectionPool
+
+READ_SQL = """
+    SELECT id, name, category, latitude, longitude, tag_bits
+    FROM spots
+    WHERE id BETWEEN ? AND ?
+"""
+WRITE_SQL = "INSERT INTO reviews (spot_id, rating, text, user_id) VALUES (?, ?, ?, ?)"
+
+
+def build_database(path, spot_count, review_count):
+    connection = sqlite3.connect(path)
+    with open("schema.sql") as f:
+        connection.executescript(f.read())
+    connection.executemany(
+        "INSERT INTO spots (name, category, latitude, longitude) VALUES (?, ?, ?, ?)",
+        [(f"Spot {i}", "Cafe", 42.37, -71.11) for i in range(spot_count)],
+    )
+    connection.executemany(
+        WRITE_SQL,
+        [(random.randint(1, spot_count), random.randint(1, 5), "ok", 1) for _ in range(review_count)],
+    )
+    connection.commit()
+    connection.close()
+
+
+def one_request(connection, spot_count, write_ratio):
+    if random.random() < write_ratio:
+        connection.execute(WRITE_SQL, (random.randint(1, spot_count), random.randint(1, 5), "bench", 1))
+        connection.commit()
+    else:
+        start = random.randint(1, spot_count)
+        connection.execute(READ_SQL, (start, start + 20)).fetchall()
+
+
+def run(label, open_connection, close_connection, args):
+    done = [0] * args.threads
+    errors = [0] * args.threads
+    stop_at = time.perf_counter() + args.seconds
+
+    def worker(index):
+        while time.perf_counter() < stop_at:
+            connection = open_connection()
+            try:
+                one_request(connection, args.spots, args.write_ratio)
+                done[index] += 1
+            except sqlite3.OperationalError:
+                errors[index] += 1
+            finally:
+                close_connection(connection)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    total = sum(done)
+    print(f"{label:<22} {total / args.seconds:10.1f} req/s   ({total} ok, {sum(errors)} errors)")
+    return total / args.seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--spots", type=int, default=500)
+    parser.add_argument("--reviews", type=int, default=20000)
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        build_database(path, args.spots, args.reviews)
+
+        # Old behaviour: connect on every request, default rollback journal
+        def fresh_connect():
+            connection = sqlite3.connect(path)
+            connection.row_factory = sqlite3.Row
+            return connection
+
+        baseline = run("fresh connect", fresh_connect, lambda c: c.close(), args)
+
+        # New behaviour: bounded pool of WAL connections with tuned pragmas
+        pool = ConnectionPool(path, size=args.threads)
+        pooled = run("pooled WAL", pool.acquire, pool.release, args)
+        pool.close()
+
+        if baseline:
+            print(f"speedup: {pooled / baseline:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Measure browsing latency while a burst of logins hashes passwords.
+
+Usage: python bench_login.py --db bench.db [--browsers 4] [--logins 16] [--seconds 10]
+
+Runs three rounds against a generate_data.py database: browsing alone, then
+browsing during a login storm with passwords hashed on the request threads
+(PASSWORD_HASH_WORKERS = 0), then the same storm with the hashing pool. Each
+round prints the browse routes' latency and what the logins got back (redirects,
+503s from a full pool, 429s from throttling). Generated users start with cheap
+hashes that their first login upgrades, so every user taking part logs in once
+before the rounds, and each round checks scrypt hashes only.
+"""
+import argparse
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+from app import app
+from bench_routes import ROUTES, Context, print_report, summarize
+from database import connect
+from generate_data import password_for
+
+# Users the login storm logs in as; each one's hash is upgraded before the rounds
+STORM_USERS = 20
+
+
+def run_round(args, users, max_spot_id, logins):
+    # Read routes only, and not the login route: logins are what the storm adds
+    browse = {name: route for name, route in ROUTES.items() if not route[1] and name != "login"}
+    names = list(browse)
+    weights = [browse[name][0] for name in names]
+    latencies = {name: [] for name in names}
+    errors = Counter()
+    login_statuses = Counter()
+    login_latencies = []
+    lock = threading.Lock()
+    ready = threading.Barrier(args.browsers + logins + 1)
+    timing = {}
+
+    def browser(index):
+        rng = random.Random(args.seed + index)
+        username, user_id = users[index % len(users)]
+        client = app.test_client()
+        client.post("/login", data={"username": username, "password": password_for(username)})
+        ctx = Context(rng, max_spot_id, user_id, [username])
+        ready.wait()
+        while time.perf_counter() < timing["stop"]:
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            response = browse[name][2](client, ctx)
+            response.get_data()
+            elapsed = time.perf_counter() - start
+            with lock:
+                if response.status_code >= 400:
+                    errors[name] += 1
+                else:
+                    latencies[name].append(elapsed)
+
+    def login_storm(index):
+        rng = random.Random(args.seed + 1000 + index)
+        client = app.test_client()
+        ready.wait()
+        while time.perf_counter() < timing["stop"]:
+            username, _ = rng.choice(users[:STORM_USERS])
+            start = time.perf_counter()
+            response = client.post("/login", data={"username": username, "password": password_for(username)})
+            elapsed = time.perf_counter() - start
+            with lock:
+                login_statuses[response.status_code] += 1
+                login_latencies.append(elapsed)
+            # Back off the way the 503/429 asks a browser to
+            if "Retry-After" in response.headers:
+                wait = min(float(response.headers["Retry-After"]), 5)
+                time.sleep(max(0, min(wait, timing["stop"] - time.perf_counter())))
+
+    threads = [threading.Thread(target=browser, args=(i,)) for i in range(args.browsers)]
+    threads += [threading.Thread(target=login_storm, args=(i,)) for i in range(logins)]
+    for t in threads:
+        t.start()
+    timing["stop"] = time.perf_counter() + args.seconds
+    ready.wait()
+    for t in threads:
+        t.join()
+
+    results = {name: summarize(latencies[name], errors[name], args.seconds) for name in names}
+    everything = [value for name in names for value in latencies[name]]
+    total = summarize(everything, sum(errors.values()), args.seconds)
+    return results, total, login_statuses, summarize(login_latencies, 0, args.seconds)
+
+
+def upgrade_hashes(users):
+    """Log every user in once, which upgrades their generated hash to the app's settings."""
+    client = app.test_client()
+    for username, _ in users:
+        client.post("/login", data={"username": username, "password": password_for(username)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="bench.db")
+    parser.add_argument("--browsers", type=int, default=4, help="threads browsing pages")
+    parser.add_argument("--logins", type=int, default=16, help="threads logging in over and over")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--hash-workers", type=int, help="PASSWORD_HASH_WORKERS for the pool round")
+    parser.add_argument("--no-cache", action="store_true", help="turn the response cache off")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} not found - create it with generate_data.py")
+
+    app.config["DATABASE"] = args.db
+    if args.no_cache:
+        app.config["RESPONSE_CACHE_SIZE"] = 0
+    # The storm logs in with the right password, so this only matters for the browsers
+    app.config["LOGIN_MAX_FAILURES_PER_IP"] = float("inf")
+    pool_workers = args.hash_workers or app.config["PASSWORD_HASH_WORKERS"]
+
+    db = connect(args.db)
+    users = db.execute(
+        "SELECT username, id FROM users WHERE username LIKE 'user%' ORDER BY id LIMIT 200"
+    ).fetchall()
+    max_spot_id = db.execute("SELECT MAX(id) FROM spots").fetchone()[0]
+    db.close()
+    if not users or not max_spot_id:
+        parser.error(f"{args.db} has no generated users or spots - run generate_data.py")
+
+    upgrade_hashes(users[:max(STORM_USERS, args.browsers)])
+
+    rounds = [
+        ("browsing alone", 0, pool_workers),
+        ("login storm, hashing on request threads", args.logins, 0),
+        (f"login storm, hashing in a pool of {pool_workers}", args.logins, pool_workers),
+    ]
+    for title, logins, hash_workers in rounds:
+        app.config["PASSWORD_HASH_WORKERS"] = hash_workers
+        print(f"\n{title}: {args.browsers} browsers, {logins} login threads, {args.seconds}s")
+        results, total, statuses, login_summary = run_round(args, users, max_spot_id, logins)
+        print_report(results, total)
+        if logins:
+            print(
+                f"logins: {login_summary['rps']}/s, p50 {login_summary['p50_ms']} ms, "
+                f"p95 {login_summary['p95_ms']} ms; statuses "
+                + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items()))
+            )
+
+
+if __name__ == "__main__":
+    main()
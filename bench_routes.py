@@ -0,0 +1,351 @@
+"""Drive every route through the Flask test client and report latency percentiles.
+
+Usage: python bench_routes.py --db bench.db [--workers 4] [--seconds 10]
+                              [--only spots_search,spot_detail] [--no-writes]
+                              [--write-behind]
+                              [--save results.json] [--compare baseline.json]
+
+Fill the database with generate_data.py first; the write routes add reviews,
+favorites and spots to it, so point this at a copy you don't mind changing.
+Each worker thread logs in as a different generated user and requests a
+weighted mix of routes until time is up; the login route logs other
+generated users in as well. The report shows requests per
+second and p50/p95/p99 latency per route. --save writes the results as JSON
+and --compare prints the change against an earlier run, exiting with status
+1 if any route's p95 got more than --threshold slower.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from datetime import datetime, timezone
+
+from app import app
+from database import connect
+from generate_data import CUISINES, HOTSPOTS, password_for
+from tags import TAG_KEYS
+
+# Generated users the login route picks from
+LOGIN_USERS = 1000
+
+
+class Context:
+    """What a worker knows about the database it is exercising."""
+
+    def __init__(self, rng, max_spot_id, user_id, usernames):
+        self.rng = rng
+        self.max_spot_id = max_spot_id
+        self.user_id = user_id
+        self.usernames = usernames  # generated users the login route can log in as
+
+    def spot_id(self):
+        return self.rng.randint(1, self.max_spot_id)
+
+    def near(self):
+        lat, lon = self.rng.choice(HOTSPOTS)
+        return lat + self.rng.uniform(-0.01, 0.01), lon + self.rng.uniform(-0.01, 0.01)
+
+
+def spots_filtered(client, ctx):
+    tags = ctx.rng.sample(TAG_KEYS, ctx.rng.randint(1, 2))
+    query = "&".join(f"{key}=1" for key in tags)
+    if ctx.rng.random() < 0.5:
+        query += f"&min_rating={ctx.rng.choice([3, 4])}"
+    return client.get(f"/spots?{query}")
+
+
+def spots_open(client, ctx):
+    if ctx.rng.random() < 0.5:
+        return client.get("/spots?open_now=1")
+    day = ctx.rng.choice(["Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"])
+    return client.get(f"/spots?open_day={day}&open_at={ctx.rng.randint(0, 23):02d}:30")
+
+
+def spots_search(client, ctx):
+    return client.get(f"/spots?q={ctx.rng.choice(CUISINES).lower()}")
+
+
+def spots_distance(client, ctx):
+    lat, lon = ctx.near()
+    return client.get(f"/spots?sort=distance&lat={lat}&lon={lon}")
+
+
+def api_nearby(client, ctx):
+    lat, lon = ctx.near()
+    return client.get(f"/api/spots/nearby?lat={lat}&lon={lon}&limit=20")
+
+
+def api_geojson(client, ctx):
+    lat, lon = ctx.near()
+    zoom = ctx.rng.randint(12, 17)
+    size = 0.5 / 2 ** (zoom - 10)
+    bbox = f"{lon - size},{lat - size / 2},{lon + size},{lat + size / 2}"
+    return client.get(f"/api/spots.geojson?bbox={bbox}&zoom={zoom}")
+
+
+def spot_reviews(client, ctx):
+    # The second page of a spot's reviews, as "Load more reviews" asks for it
+    spot_id = ctx.spot_id()
+    first = client.get(f"/api/spots/{spot_id}/reviews?limit=5").get_json() or {}
+    if not first.get("next_cursor"):
+        return client.get(f"/api/spots/{spot_id}/reviews")
+    return client.get(f"/api/spots/{spot_id}/reviews?before={first['next_cursor']}")
+
+
+def api_batch(client, ctx):
+    ids = ",".join(str(ctx.spot_id()) for _ in range(20))
+    return client.get(f"/api/spots/batch?ids={ids}")
+
+
+def login(client, ctx):
+    # Someone else logging in, on a client of their own so the worker's session
+    # stays as it is. A user's first login also upgrades their password hash
+    username = ctx.rng.choice(ctx.usernames)
+    return app.test_client().post(
+        "/login", data={"username": username, "password": password_for(username)}
+    )
+
+
+def add_review(client, ctx):
+    return client.post(
+        f"/spot/{ctx.spot_id()}/review",
+        data={"rating": str(ctx.rng.randint(1, 5)), "text": "Benchmark review, tasty."},
+    )
+
+
+def toggle_favorite(client, ctx):
+    action = ctx.rng.choice(["favorite", "unfavorite"])
+    return client.post(f"/spot/{ctx.spot_id()}/{action}")
+
+
+def add_spot(client, ctx):
+    lat, lon = ctx.near()
+    return client.post(
+        "/add-spot",
+        data={"name": "Benchmark Cafe", "category": "Cafe", "latitude": lat, "longitude": lon},
+    )
+
+
+# name -> (weight in the mix, writes?, request function)
+ROUTES = {
+    "index": (10, False, lambda client, ctx: client.get("/")),
+    "spots": (5, False, lambda client, ctx: client.get("/spots")),
+    "spots_filtered": (8, False, spots_filtered),
+    "spots_open": (4, False, spots_open),
+    "spots_search": (8, False, spots_search),
+    "spots_distance": (4, False, spots_distance),
+    "spot_detail": (20, False, lambda client, ctx: client.get(f"/spot/{ctx.spot_id()}")),
+    "my_reviews": (4, False, lambda client, ctx: client.get("/my-reviews")),
+    "favorites": (4, False, lambda client, ctx: client.get("/favorites")),
+    "api_spots": (4, False, lambda client, ctx: client.get("/api/spots?limit=50")),
+    "api_nearby": (4, False, api_nearby),
+    "api_geojson": (4, False, api_geojson),
+    "api_leaderboard": (3, False, lambda client, ctx: client.get("/api/leaderboard")),
+    "spot_reviews": (3, False, spot_reviews),
+    "api_batch": (3, False, api_batch),
+    "login": (1, False, login),
+    "add_review": (4, True, add_review),
+    "toggle_favorite": (3, True, toggle_favorite),
+    "add_spot": (1, True, add_spot),
+}
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, seconds):
+    latencies = sorted(latencies)
+    summary = {"requests": len(latencies), "errors": errors, "rps": round(len(latencies) / seconds, 1)}
+    for p in (50, 95, 99):
+        value = percentile(latencies, p)
+        summary[f"p{p}_ms"] = round(value * 1000, 3) if value is not None else None
+    return summary
+
+
+def run(routes, args, users, usernames, max_spot_id):
+    names = list(routes)
+    weights = [routes[name][0] for name in names]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    ready = threading.Barrier(args.workers + 1)
+    timing = {}
+
+    def worker(index):
+        rng = random.Random(args.seed + index)
+        username, user_id = users[index % len(users)]
+        client = app.test_client()
+        client.post("/login", data={"username": username, "password": password_for(username)})
+        ctx = Context(rng, max_spot_id, user_id, usernames)
+        mine = {name: [] for name in names}
+        my_errors = {name: 0 for name in names}
+
+        ready.wait()
+        warm_until = timing["start"] + args.warmup
+        while True:
+            now = time.perf_counter()
+            if now >= timing["stop"]:
+                break
+            name = rng.choices(names, weights)[0]
+            response = routes[name][2](client, ctx)
+            response.get_data()
+            elapsed = time.perf_counter() - now
+            if now < warm_until:
+                continue
+            if response.status_code >= 400:
+                my_errors[name] += 1
+            else:
+                mine[name].append(elapsed)
+
+        with lock:
+            for name in names:
+                latencies[name].extend(mine[name])
+                errors[name] += my_errors[name]
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.workers)]
+    for t in threads:
+        t.start()
+    timing["start"] = time.perf_counter()
+    timing["stop"] = timing["start"] + args.warmup + args.seconds
+    ready.wait()
+    for t in threads:
+        t.join()
+
+    results = {name: summarize(latencies[name], errors[name], args.seconds) for name in names}
+    everything = [value for name in names for value in latencies[name]]
+    total = summarize(everything, sum(errors.values()), args.seconds)
+    return results, total
+
+
+def print_report(results, total):
+    print(f"{'route':<18} {'req':>7} {'err':>5} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, r in [*results.items(), ("TOTAL", total)]:
+        cells = [f"{r[key]:9.2f}" if r[key] is not None else f"{'-':>9}" for key in ("p50_ms", "p95_ms", "p99_ms")]
+        print(f"{name:<18} {r['requests']:7d} {r['errors']:5d} {r['rps']:9.1f} {' '.join(cells)}")
+
+
+def compare(results, baseline, threshold):
+    """Print p50/p95 changes against a saved run; returns the routes whose p95 regressed."""
+    regressed = []
+    print(f"\nvs baseline {baseline.get('started_at')} ({baseline.get('git_commit')})")
+    print(f"{'route':<18} {'p50 ms':<18} {'p95 ms':<18} {'change':>8}")
+    for name, r in results.items():
+        old = baseline["routes"].get(name)
+        if not old or not old.get("p95_ms") or r["p95_ms"] is None:
+            continue
+        change = r["p95_ms"] / old["p95_ms"] - 1
+        flag = ""
+        if change > threshold:
+            regressed.append(name)
+            flag = "  SLOWER"
+        print(
+            f"{name:<18} {old['p50_ms']:7.2f} -> {r['p50_ms']:<7.2f} "
+            f"{old['p95_ms']:7.2f} -> {r['p95_ms']:<7.2f} {change:+8.0%}{flag}"
+        )
+    return regressed
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="bench.db")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=1, help="seconds of requests not counted")
+    parser.add_argument("--only", help="comma-separated route names to run (default: all)")
+    parser.add_argument("--no-writes", action="store_true", help="skip the POST routes")
+    parser.add_argument("--no-cache", action="store_true", help="turn the response cache off")
+    parser.add_argument("--no-metrics", action="store_true", help="turn request/SQL metrics off")
+    parser.add_argument("--write-behind", action="store_true",
+                        help="commit reviews and favorites through the group-commit thread")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier --save to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="p95 slowdown that counts as a regression (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} not found - create it with generate_data.py")
+
+    routes = dict(ROUTES)
+    if args.only:
+        unknown = set(args.only.split(",")) - set(routes)
+        if unknown:
+            parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+        routes = {name: routes[name] for name in args.only.split(",")}
+    if args.no_writes:
+        routes = {name: route for name, route in routes.items() if not route[1]}
+
+    app.config["DATABASE"] = args.db
+    if args.no_cache:
+        app.config["RESPONSE_CACHE_SIZE"] = 0
+    if args.no_metrics:
+        app.config["METRICS_ENABLED"] = False
+    if args.write_behind:
+        app.config["WRITE_BEHIND"] = True
+
+    db = connect(args.db)
+    users = db.execute(
+        "SELECT username, id FROM users WHERE username LIKE 'user%' ORDER BY id LIMIT ?",
+        (args.workers,),
+    ).fetchall()
+    usernames = [
+        row[0] for row in db.execute(
+            "SELECT username FROM users WHERE username LIKE 'user%' ORDER BY id LIMIT ?",
+            (LOGIN_USERS,),
+        )
+    ]
+    max_spot_id = db.execute("SELECT MAX(id) FROM spots").fetchone()[0]
+    counts = {
+        table: db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ["users", "spots", "reviews", "favorites"]
+    }
+    db.close()
+    if not users or not max_spot_id:
+        parser.error(f"{args.db} has no generated users or spots - run generate_data.py")
+
+    print(f"{args.workers} workers for {args.seconds}s on {args.db}: "
+          + ", ".join(f"{count} {table}" for table, count in counts.items()))
+    results, total = run(routes, args, [tuple(row) for row in users], usernames, max_spot_id)
+    print_report(results, total)
+
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "config": vars(args),
+        "database": counts,
+        "total": total,
+        "routes": results,
+    }
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(results, json.load(f), args.threshold)
+        if regressed:
+            print(f"Regressed: {', '.join(regressed)}")
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
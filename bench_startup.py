@@ -0,0 +1,177 @@
+"""Measure how long a newly started worker takes to answer its first requests.
+
+Usage: python bench_startup.py --db bench.db [--runs 5] [--modes cold,cached,warm]
+                               [--budget-ms 800]
+
+Every run is a fresh Python process, as a recycled worker is: it imports the
+app, signs a generated user in by setting the session (so no password is
+hashed) and requests each of a few pages once through the Flask test client. It reports how long the import took, each page's first
+response, the time from the start of the process to the last of them, and the
+worker's peak memory. The modes are:
+
+  cold    an empty template bytecode cache and no warm-up
+  cached  the bytecode cache filled by an earlier run (the usual case after a deploy)
+  warm    cached, plus startup.warm_up(app) before the first request, as the WSGI file does
+
+The medians of each mode are printed. --budget-ms exits with status 1 if any
+mode's median time to the last first response is over the budget, so a change
+that makes workers start slower fails the check.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# The pages a visitor usually opens first
+PATHS = ["/", "/spots", "/spot/{spot_id}", "/favorites"]
+
+MODES = ["cold", "cached", "warm"]
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def child(args):
+    """One worker's start: runs in its own process and prints its timings as JSON."""
+    started = time.perf_counter()
+    from app import app
+    imported = time.perf_counter()
+
+    from database import connect
+
+    app.config["DATABASE"] = args.db
+    app.config["STARTUP_WARM_UP"] = False
+    # Pages only; starting the hashing processes is timed by the warm-up
+    app.config["PASSWORD_HASH_WORKERS"] = 0
+    # The app has set up its cache already, so point it at this run's directory
+    from jinja2 import FileSystemBytecodeCache
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(args.template_cache)
+
+    db = connect(args.db)
+    username, user_id = db.execute(
+        "SELECT username, id FROM users WHERE username LIKE 'user%' ORDER BY id LIMIT 1"
+    ).fetchone()
+    # The best rated spot, the one most visitors open
+    spot_id = db.execute(
+        "SELECT spot_id FROM leaderboard WHERE board = 'all' ORDER BY score DESC, spot_id LIMIT 1"
+    ).fetchone()
+    db.close()
+
+    warm_up_seconds = None
+    if args.mode == "warm":
+        from startup import warm_up
+        start = time.perf_counter()
+        warm_up(app)
+        warm_up_seconds = time.perf_counter() - start
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+        session["username"] = username
+
+    first = {}
+    for path in PATHS:
+        url = path.format(spot_id=spot_id[0] if spot_id else 1)
+        start = time.perf_counter()
+        response = client.get(url)
+        first[path] = time.perf_counter() - start
+        if response.status_code != 200:
+            raise SystemExit(f"{url} returned {response.status_code}")
+
+    print(json.dumps({
+        "import": imported - started,
+        "warm_up": warm_up_seconds,
+        "first": first,
+        "total": time.perf_counter() - started,
+        "rss_mb": peak_rss_mb(),
+    }))
+
+
+def run_child(db, mode, template_cache):
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", "--db", db,
+         "--mode", mode, "--template-cache", template_cache],
+        capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise SystemExit(f"A {mode} run failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def median_ms(values):
+    values = [value for value in values if value is not None]
+    return round(statistics.median(values) * 1000, 1) if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="bench.db")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per mode")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--budget-ms", type=float,
+                        help="fail if a mode's median time to the last first response is over this")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--template-cache", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} not found - create it with generate_data.py")
+    modes = args.modes.split(",")
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(sorted(unknown))}")
+
+    over_budget = []
+    print(f"{'mode':<8} {'import':>8} {'warm-up':>8} " + " ".join(f"{p:>16}" for p in PATHS)
+          + f" {'total':>8} {'peak RSS':>9}")
+    for mode in modes:
+        template_cache = tempfile.mkdtemp(prefix="jinja-cache-")
+        try:
+            if mode != "cold":
+                run_child(args.db, "cached", template_cache)  # fills the cache
+            results = []
+            for _ in range(args.runs):
+                if mode == "cold":
+                    shutil.rmtree(template_cache)
+                    os.makedirs(template_cache)
+                results.append(run_child(args.db, mode, template_cache))
+        finally:
+            shutil.rmtree(template_cache, ignore_errors=True)
+
+        total = median_ms([r["total"] for r in results])
+        rss = [r["rss_mb"] for r in results if r["rss_mb"] is not None]
+        warm_up = median_ms([r["warm_up"] for r in results])
+        print(
+            f"{mode:<8} {median_ms([r['import'] for r in results]):>6}ms "
+            f"{(str(warm_up) + 'ms') if warm_up is not None else '-':>8} "
+            + " ".join(f"{median_ms([r['first'][p] for r in results]):>14}ms" for p in PATHS)
+            + f" {total:>6}ms "
+            + (f"{statistics.median(rss):>6.1f} MB" if rss else f"{'-':>9}")
+        )
+        if args.budget_ms is not None and total > args.budget_ms:
+            over_budget.append(mode)
+
+    if over_budget:
+        print(f"Over the {args.budget_ms:g}ms budget: {', '.join(over_budget)}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
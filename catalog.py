@@ -0,0 +1,449 @@
+"""Build the read-only spot catalog snapshot that every worker memory-maps.
+
+Usage: python catalog.py [--db spots.db] [--path spots.db-catalog]
+
+The app rebuilds the snapshot by itself in a background thread whenever a spot
+changes; this script builds it by hand, e.g. before starting the workers so
+their first requests already find it. Rating changes don't need a new file:
+each worker reads the spots whose ratings changed since the snapshot from the
+spot change log and lays them over it, until there are enough of them (or
+they are old enough) to be worth a rebuild.
+
+The file holds one column per field, as packed arrays in spot id order (ids,
+coordinates, tag bits, rating stats), plus a string table in which each
+distinct name and category is stored once. Workers map it read-only, so the
+pages are shared between them by the OS instead of every process holding its
+own copy, and reading a column is slicing a memoryview rather than running SQL.
+Two extra columns hold the spots in name order and in leaderboard order, for
+the unsearched /spots list and the home page. A new snapshot is written to a
+temporary file and renamed over the old one, so a worker never maps half a file.
+"""
+import bisect
+import heapq
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+from flask import current_app
+
+from changes import last_seq
+from database import connect, data_version
+
+try:
+    import fcntl
+except ImportError:  # Windows: no file locks, so workers may each build the snapshot
+    fcntl = None
+
+DB_PATH = "spots.db"
+
+DEFAULTS = {
+    "CATALOG_ENABLED": True,   # serve spot lists from the memory-mapped snapshot
+    "CATALOG_PATH": None,      # default: next to the database, as <DATABASE>-catalog
+    "CATALOG_MAX_CHANGES": 5000,  # rebuild once this many spots' ratings changed since the snapshot
+    "CATALOG_MAX_AGE": 300,       # ...or once its ratings are this many seconds out of date
+}
+
+MAGIC = b"HEATCAT1"
+HEADER = struct.Struct("<8sQ")  # magic, length of the JSON that follows
+ALIGN = 8
+
+# Ratings of the spots changed after seq ?, with their score on the "all" board
+CHANGED_RATINGS_SQL = """
+    SELECT
+        spot_changes.spot_id, spot_stats.avg_rating,
+        COALESCE(spot_stats.rating_count, 0), leaderboard.score
+    FROM spot_changes
+    LEFT JOIN spot_stats ON spot_stats.spot_id = spot_changes.spot_id
+    LEFT JOIN leaderboard ON leaderboard.spot_id = spot_changes.spot_id AND leaderboard.board = 'all'
+    WHERE spot_changes.seq > ?
+"""
+
+
+class CatalogError(Exception):
+    pass
+
+
+def catalog_path(config):
+    return config.get("CATALOG_PATH") or config["DATABASE"] + "-catalog"
+
+
+def build(db, path):
+    """Write a snapshot of the spots table to path; returns its version stamp."""
+    # One read transaction, so the stamp matches the rows
+    db.execute("BEGIN")
+    try:
+        version = data_version(db, "spots", "ratings")
+        changes_seq = last_seq(db)
+        # Scores come from the leaderboard, which keeps the one score formula
+        rows = db.execute(
+            """
+            SELECT
+                spots.id, spots.name, spots.category, spots.latitude, spots.longitude,
+                spots.tag_bits, spot_stats.avg_rating,
+                COALESCE(spot_stats.rating_count, 0), leaderboard.score
+            FROM spots
+            LEFT JOIN spot_stats ON spot_stats.spot_id = spots.id
+            LEFT JOIN leaderboard ON leaderboard.spot_id = spots.id AND leaderboard.board = 'all'
+            ORDER BY spots.id
+            """
+        ).fetchall()
+    finally:
+        db.rollback()
+
+    strings = {}
+    nan = float("nan")
+
+    def intern(text):
+        if text is None:
+            return -1
+        return strings.setdefault(text, len(strings))
+
+    columns = {
+        "id": array("q", (row[0] for row in rows)),
+        "name": array("i", (intern(row[1]) for row in rows)),
+        "category": array("i", (intern(row[2]) for row in rows)),
+        "latitude": array("d", (nan if row[3] is None else row[3] for row in rows)),
+        "longitude": array("d", (nan if row[4] is None else row[4] for row in rows)),
+        "tag_bits": array("q", (row[5] or 0 for row in rows)),
+        "avg_rating": array("d", (nan if row[6] is None else row[6] for row in rows)),
+        "rating_count": array("q", (row[7] for row in rows)),
+    }
+
+    # Name order matches SQLite's ORDER BY name, id (BINARY collation = code point order)
+    by_name = sorted(range(len(rows)), key=lambda i: (rows[i][1], rows[i][0]))
+    name_rank = array("i", bytes(4 * len(rows)))
+    for rank, position in enumerate(by_name):
+        name_rank[position] = rank
+    columns["by_name"] = array("i", by_name)
+    columns["name_rank"] = name_rank
+
+    # Reviewed spots by leaderboard score, best first, then by id as the leaderboard does
+    scores = {i: row[8] for i, row in enumerate(rows) if row[8] is not None}
+    columns["score"] = array("d", (scores.get(i, nan) for i in range(len(rows))))
+    columns["by_score"] = array("i", sorted(scores, key=lambda i: (-scores[i], rows[i][0])))
+
+    encoded = [text.encode() for text in strings]
+    offsets = array("q", [0])
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    columns["string_offsets"] = offsets
+    columns["string_data"] = array("B", b"".join(encoded))
+
+    # The header JSON says where each column starts, counting from the end of the
+    # (padded) header; columns are 8-byte aligned
+    layout = {}
+    offset = 0
+    for name, values in columns.items():
+        layout[name] = [offset, values.typecode, len(values)]
+        offset += -(-len(values) * values.itemsize // ALIGN) * ALIGN
+    header = json.dumps({
+        "version": version,
+        "changes_seq": changes_seq,
+        "count": len(rows),
+        "columns": layout,
+    }).encode()
+    header = header.ljust(-(-(HEADER.size + len(header)) // ALIGN) * ALIGN - HEADER.size)
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(header)))
+        f.write(header)
+        for values in columns.values():
+            data = values.tobytes()
+            f.write(data)
+            f.write(bytes(-len(data) % ALIGN))
+    os.replace(temporary, path)
+    return version
+
+
+class Catalog:
+    """A snapshot file mapped read-only, with each column as a typed memoryview.
+
+    changed maps the position of every spot whose rating changed since the
+    snapshot to its current (avg_rating, rating_count, score), NaN for none;
+    those take precedence over the columns.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise CatalogError(f"{path} is not a spot catalog")
+        header = json.loads(self._map[HEADER.size:HEADER.size + length])
+        self.version = tuple(header["version"])
+        self.changes_seq = header["changes_seq"]
+        self.size = header["count"]
+        self.ratings_version = self.version[1]
+        self.ratings_stale_since = None
+        self.changed = {}
+        view = memoryview(self._map)[HEADER.size + length:]
+        for name, (offset, typecode, count) in header["columns"].items():
+            itemsize = array(typecode).itemsize
+            setattr(self, name, view[offset:offset + count * itemsize].cast(typecode))
+
+    def string(self, ref):
+        if ref < 0:
+            return None
+        return bytes(self.string_data[self.string_offsets[ref]:self.string_offsets[ref + 1]]).decode()
+
+    def apply_ratings(self, db, ratings_version):
+        """Bring the changed ratings up to date from the spot change log."""
+        changes_seq = last_seq(db)
+        rows = db.execute(CHANGED_RATINGS_SQL, (self.changes_seq,)).fetchall()
+        nan = float("nan")
+        # Readers keep using the old dict until the new one is complete
+        changed = dict(self.changed)
+        for spot_id, avg_rating, rating_count, score in rows:
+            position = self.position(spot_id)
+            if position is None:
+                continue  # a new spot, which makes the whole snapshot stale anyway
+            changed[position] = (
+                nan if avg_rating is None else avg_rating,
+                rating_count,
+                nan if score is None else score,
+            )
+        self.changed = changed
+        self.changes_seq = changes_seq
+        self.ratings_version = ratings_version
+        if self.ratings_stale_since is None:
+            self.ratings_stale_since = time.monotonic()
+
+    def worth_rebuilding(self, config):
+        """Whether enough ratings changed since the snapshot to write a new one."""
+        if self.ratings_stale_since is None:
+            return False
+        return (len(self.changed) > config["CATALOG_MAX_CHANGES"]
+                or time.monotonic() - self.ratings_stale_since > config["CATALOG_MAX_AGE"])
+
+    def position(self, spot_id):
+        """Where spot_id is in the columns, or None if it isn't in the snapshot."""
+        i = bisect.bisect_left(self.id, spot_id)
+        return i if i < self.size and self.id[i] == spot_id else None
+
+    def row(self, position):
+        """The same fields spot_query's SQL selects, for one spot."""
+
+        def number(value):
+            return None if math.isnan(value) else value
+
+        name = self.string(self.name[position])
+        avg_rating, rating_count, _ = self.changed.get(position) or (
+            self.avg_rating[position], self.rating_count[position], None
+        )
+        return {
+            "id": self.id[position],
+            "name": name,
+            "category": self.string(self.category[position]),
+            "latitude": number(self.latitude[position]),
+            "longitude": number(self.longitude[position]),
+            "tag_bits": self.tag_bits[position],
+            "avg_rating": number(avg_rating),
+            "review_count": rating_count,
+            "distance": None,
+            "rank": None,
+            "snippet": None,
+            "sort_key": name,
+        }
+
+    def _name_rank_after(self, name, spot_id):
+        """First name-order rank that sorts strictly after (name, spot_id)."""
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            position = self.by_name[middle]
+            if (self.string(self.name[position]), self.id[position]) <= (name, spot_id):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def page_by_name(self, limit, after=None, spot_ids=None):
+        """Up to limit rows in name order, starting after the (name, id) cursor key.
+
+        spot_ids, if given, is the set of ids that passed the filters (from
+        tag_index.py). A large set is checked while walking the name order; a
+        small one is looked up and sorted directly, which is cheaper than
+        walking past thousands of spots that don't match.
+        """
+        first = self._name_rank_after(*after) if after else 0
+        if spot_ids is None:
+            ranks = range(first, min(first + limit, self.size))
+        elif len(spot_ids) * 8 >= self.size:
+            ranks = []
+            for rank in range(first, self.size):
+                if self.id[self.by_name[rank]] in spot_ids:
+                    ranks.append(rank)
+                    if len(ranks) == limit:
+                        break
+        else:
+            positions = (self.position(spot_id) for spot_id in spot_ids)
+            ranks = heapq.nsmallest(limit, (
+                rank for rank in (self.name_rank[p] for p in positions if p is not None)
+                if rank >= first
+            ))
+        return [self.row(self.by_name[rank]) for rank in ranks]
+
+    def top_rated(self, limit):
+        """The leaderboard's "all" board from the snapshot, best first."""
+        changed = self.changed
+        # The best unchanged spots in snapshot order, merged with the changed ones
+        entries = [
+            (-score, self.id[position], position)
+            for position, (_, _, score) in changed.items() if not math.isnan(score)
+        ]
+        unchanged = 0
+        for position in self.by_score:
+            if unchanged == limit:
+                break
+            if position not in changed:
+                entries.append((-self.score[position], self.id[position], position))
+                unchanged += 1
+        rows = []
+        for score, _, position in heapq.nsmallest(limit, entries):
+            row = self.row(position)
+            row["score"] = -score
+            rows.append(row)
+        return rows
+
+
+class Builder:
+    """Background thread that rebuilds the snapshot file when it is out of date."""
+
+    def __init__(self, db_path, path, config, logger):
+        self.db_path = db_path
+        self.path = path
+        self.config = config
+        self.logger = logger
+        self.pid = os.getpid()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="catalog", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        db = connect(self.db_path, self.config)
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self._build_if_stale(db)
+            except Exception:
+                self.logger.exception("Building the spot catalog failed")
+
+    def _build_if_stale(self, db):
+        with open(self.path + ".lock", "a") as lock:
+            # One worker builds while the others wait, then find it already fresh
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            header = _file_header(self.path)
+            if header is not None and tuple(header["version"]) == data_version(db, "spots", "ratings"):
+                return
+            start = time.perf_counter()
+            build(db, self.path)
+            self.logger.info("Built the spot catalog in %.2fs", time.perf_counter() - start)
+
+
+def _file_header(path):
+    try:
+        with open(path, "rb") as f:
+            magic, length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                return None
+            return json.loads(f.read(length))
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+_catalogs = {}
+_builders = {}
+_lock = threading.Lock()
+
+
+def _builder(app):
+    builder = _builders.get(app)
+    if builder is None or builder.pid != os.getpid():
+        builder = Builder(app.config["DATABASE"], catalog_path(app.config), app.config, app.logger)
+        _builders[app] = builder
+    return builder
+
+
+def get_catalog(db):
+    """This worker's mapped snapshot, or None if it is missing or out of date.
+
+    A spot change bumps the spots data version, which makes the mapped
+    snapshot stale. The caller then falls back to SQL while a background
+    thread writes a new file; the next request maps that one instead. A
+    rating change only brings the snapshot's changed ratings up to date, and
+    wakes the builder once there are many of them or they have waited long.
+    """
+    app = current_app._get_current_object()
+    if not app.config["CATALOG_ENABLED"]:
+        return None
+    version = data_version(db, "spots", "ratings")
+    catalog = _catalogs.get(app)
+    if (catalog is not None and (catalog.version[0], catalog.ratings_version) == version
+            and not catalog.worth_rebuilding(app.config)):
+        return catalog
+
+    with _lock:
+        catalog = _catalogs.get(app)
+        if catalog is not None and catalog.version[0] != version[0]:
+            catalog = None
+        if catalog is not None:
+            if catalog.ratings_version != version[1]:
+                catalog.apply_ratings(db, version[1])
+            if not catalog.worth_rebuilding(app.config):
+                return catalog
+        # Another worker (or this one's builder) may have written a newer file
+        path = catalog_path(app.config)
+        header = _file_header(path)
+        if (header is not None and header["version"][0] == version[0]
+                and (catalog is None or tuple(header["version"]) != catalog.version)):
+            try:
+                fresh = Catalog(path)
+            except (OSError, ValueError, CatalogError):
+                fresh = None
+            if fresh is not None and fresh.version[0] == version[0]:
+                if fresh.ratings_version != version[1]:
+                    fresh.apply_ratings(db, version[1])
+                # The old mapping is closed when the last request using it is done
+                _catalogs[app] = catalog = fresh
+                if not catalog.worth_rebuilding(app.config):
+                    return catalog
+        _builder(app).wake()
+    return catalog
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--path", help="where to write it (default: <db>-catalog)")
+    args = parser.parse_args()
+
+    path = args.path or args.db + "-catalog"
+    db = connect(args.db)
+    start = time.perf_counter()
+    build(db, path)
+    db.close()
+    catalog = Catalog(path)
+    print(f"Wrote {catalog.size} spots to {path} ({os.path.getsize(path) / 1e6:.1f} MB) "
+          f"in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""The spot change log behind /api/changes (see CHANGE LOG in schema.sql).
+
+Browsers keep a copy of every spot in IndexedDB (static/spot_sync.js) and ask
+for the changes since the last cursor they saw, so a repeat visit downloads
+the few spots that changed instead of the whole list. Cursor 0 returns every
+spot; the first sync is the full download.
+"""
+from flask import current_app
+
+DEFAULTS = {
+    "CHANGES_PAGE_SIZE": 2000,       # changes per /api/changes response
+    "CHANGES_TOMBSTONE_DAYS": 30,    # how long deletions stay in the log
+}
+
+MAX_PAGE_SIZE = 10000
+
+CHANGES_SQL = """
+    SELECT
+        spot_changes.seq,
+        spot_changes.spot_id,
+        spot_changes.deleted,
+        spots.name,
+        spots.category,
+        spots.latitude,
+        spots.longitude,
+        spots.tag_bits,
+        spot_stats.avg_rating,
+        COALESCE(spot_stats.rating_count, 0) AS review_count
+    FROM spot_changes
+    LEFT JOIN spots ON spots.id = spot_changes.spot_id
+    LEFT JOIN spot_stats ON spot_stats.spot_id = spot_changes.spot_id
+    WHERE spot_changes.seq > ?
+    ORDER BY spot_changes.seq
+    LIMIT ?
+"""
+
+
+def change_json(row):
+    if row["deleted"]:
+        return {"id": row["spot_id"], "deleted": True}
+    return {
+        "id": row["spot_id"],
+        "name": row["name"],
+        "category": row["category"],
+        "latitude": row["latitude"],
+        "longitude": row["longitude"],
+        "tag_bits": row["tag_bits"],
+        "avg_rating": row["avg_rating"],
+        "review_count": row["review_count"],
+    }
+
+
+def last_seq(db):
+    """The newest seq ever handed out, including changes since replaced or pruned."""
+    return db.execute(
+        "SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'spot_changes'"
+    ).fetchone()[0]
+
+
+def changes_since(db, since, limit):
+    """Changes after cursor `since`, oldest first, as the /api/changes body.
+
+    "reset" is true when the client must drop its copy and apply these
+    changes to an empty one: its cursor is older than pruned tombstones, or
+    newer than anything in the log (the database was restored from a backup).
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    # One read transaction, so pruning can't happen between the check and the page
+    db.execute("BEGIN")
+    try:
+        floor = db.execute("SELECT seq FROM spot_changes_floor").fetchone()[0]
+        last = last_seq(db)
+        reset = since != 0 and (since < floor or since > last)
+        if reset:
+            since = 0
+        rows = db.execute(CHANGES_SQL, (since, limit)).fetchall()
+    finally:
+        db.rollback()
+
+    return {
+        "changes": [change_json(row) for row in rows],
+        "cursor": rows[-1]["seq"] if rows else since,
+        "more": len(rows) == limit,
+        "reset": reset,
+    }
+
+
+def compact_changes(db, days=None):
+    """Prune tombstones older than CHANGES_TOMBSTONE_DAYS, in the caller's transaction.
+
+    Clients that last synced before the newest pruned one are told to start
+    over, since they may not have seen that deletion.
+    """
+    if days is None:
+        days = current_app.config["CHANGES_TOMBSTONE_DAYS"]
+    newest = db.execute(
+        """
+        SELECT MAX(seq) FROM spot_changes
+        WHERE deleted AND changed_at < datetime('now', ?)
+        """,
+        (f"-{days} days",),
+    ).fetchone()[0]
+    if newest is None:
+        return 0
+    cursor = db.execute("DELETE FROM spot_changes WHERE deleted AND seq <= ?", (newest,))
+    db.execute("UPDATE spot_changes_floor SET seq = MAX(seq, ?)", (newest,))
+    return cursor.rowcount
+
+
+def rebuild_changes(db):
+    """Restart the log with one row per current spot; every client starts over."""
+    db.execute("DELETE FROM spot_changes")
+    db.execute("INSERT INTO spot_changes (spot_id) SELECT id FROM spots ORDER BY id")
+    db.execute(
+        """
+        UPDATE spot_changes_floor SET seq = (
+            SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'spot_changes'
+        )
+        """
+    )
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
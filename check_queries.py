@@ -0,0 +1,204 @@
+"""Check the query plan of every SQL statement the app runs for full table scans.
+
+Usage: python check_queries.py [--db copy.db] [--fail-on reviews,favorites]
+
+Builds a small database with migrate.py and generate_data.py (or uses --db),
+drives every route from bench_routes.py through the Flask test client while
+recording each statement, and runs EXPLAIN QUERY PLAN on all of them plus the
+statements inside every trigger. Any SCAN of a --fail-on table (reviews by
+default) fails the check with exit status 1; scans of other tables are
+listed as warnings. Each scan comes with an index suggestion built from the
+columns the statement filters and sorts that table on. A few statements must
+never scan certain tables whatever --fail-on says (MUST_NOT_SCAN), and must
+show up among the ones the routes run, so they can't quietly stop being checked.
+"""
+import argparse
+import os
+import random
+import re
+import sqlite3
+import tempfile
+
+from app import app
+from bench_routes import ROUTES, Context
+from database import connect
+from derived_tags import create_lookup_tables
+from generate_data import (
+    generate_favorites, generate_reviews, generate_spots, generate_users, password_for,
+)
+from metrics import InstrumentedConnection, normalize_sql
+from migrate import migrate, sql_statements
+
+ROUNDS = 8  # times each route is requested, so the filter/sort variants all show up
+
+# Pages that bench_routes.py doesn't time but that still run queries
+EXTRA_PAGES = ["/add-spot", "/spot/1/edit", "/login", "/register"]
+
+# Fixed lookup tables of a few rows, where a scan is the cheapest plan
+SMALL_TABLES = {"cluster_zooms", "tag_bit_numbers"}
+
+# Statements that fail the check if they scan the table, and what they are
+MUST_NOT_SCAN = [
+    # Distance-sorted /spots pages find spots through spots_rtree
+    ("distance-sorted spot page", re.compile(r"\A(?=.*\bsort_key\b)(?=.*\bdistance_km\(spots\.latitude)", re.DOTALL),
+     "spots"),
+]
+
+SCAN_RE = re.compile(r"\bSCAN (\w+)( USING)?")
+TRIGGER_BODY_RE = re.compile(r"\bBEGIN\b(.*)\bEND\s*;?\s*$", re.IGNORECASE | re.DOTALL)
+NEW_OLD_RE = re.compile(r"\b(?:NEW|OLD)\.\w+", re.IGNORECASE)
+
+
+def build_database(path):
+    db = connect(path)
+    migrate(db)
+    random.seed(1)
+    with db:
+        user_ids = generate_users(db, 20, 1)
+        spot_ids = generate_spots(db, 500)
+        generate_reviews(db, 5000, user_ids, spot_ids)
+        generate_favorites(db, 5, user_ids, spot_ids)
+    db.close()
+
+
+def record_app_queries(path):
+    """Every distinct statement (with the parameters of its first use) the routes run."""
+    captured = []
+    app.config["DATABASE"] = path
+    app.config["RESPONSE_CACHE_SIZE"] = 0
+    # Warming up runs the same queries on a connection the check doesn't see
+    app.config["STARTUP_WARM_UP"] = False
+    app.extensions["wrap_db"] = lambda connection: InstrumentedConnection(connection, captured)
+
+    db = connect(path)
+    username, user_id = db.execute(
+        "SELECT username, id FROM users WHERE is_admin = 1 ORDER BY id LIMIT 1"
+    ).fetchone()
+    max_spot_id = db.execute("SELECT MAX(id) FROM spots").fetchone()[0]
+    db.close()
+
+    client = app.test_client()
+    client.post("/login", data={"username": username, "password": password_for(username)})
+    ctx = Context(random.Random(1), max_spot_id, user_id, [username])
+    for name, (_, _, request) in ROUTES.items():
+        for _ in range(ROUNDS):
+            request(client, ctx).get_data()
+    for page in EXTRA_PAGES:
+        client.get(page).get_data()
+
+    statements = {}
+    for record in captured:
+        if record.parameters is not None:
+            statements.setdefault(record.sql, record.parameters)
+    return statements
+
+
+def trigger_statements(db):
+    """The statements inside every trigger, with NEW./OLD. values as parameters."""
+    statements = {}
+    for name, sql in db.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'"):
+        body = TRIGGER_BODY_RE.search(sql)
+        if not body:
+            continue
+        for statement in sql_statements(body.group(1)):
+            text = NEW_OLD_RE.sub("?", statement.strip().rstrip(";"))
+            statements[text] = (None,) * text.count("?")
+    return statements
+
+
+def scanned_tables(db, sql, parameters, tables):
+    """Real tables the statement reads in full, and its whole plan.
+
+    Returns (table, walks an index) pairs. Scans of virtual tables (search,
+    json_each), subqueries and SMALL_TABLES don't count.
+    """
+    plan = [row[3] for row in db.execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+    scanned = []
+    for detail in plan:
+        match = SCAN_RE.search(detail)
+        if match and match.group(1) in tables and match.group(1) not in SMALL_TABLES:
+            scanned.append((match.group(1), bool(match.group(2))))
+    return scanned, plan
+
+
+def suggest_index(db, table, sql):
+    """Columns of table the statement compares to a value (then sorts by): an index to try."""
+    # The INTEGER PRIMARY KEY is the rowid, which every index already ends with
+    columns = [row[1] for row in db.execute(f"PRAGMA table_info({table})") if not row[5]]
+    names = "|".join(re.escape(column) for column in columns)
+    equal = re.findall(rf"\b({names})\s*(?:=\s*\?|IN\s*\()", sql, re.IGNORECASE)
+    order = re.findall(rf"ORDER BY\s+(?:\w+\.)?({names})\b", sql, re.IGNORECASE)
+    suggestion = list(dict.fromkeys([*equal, *order]))
+    if not suggestion:
+        return None
+    return f"CREATE INDEX ON {table} ({', '.join(suggestion)})"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="check against a copy of this database instead of a generated one")
+    parser.add_argument("--fail-on", default="reviews", help="comma-separated tables that must never be scanned")
+    args = parser.parse_args()
+    fail_on = set(args.fail_on.split(","))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "check.db")
+        if args.db:
+            # The routes write, so work on a copy
+            source, copy = sqlite3.connect(args.db), sqlite3.connect(path)
+            source.backup(copy)
+            source.close()
+            copy.close()
+        else:
+            build_database(path)
+
+        statements = record_app_queries(path)
+        db = connect(path)
+        # derive_tags reads TEMP tables of its own connection; plan it against empty ones
+        create_lookup_tables(db)
+        from_triggers = trigger_statements(db)
+        tables = {row[0] for row in db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND sql NOT LIKE 'CREATE VIRTUAL%'"
+        )}
+        print(f"Checking {len(statements)} app queries and {len(from_triggers)} trigger statements")
+
+        failures = warnings = 0
+        seen = set()
+        checked = set()
+        for sql, parameters in [*statements.items(), *from_triggers.items()]:
+            text, fingerprint = normalize_sql(sql)
+            if fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+            must_not_scan = set()
+            for name, pattern, table in MUST_NOT_SCAN:
+                if pattern.search(sql):
+                    checked.add(name)
+                    must_not_scan.add(table)
+            scanned, plan = scanned_tables(db, sql, parameters, tables)
+            for table, uses_index in dict.fromkeys(scanned):
+                failed = table in fail_on or table in must_not_scan
+                failures += failed
+                warnings += not failed
+                print(f"\n{'FAIL' if failed else 'warn'}: full scan of {table}")
+                print(f"  {text}")
+                for line in plan:
+                    print(f"    {line}")
+                # A scan that already walks an index in order is how a LIMIT-ed list is read
+                suggestion = None if uses_index else suggest_index(db, table, sql)
+                if suggestion:
+                    print(f"  try: {suggestion}")
+        db.close()
+
+        for name, _, _ in MUST_NOT_SCAN:
+            if name not in checked:
+                failures += 1
+                print(f"\nFAIL: no {name} statement was run, so it wasn't checked")
+
+    print(f"\n{failures} failure(s), {warnings} warning(s)")
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import json
+
+from geo import SPOT_COLUMNS, spots_in_box
+
+# Highest zoom level with precomputed clusters (see cluster_zooms in schema.sql).
+# Past it the map is zoomed in far enough to show every spot individually.
+MAX_CLUSTER_ZOOM = 16
+
+# Most individual spots returned for one viewport when zoomed past MAX_CLUSTER_ZOOM
+MAX_POINTS = 5000
+
+
+def spot_feature(row):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [row["longitude"], row["latitude"]]},
+        "properties": {
+            "id": row["id"],
+            "name": row["name"],
+            "category": row["category"],
+            "avg_rating": row["avg_rating"],
+            "review_count": row["review_count"],
+        },
+    }
+
+
+def cluster_feature(count, lat, lon):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [lon, lat]},
+        "properties": {"cluster": True, "point_count": count},
+    }
+
+
+def map_features(db, zoom, min_lat, max_lat, min_lon, max_lon):
+    """Yield GeoJSON features for one map viewport, one at a time.
+
+    Up to MAX_CLUSTER_ZOOM this reads the precomputed spot_clusters cells that
+    overlap the box, so the work depends on the number of cells on screen, not
+    the number of spots. A cell holding a single spot is sent as that spot.
+    """
+    # Zoomed-out maps can report boxes past the edge of the world
+    min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+    min_lon, max_lon = max(min_lon, -180.0), min(max_lon, 180.0)
+
+    if zoom > MAX_CLUSTER_ZOOM:
+        for row in spots_in_box(db, min_lat, max_lat, min_lon, max_lon, MAX_POINTS):
+            yield spot_feature(row)
+        return
+
+    cells_per_degree = db.execute(
+        "SELECT cells_per_degree FROM cluster_zooms WHERE zoom = ?", (zoom,)
+    ).fetchone()["cells_per_degree"]
+
+    # Each cell that holds a single spot comes with that spot, looked up in the
+    # R*Tree by the cell's bounds inside the same query. The R*Tree keeps its
+    # boxes as float32 rounded outward, so a spot just across the cell's edge
+    # can match too; the exact cell test, worked out as the triggers and
+    # rebuild_clusters do, keeps only the cell's own spot.
+    cells = db.execute(
+        f"""
+        SELECT spot_clusters.spot_count, spot_clusters.lat_sum, spot_clusters.lon_sum, {SPOT_COLUMNS}
+        FROM spot_clusters
+        LEFT JOIN spots ON spots.id = CASE WHEN spot_clusters.spot_count = 1 THEN (
+            SELECT spots_rtree.id
+            FROM spots_rtree
+            JOIN spots AS cell_spots ON cell_spots.id = spots_rtree.id
+            WHERE spots_rtree.min_lat <= spot_clusters.cell_y * 1.0 / :cells_per_degree - 90 + :size
+              AND spots_rtree.max_lat >= spot_clusters.cell_y * 1.0 / :cells_per_degree - 90
+              AND spots_rtree.min_lon <= spot_clusters.cell_x * 1.0 / :cells_per_degree - 180 + :size
+              AND spots_rtree.max_lon >= spot_clusters.cell_x * 1.0 / :cells_per_degree - 180
+              AND CAST((cell_spots.longitude + 180) * :cells_per_degree AS INTEGER) = spot_clusters.cell_x
+              AND CAST((cell_spots.latitude + 90) * :cells_per_degree AS INTEGER) = spot_clusters.cell_y
+            LIMIT 1
+        ) END
+        LEFT JOIN spot_stats ON spot_stats.spot_id = spots.id
+        WHERE spot_clusters.zoom = :zoom
+          AND spot_clusters.cell_x BETWEEN :min_x AND :max_x
+          AND spot_clusters.cell_y BETWEEN :min_y AND :max_y
+        """,
+        {
+            "zoom": zoom,
+            "cells_per_degree": cells_per_degree,
+            "size": 1 / cells_per_degree,
+            "min_x": int((min_lon + 180) * cells_per_degree),
+            "max_x": int((max_lon + 180) * cells_per_degree),
+            "min_y": int((min_lat + 90) * cells_per_degree),
+            "max_y": int((max_lat + 90) * cells_per_degree),
+        },
+    ).fetchall()
+
+    for cell in cells:
+        if cell["id"] is not None:
+            yield spot_feature(cell)
+        else:
+            count = cell["spot_count"]
+            yield cluster_feature(count, cell["lat_sum"] / count, cell["lon_sum"] / count)
+
+
+def stream_feature_collection(features):
+    """Serialize features as a GeoJSON FeatureCollection, chunk by chunk."""
+    yield '{"type":"FeatureCollection","features":['
+    first = True
+    for feature in features:
+        yield ("" if first else ",") + json.dumps(feature, separators=(",", ":"))
+        first = False
+    yield "]}"
@@ -0,0 +1,185 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g
+
+from geo import haversine_km
+
+# Defaults for the connection pool and the pragmas every connection is opened with.
+# Any of these can be overridden through app.config (see init_app below).
+DEFAULTS = {
+    "DATABASE": "spots.db",
+    "SQLITE_POOL_SIZE": 8,              # max open connections per worker process
+    "SQLITE_POOL_TIMEOUT": 10.0,        # seconds to wait for a free connection
+    "SQLITE_BUSY_TIMEOUT": 5000,        # ms SQLite itself waits on a locked database
+    "SQLITE_BUSY_RETRIES": 3,           # extra attempts after SQLITE_BUSY slips through
+    "SQLITE_SYNCHRONOUS": "NORMAL",     # NORMAL is safe with WAL and much faster than FULL
+    "SQLITE_CACHE_SIZE": -16000,        # negative = KiB, so roughly 16 MB of page cache
+    "SQLITE_MMAP_SIZE": 64 * 1024 * 1024,
+}
+
+
+def is_busy_error(error):
+    """True if an OperationalError means another connection holds the lock."""
+    message = str(error).lower()
+    return "database is locked" in message or "database is busy" in message
+
+
+class RetryingConnection(sqlite3.Connection):
+    """sqlite3 connection that retries statements and commits on SQLITE_BUSY."""
+
+    busy_retries = 3
+
+    def _retry(self, func, *args):
+        delay = 0.01
+        for attempt in range(self.busy_retries + 1):
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as error:
+                if not is_busy_error(error) or attempt == self.busy_retries:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    def execute(self, sql, parameters=()):
+        return self._retry(super().execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self._retry(super().executemany, sql, parameters)
+
+    def commit(self):
+        return self._retry(super().commit)
+
+
+def connect(path, config=None):
+    """Open a connection in WAL mode with the configured pragmas applied."""
+    settings = dict(DEFAULTS)
+    if config:
+        settings.update({key: config[key] for key in DEFAULTS if key in config})
+
+    connection = sqlite3.connect(
+        path,
+        timeout=settings["SQLITE_BUSY_TIMEOUT"] / 1000,
+        factory=RetryingConnection,
+        check_same_thread=False,  # the pool hands a connection to one thread at a time
+    )
+    connection.busy_retries = settings["SQLITE_BUSY_RETRIES"]
+    connection.row_factory = sqlite3.Row
+
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute(f"PRAGMA busy_timeout = {int(settings['SQLITE_BUSY_TIMEOUT'])}")
+    connection.execute(f"PRAGMA synchronous = {settings['SQLITE_SYNCHRONOUS']}")
+    connection.execute(f"PRAGMA cache_size = {int(settings['SQLITE_CACHE_SIZE'])}")
+    connection.execute(f"PRAGMA mmap_size = {int(settings['SQLITE_MMAP_SIZE'])}")
+
+    # distance_km(lat1, lon1, lat2, lon2) lets queries sort by distance from the user
+    connection.create_function("distance_km", 4, haversine_km, deterministic=True)
+    return connection
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections for one worker process."""
+
+    def __init__(self, path, size=8, timeout=10.0, config=None):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.config = config
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RuntimeError("Timed out waiting for a database connection")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return connect(self.path, self.config)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, connection):
+        # Never hand a half-finished transaction to the next request
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+        except sqlite3.Error:
+            connection.close()
+            self._slots.release()
+            return
+        self._idle.put(connection)
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(app=None):
+    """Return this process's pool for the app, creating it on first use."""
+    app = app or current_app._get_current_object()
+    pool = _pools.get(app)
+    # A forked worker must not reuse connections opened by its parent
+    if pool is None or pool.pid != os.getpid():
+        with _pools_lock:
+            pool = _pools.get(app)
+            if pool is None or pool.pid != os.getpid():
+                pool = ConnectionPool(
+                    app.config["DATABASE"],
+                    size=app.config["SQLITE_POOL_SIZE"],
+                    timeout=app.config["SQLITE_POOL_TIMEOUT"],
+                    config=app.config,
+                )
+                _pools[app] = pool
+    return pool
+
+
+def get_db():
+    """Connection for the current request, borrowed from the pool once and reused.
+
+    Extensions can register app.extensions["wrap_db"] to hand out a wrapper
+    around it instead (metrics.py uses this to time queries).
+    """
+    if "db" not in g:
+        connection = get_pool().acquire()
+        g.db_connection = connection
+        wrap = current_app.extensions.get("wrap_db")
+        g.db = wrap(connection) if wrap else connection
+    return g.db
+
+
+def close_db(exception=None):
+    g.pop("db", None)
+    connection = g.pop("db_connection", None)
+    if connection is not None:
+        get_pool().release(connection)
+
+
+def data_version(db, *names):
+    """Current counters from data_versions (bumped by triggers on every write)."""
+    placeholders = ", ".join("?" for _ in names)
+    rows = db.execute(
+        f"SELECT name, version FROM data_versions WHERE name IN ({placeholders})", names
+    ).fetchall()
+    versions = dict(rows)
+    return tuple(versions.get(name, 0) for name in names)
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.teardown_appcontext(close_db)
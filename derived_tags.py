@@ -0,0 +1,198 @@
+import json
+import math
+
+from geo import EARTH_RADIUS_KM, bounding_box
+from tags import tag_mask
+
+# Spots within CLOSE_RADIUS_KM of any of these points get the "close" tag
+ANCHORS = {
+    "Harvard Yard": (42.3744, -71.1169),
+}
+CLOSE_RADIUS_KM = 0.8  # about a ten minute walk
+
+# OSM tag values that give a spot one of the app's tags. cuisine is OSM's
+# ";"-separated list (stored in spots.cuisine), and any one of its values counts;
+# the other keys are read from the element's tags in spots.osm_tags.
+OSM_RULES = {
+    "sweet_treat": {
+        "amenity": ["ice_cream"],
+        "shop": ["bakery", "confectionery", "pastry", "chocolate", "ice_cream"],
+        "cuisine": ["ice_cream", "frozen_yogurt", "dessert", "donut", "cake", "crepe",
+                    "waffle", "pastry", "bakery", "chocolate", "bubble_tea"],
+    },
+    "health_conscious": {
+        "diet:vegan": ["yes", "only"],
+        "diet:vegetarian": ["only"],
+        "cuisine": ["salad", "vegan", "vegetarian", "juice", "poke", "açaí", "acai", "healthy"],
+    },
+    "affordable": {
+        "amenity": ["fast_food", "food_court"],
+        "cuisine": ["pizza", "burger", "sandwich", "bagel", "falafel", "donut", "hot_dog",
+                    "kebab", "burrito", "taco"],
+    },
+}
+
+CLOSE_BIT = tag_mask(["close"])
+
+KM_PER_DEGREE = math.radians(1) * EARTH_RADIUS_KM  # of latitude
+
+
+# OSM keys other than cuisine that any rule looks at
+OSM_KEYS = sorted({key for rules in OSM_RULES.values() for key in rules if key != "cuisine"})
+
+
+def _close_condition(anchors, radius_km, params):
+    """SQL that is true within radius_km of an anchor. The bounding box and a
+    flat-earth distance are plain arithmetic; only spots within 1% of the radius
+    either side are close enough to the edge to need the exact distance_km."""
+    parts = []
+    for i, (lat, lon) in enumerate(anchors.values()):
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+        params.update({
+            f"lat{i}": lat, f"lon{i}": lon,
+            f"min_lat{i}": min_lat, f"max_lat{i}": max_lat,
+            f"min_lon{i}": min_lon, f"max_lon{i}": max_lon,
+            f"km_lon{i}": KM_PER_DEGREE * math.cos(math.radians(lat)),
+        })
+        dy = f"(spots.latitude - :lat{i}) * :km_lat"
+        dx = f"(spots.longitude - :lon{i}) * :km_lon{i}"
+        flat = f"({dy}) * ({dy}) + ({dx}) * ({dx})"
+        parts.append(
+            f"(spots.latitude BETWEEN :min_lat{i} AND :max_lat{i}"
+            f" AND spots.longitude BETWEEN :min_lon{i} AND :max_lon{i}"
+            f" AND ({flat} <= :inner_sq OR ({flat} <= :outer_sq"
+            f" AND distance_km(spots.latitude, spots.longitude, :lat{i}, :lon{i}) <= :radius)))"
+        )
+    params.update({
+        "radius": radius_km,
+        "km_lat": KM_PER_DEGREE,
+        "inner_sq": (radius_km * 0.99) ** 2,
+        "outer_sq": (radius_km * 1.01) ** 2,
+    })
+    return " OR ".join(parts) or "0"
+
+
+def _rule_bits(found):
+    """Tag bits for a spot whose OSM data has these (key, value) pairs."""
+    bits = 0
+    for key, rules in OSM_RULES.items():
+        if any(value in rules.get(name, ()) for name, value in found):
+            bits |= tag_mask([key])
+    return bits
+
+
+def _cuisine_bits(cuisine):
+    """Tag bits for an OSM cuisine list; any one of its values counts."""
+    return _rule_bits([("cuisine", value.strip().lower()) for value in cuisine.split(";")])
+
+
+def _osm_bits(values):
+    """Tag bits for the OSM_KEYS values json_extract pulled out, as a JSON array."""
+    return _rule_bits(zip(OSM_KEYS, json.loads(values)))
+
+
+# TEMP tables derive_tags fills with the tag bits of each distinct value
+LOOKUP_TABLES = ["derive_cuisine_bits", "derive_osm_bits"]
+
+
+def create_lookup_tables(db):
+    """Create derive_tags' lookup tables on this connection if they are missing."""
+    for table in LOOKUP_TABLES:
+        db.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (value TEXT PRIMARY KEY, bits INTEGER)")
+
+
+def _fill_value_bits(db, table, values, bits_of):
+    """Keep the values with tag bits in one of the lookup tables."""
+    db.execute(f"DELETE FROM temp.{table}")
+    rows = []
+    for value in values:
+        bits = bits_of(value)
+        if bits:
+            rows.append((value, bits))
+    db.executemany(f"INSERT INTO temp.{table} (value, bits) VALUES (?, ?)", rows)
+
+
+def derive_tags(db, spot_ids=None, anchors=ANCHORS, radius_km=CLOSE_RADIUS_KM):
+    """Recompute the derived tags of the given spots (default: every spot).
+
+    "close" is set or cleared from the distance to the anchors. Tags implied by
+    the OSM data are added, except those an admin unticked (spots.tags_removed);
+    tags an admin ticked are kept. Cuisine lists and OSM values come from a
+    small vocabulary, so their tag bits are worked out in Python once per
+    distinct value and put in TEMP lookup tables. A single UPDATE then does the
+    rest inside SQLite and writes only the spots whose bits change, in the
+    caller's transaction. Returns the number of spots changed.
+    """
+    params = {}
+    paths = ", ".join("'$.\"" + key + "\"'" for key in OSM_KEYS)
+    osm_values = f"json_extract(spots.osm_tags, {paths})"
+    where = "1"
+    if spot_ids is not None:
+        where = "spots.id IN (SELECT value FROM json_each(:spot_ids))"
+        params["spot_ids"] = "[" + ",".join(str(int(spot_id)) for spot_id in spot_ids) + "]"
+
+    create_lookup_tables(db)
+    cuisines = db.execute(
+        f"SELECT DISTINCT cuisine FROM spots WHERE cuisine IS NOT NULL AND {where}", params
+    ).fetchall()
+    _fill_value_bits(db, "derive_cuisine_bits", [row[0] for row in cuisines], _cuisine_bits)
+    found = db.execute(
+        f"SELECT DISTINCT {osm_values} FROM spots WHERE osm_tags IS NOT NULL AND {where}", params
+    ).fetchall()
+    _fill_value_bits(db, "derive_osm_bits", [row[0] for row in found], _osm_bits)
+
+    params["close_bit"] = CLOSE_BIT
+    bits = f"""
+        ((spots.tag_bits & ~:close_bit)
+         | CASE WHEN {_close_condition(anchors, radius_km, params)} THEN :close_bit ELSE 0 END
+         | COALESCE((SELECT bits FROM temp.derive_cuisine_bits WHERE value = spots.cuisine), 0)
+         | COALESCE((SELECT bits FROM temp.derive_osm_bits WHERE value = {osm_values}), 0))
+        & ~spots.tags_removed
+    """
+    db.execute(f"UPDATE spots SET tag_bits = {bits} WHERE {where} AND tag_bits != {bits}", params)
+    return db.execute("SELECT changes()").fetchone()[0]
+
+
+# Temporary triggers that note every spot inserted, or whose derived tag inputs
+# change, on one connection (see queue_input_changes)
+QUEUE_TRIGGERS = {
+    "derive_queue_insert": "AFTER INSERT ON main.spots",
+    "derive_queue_update": """
+        AFTER UPDATE OF latitude, longitude, cuisine, osm_tags ON main.spots
+        WHEN OLD.latitude IS NOT NEW.latitude
+          OR OLD.longitude IS NOT NEW.longitude
+          OR OLD.cuisine IS NOT NEW.cuisine
+          OR OLD.osm_tags IS NOT NEW.osm_tags
+    """,
+}
+
+
+def queue_input_changes(db):
+    """Start noting the spots whose derived tags may change, for derive_queued.
+
+    A bulk load rewrites every row but only changes a few of them; deriving
+    the tags of just those is what keeps a re-import cheap. Only writes on
+    this connection are seen, and the queue is a TEMP table, so it is gone
+    if the connection is.
+    """
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS derive_queue (spot_id INTEGER PRIMARY KEY)")
+    for name, when in QUEUE_TRIGGERS.items():
+        db.execute(
+            f"""
+            CREATE TEMP TRIGGER IF NOT EXISTS {name} {when}
+            BEGIN
+                -- Not OR IGNORE: inside the importer's upsert that would still fail
+                INSERT INTO derive_queue (spot_id)
+                SELECT NEW.id WHERE NOT EXISTS (SELECT 1 FROM derive_queue WHERE spot_id = NEW.id);
+            END
+            """
+        )
+
+
+def derive_queued(db):
+    """derive_tags for the spots noted since queue_input_changes, then stop noting."""
+    spot_ids = [row[0] for row in db.execute("SELECT spot_id FROM temp.derive_queue")]
+    for name in QUEUE_TRIGGERS:
+        db.execute(f"DROP TRIGGER IF EXISTS temp.{name}")
+    db.execute("DROP TABLE IF EXISTS temp.derive_queue")
+    return derive_tags(db, spot_ids) if spot_ids else 0
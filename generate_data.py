@@ -0,0 +1,294 @@
+"""Fill a database with synthetic users, spots, reviews and favorites for load testing.
+
+Usage: python generate_data.py --db bench.db [--users 1000] [--spots 100000]
+                               [--reviews 5000000] [--favorites 20] [--seed 1]
+
+Creates or upgrades the schema with migrate.py and appends to whatever is
+already there. Spots are clustered around a few Boston/Cambridge squares with
+some spread over the whole area; a few spots and users get most of the
+reviews, the way real review sites do. Each generated user has their own
+password, password_for(username), so bench_routes.py can log in as any of
+them. Those are hashed with the cheap GENERATED_HASH_METHOD, since hashing
+thousands of passwords with the app's scrypt settings would take minutes;
+the first time a user logs in, the app upgrades the hash, as it does for
+any user whose hash predates its current settings.
+"""
+import argparse
+import random
+import time
+
+from werkzeug.security import generate_password_hash
+
+from database import connect
+from migrate import migrate
+from opening_hours import LATE_NIGHT_BIT, hours_columns
+from rebuild import REBUILDERS
+from tags import TAGS
+
+# A thousand iterations: about a millisecond per user instead of scrypt's ~50
+GENERATED_HASH_METHOD = "pbkdf2:sha256:1000"
+
+BATCH_SIZE = 50000
+
+# Spots cluster around these squares (lat, lon); the rest are spread over AREA
+HOTSPOTS = [
+    (42.3736, -71.1190),  # Harvard Square
+    (42.3652, -71.1036),  # Central Square
+    (42.3625, -71.0862),  # Kendall Square
+    (42.3884, -71.1191),  # Porter Square
+    (42.3503, -71.0810),  # Back Bay
+    (42.3555, -71.0605),  # Downtown Crossing
+    (42.3967, -71.1225),  # Davis Square
+]
+HOTSPOT_SPREAD = 0.008    # standard deviation in degrees, about 900 m
+HOTSPOT_SHARE = 0.7
+AREA = (42.23, 42.45, -71.25, -70.98)  # min_lat, max_lat, min_lon, max_lon
+
+CATEGORIES = ["Restaurant", "Cafe", "Fast Food", "Dessert", "Bar"]
+CATEGORY_WEIGHTS = [50, 20, 15, 8, 7]
+KINDS = {
+    "Restaurant": ["Kitchen", "House", "Bistro", "Grill", "Table"],
+    "Cafe": ["Cafe", "Coffee", "Espresso Bar", "Bakery"],
+    "Fast Food": ["Express", "To Go", "Shack", "Spot"],
+    "Dessert": ["Creamery", "Sweets", "Gelato", "Cakes"],
+    "Bar": ["Tavern", "Pub", "Taproom", "Lounge"],
+}
+PREFIXES = ["Golden", "Crimson", "Little", "Royal", "Blue", "Lucky", "Green", "Old",
+            "Sunny", "Corner", "Square", "River", "Harbor", "Union", "Happy", "Red"]
+CUISINES = ["Thai", "Sichuan", "Pizza", "Burrito", "Ramen", "Falafel", "Bagel", "Taco",
+            "Sushi", "Curry", "Burger", "Noodle", "Dumpling", "Pho", "Bibimbap", "Crepe"]
+
+# Chance a spot gets each tag, by tag key
+TAG_RATES = {
+    "late_night": 0.15,
+    "fine_dining": 0.05,
+    "health_conscious": 0.15,
+    "affordable": 0.35,
+    "sweet_treat": 0.10,
+    "close": 0.10,
+}
+
+# Opening hours for most spots, from real ones in the OSM extract; late_night follows from them
+HOURS_SHARE = 0.8
+HOURS = [
+    "Mo-Su 11:00-22:00",
+    "Mo-Fr 07:00-19:00; Sa-Su 08:00-18:00",
+    "Mo-Sa 11:30-22:00",
+    "Mo-Th 11:00-23:00; Fr-Sa 11:00-24:00; Su 12:00-22:00",
+    "Su-We 11:00-01:00; Th-Sa 11:00-02:00",
+    "Mo-Th 17:30-22:00; Fr-Sa 17:30-23:00",
+    "Mo-Fr 07:30-15:30; Sa-Su 08:00-15:30",
+    "Mo-Su 08:00-04:00",
+    "Tu-Su 11:00-22:00",
+    "Mo-Th 11:00-15:00,16:00-21:00; Fr,Sa 11:00-15:00,16:00-21:30; Su 12:00-15:00,16:00-21:00",
+]
+
+OPENERS = ["Great", "Decent", "Amazing", "Disappointing", "Solid", "Overpriced", "Cozy",
+           "Crowded", "Friendly", "Quick"]
+SUBJECTS = ["spot", "service", "portions", "vibe", "staff", "menu", "prices", "study spot"]
+ENDINGS = ["Would come back.", "Good for late night.", "Long line at lunch.",
+           "Perfect after exams.", "Skip the fries.", "Ask for extra sauce.",
+           "Bring friends.", "Not worth the walk.", ""]
+
+REVIEW_TEXT_SHARE = 0.6
+REVIEW_AGE_SECONDS = 2 * 365 * 24 * 3600
+
+
+def zipf_cum_weights(n, exponent):
+    """Cumulative weights for n items where item k (shuffled) weighs 1 / k^exponent."""
+    weights = [1 / (k ** exponent) for k in range(1, n + 1)]
+    random.shuffle(weights)
+    total = 0.0
+    cumulative = []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+
+def random_location():
+    if random.random() < HOTSPOT_SHARE:
+        lat, lon = random.choice(HOTSPOTS)
+        return random.gauss(lat, HOTSPOT_SPREAD), random.gauss(lon, HOTSPOT_SPREAD)
+    min_lat, max_lat, min_lon, max_lon = AREA
+    return random.uniform(min_lat, max_lat), random.uniform(min_lon, max_lon)
+
+
+def random_tag_bits():
+    bits = 0
+    for tag in TAGS:
+        if random.random() < TAG_RATES.get(tag.key, 0):
+            bits |= 1 << tag.bit
+    return bits
+
+
+def insert_batches(db, sql, rows, label, total):
+    """executemany rows (an iterator) in BATCH_SIZE chunks, printing progress."""
+    start = time.perf_counter()
+    done = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            db.executemany(sql, batch)
+            done += len(batch)
+            batch.clear()
+            print(f"  {label}: {done}/{total} ({done / (time.perf_counter() - start):.0f}/s)")
+    if batch:
+        db.executemany(sql, batch)
+
+
+def password_for(username):
+    """The password of a generated user."""
+    return f"{username}-password"
+
+
+def generate_users(db, count, admins):
+    first = db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM users").fetchone()[0]
+    rows = (
+        (
+            f"user{n}@college.harvard.edu",
+            f"user{n}",
+            generate_password_hash(password_for(f"user{n}"), GENERATED_HASH_METHOD),
+            int(n - first < admins),
+        )
+        for n in range(first, first + count)
+    )
+    insert_batches(
+        db, "INSERT INTO users (email, username, hash, is_admin) VALUES (?, ?, ?, ?)",
+        rows, "users", count,
+    )
+    return list(range(first, first + count))
+
+
+def generate_spots(db, count):
+    first = db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM spots").fetchone()[0]
+    parsed = {text: hours_columns(text) for text in HOURS}
+
+    def rows():
+        for spot_id in range(first, first + count):
+            category = random.choices(CATEGORIES, CATEGORY_WEIGHTS)[0]
+            cuisine = random.choice(CUISINES)
+            lat, lon = random_location()
+            name = f"{random.choice(PREFIXES)} {cuisine} {random.choice(KINDS[category])}"
+            tag_bits = random_tag_bits()
+            opening_hours = hours = None
+            if random.random() < HOURS_SHARE:
+                opening_hours = random.choice(HOURS)
+                hours, late_night, _ = parsed[opening_hours]
+                tag_bits = tag_bits & ~LATE_NIGHT_BIT | late_night * LATE_NIGHT_BIT
+            yield (spot_id, name, category, round(lat, 6), round(lon, 6), cuisine.lower(),
+                   tag_bits, opening_hours, hours)
+
+    insert_batches(
+        db,
+        """
+        INSERT INTO spots (id, name, category, latitude, longitude, cuisine, tag_bits,
+                           opening_hours, hours)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows(), "spots", count,
+    )
+    return list(range(first, first + count))
+
+
+def generate_reviews(db, count, user_ids, spot_ids):
+    spot_weights = zipf_cum_weights(len(spot_ids), 0.8)
+    user_weights = zipf_cum_weights(len(user_ids), 1.0)
+    # Each spot has a true quality its ratings scatter around
+    quality = [min(5.0, max(1.0, random.gauss(3.6, 0.7))) for _ in spot_ids]
+    now = time.time()
+
+    def rows():
+        remaining = count
+        while remaining:
+            n = min(remaining, BATCH_SIZE)
+            remaining -= n
+            spots = random.choices(range(len(spot_ids)), cum_weights=spot_weights, k=n)
+            users = random.choices(user_ids, cum_weights=user_weights, k=n)
+            for spot, user_id in zip(spots, users):
+                rating = min(5, max(1, round(random.gauss(quality[spot], 0.9))))
+                text = None
+                if random.random() < REVIEW_TEXT_SHARE:
+                    text = f"{random.choice(OPENERS)} {random.choice(SUBJECTS)}. {random.choice(ENDINGS)}".strip()
+                created = time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.gmtime(now - random.random() * REVIEW_AGE_SECONDS)
+                )
+                yield (spot_ids[spot], user_id, rating, text, created)
+
+    insert_batches(
+        db,
+        "INSERT INTO reviews (spot_id, user_id, rating, text, created_at) VALUES (?, ?, ?, ?, ?)",
+        rows(), "reviews", count,
+    )
+
+
+def generate_favorites(db, per_user, user_ids, spot_ids):
+    spot_weights = zipf_cum_weights(len(spot_ids), 0.8)
+
+    def rows():
+        for user_id in user_ids:
+            n = min(len(spot_ids), int(random.expovariate(1 / per_user))) if per_user else 0
+            for spot_id in random.choices(spot_ids, cum_weights=spot_weights, k=n):
+                yield (user_id, spot_id)
+
+    insert_batches(
+        db, "INSERT OR IGNORE INTO favorites (user_id, spot_id) VALUES (?, ?)",
+        rows(), "favorites", per_user * len(user_ids),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="bench.db")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--admins", type=int, default=1, help="how many of the new users are admins")
+    parser.add_argument("--spots", type=int, default=100000)
+    parser.add_argument("--reviews", type=int, default=5000000)
+    parser.add_argument("--favorites", type=int, default=20, help="average favorites per user")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    start = time.perf_counter()
+
+    db = connect(args.db)
+    migrate(db)
+
+    # Load everything with the triggers off, then rebuild the derived tables in
+    # one pass each - the same thing import_spots.py --bulk does, for every table
+    db.execute("BEGIN")
+    triggers = db.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall()
+    for name, _ in triggers:
+        db.execute(f"DROP TRIGGER {name}")
+
+    user_ids = generate_users(db, args.users, args.admins)
+    spot_ids = generate_spots(db, args.spots)
+    if user_ids and spot_ids:
+        generate_reviews(db, args.reviews, user_ids, spot_ids)
+        generate_favorites(db, args.favorites, user_ids, spot_ids)
+
+    for _, sql in triggers:
+        db.execute(sql)
+    for name, rebuild in REBUILDERS.items():
+        print(f"  rebuilding {name}")
+        rebuild(db)
+    # Running workers reload their caches when these change
+    db.execute("UPDATE data_versions SET version = version + 1")
+    db.commit()
+
+    counts = {
+        table: db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ["users", "spots", "reviews", "favorites"]
+    }
+    db.close()
+
+    print(
+        f"Done in {time.perf_counter() - start:.1f}s: "
+        + ", ".join(f"{count} {table}" for table, count in counts.items())
+        + f" (a generated user's password is {password_for('user1')!r} for user1, and so on)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import math
+
+EARTH_RADIUS_KM = 6371.0
+
+# Columns returned for every spot by the spatial queries below
+SPOT_COLUMNS = """
+    spots.id,
+    spots.name,
+    spots.category,
+    spots.latitude,
+    spots.longitude,
+    spot_stats.avg_rating,
+    COALESCE(spot_stats.rating_count, 0) AS review_count
+"""
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in kilometres, or None if a coordinate is missing."""
+    if lat1 is None or lon1 is None or lat2 is None or lon2 is None:
+        return None
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat, lon, radius_km):
+    """(min_lat, max_lat, min_lon, max_lon) that fully contains the circle."""
+    d_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    cos_lat = math.cos(math.radians(lat))
+    if cos_lat < 1e-6 or lat - d_lat <= -90 or lat + d_lat >= 90:
+        # Near a pole every longitude is within reach
+        return max(lat - d_lat, -90.0), min(lat + d_lat, 90.0), -180.0, 180.0
+    d_lon = math.degrees(radius_km / (EARTH_RADIUS_KM * cos_lat))
+    if lon - d_lon < -180 or lon + d_lon > 180:
+        # The circle crosses the antimeridian, which a single box can't straddle
+        return lat - d_lat, lat + d_lat, -180.0, 180.0
+    return lat - d_lat, lat + d_lat, lon - d_lon, lon + d_lon
+
+
+def parse_bbox(text):
+    """Parse "west,south,east,north" (Leaflet's toBBoxString order) into floats.
+
+    Returns (min_lat, max_lat, min_lon, max_lon) or raises ValueError.
+    """
+    parts = [float(p) for p in (text or "").split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox must be west,south,east,north")
+    west, south, east, north = parts
+    if south > north or west > east:
+        raise ValueError("bbox corners are out of order")
+    return south, north, west, east
+
+
+def spots_in_box(db, min_lat, max_lat, min_lon, max_lon, limit=None):
+    """Spots whose coordinates fall inside the box, found through the R*Tree."""
+    query = f"""
+        SELECT {SPOT_COLUMNS}
+        FROM spots_rtree
+        JOIN spots ON spots.id = spots_rtree.id
+        LEFT JOIN spot_stats ON spot_stats.spot_id = spots.id
+        WHERE spots_rtree.min_lat <= ? AND spots_rtree.max_lat >= ?
+          AND spots_rtree.min_lon <= ? AND spots_rtree.max_lon >= ?
+    """
+    params = [max_lat, min_lat, max_lon, min_lon]
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    return db.execute(query, params).fetchall()
+
+
+def spots_nearby(db, lat, lon, radius_km, limit=None):
+    """Spots within radius_km of (lat, lon), closest first, as (row, distance) pairs."""
+    candidates = spots_in_box(db, *bounding_box(lat, lon, radius_km))
+    found = []
+    for row in candidates:
+        distance = haversine_km(lat, lon, row["latitude"], row["longitude"])
+        if distance is not None and distance <= radius_km:
+            found.append((row, distance))
+    found.sort(key=lambda pair: pair[1])
+    return found[:limit] if limit else found
+
+
+def nearest_spots(db, lat, lon, k, start_radius_km=0.5, max_radius_km=EARTH_RADIUS_KM * math.pi):
+    """The k spots closest to (lat, lon), searching outward in growing circles.
+
+    A spot inside the circle is only accepted once the circle holds k spots,
+    so nothing closer can be hiding just outside the search box.
+    """
+    radius = start_radius_km
+    while True:
+        found = spots_nearby(db, lat, lon, radius)
+        if len(found) >= k or radius >= max_radius_km:
+            return found[:k]
+        radius *= 4
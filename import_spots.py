@@ -1,10 +1,21 @@
+import argparse
 import json
-import sqlite3
 import os
+import time
+
+from database import connect
+from derived_tags import derive_queued, queue_input_changes
+from opening_hours import LATE_NIGHT_BIT, LATE_NIGHT_TAG_BITS_SQL, hours_columns
+from rebuild import REBUILDERS
 
 DB_PATH = "spots.db"
 OSM_JSON_PATH = "harvard_spots.json"  # path to the file you downloaded
 
+BATCH_SIZE = 1000         # rows per executemany call
+REPORT_BAD_HOURS = 20     # unparseable opening_hours printed at the end (the rest are counted)
+PROGRESS_EVERY = 10000    # print a progress line every this many elements
+CHUNK_SIZE = 1 << 16      # bytes read from the JSON file at a time
+
 
 def classify_category(tags):
     """Map OSM amenity tags to your app's category field."""
@@ -20,61 +31,334 @@ def classify_category(tags):
     return "Restaurant"
 
 
+def iter_elements(f, chunk_size=CHUNK_SIZE):
+    """Yield the objects of the Overpass "elements" array one at a time.
+
+    Reads the file in chunks and decodes each element as soon as it is complete,
+    so memory use depends on the size of one element, not the whole extract.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+
+    # Skip ahead to the opening bracket of the "elements" array
+    while True:
+        start = buffer.find('"elements"')
+        bracket = buffer.find("[", start) if start != -1 else -1
+        if bracket != -1:
+            buffer = buffer[bracket + 1:]
+            break
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        buffer += chunk
+
+    pos = 0
+    while True:
+        # Skip the whitespace and commas between elements
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+
+        try:
+            if pos == len(buffer):
+                raise json.JSONDecodeError("Need more data", buffer, pos)
+            element, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The element continues in the next chunk
+            chunk = f.read(chunk_size)
+            if not chunk:
+                if buffer[pos:].strip():
+                    raise ValueError("JSON ended in the middle of an element")
+                return
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+
+        yield element
+
+        # Drop what has been decoded so the buffer does not keep growing
+        if pos > chunk_size:
+            buffer = buffer[pos:]
+            pos = 0
+
+
+def spot_row(el):
+    """Spot column values for one OSM element, or None if it can't be a spot."""
+    tags = el.get("tags", {})
+    name = tags.get("name")
+    if not name:
+        return None  # skip things without a name
+
+    # Get lat/lon
+    if el.get("type") == "node":
+        lat = el.get("lat")
+        lon = el.get("lon")
+    else:
+        center = el.get("center") or {}
+        lat = center.get("lat")
+        lon = center.get("lon")
+
+    if lat is None or lon is None:
+        return None
+
+    # Opening hours become a weekly bitmap, which also decides late_night
+    hours, late_night, hours_error = hours_columns(tags.get("opening_hours"))
+
+    return {
+        "osm_id": f"{el.get('type')}/{el.get('id')}",
+        "name": name,
+        "category": classify_category(tags),
+        "latitude": lat,
+        "longitude": lon,
+        "cuisine": tags.get("cuisine"),
+        "brand": tags.get("brand"),
+        "osm_tags": json.dumps(tags, sort_keys=True, ensure_ascii=False),
+        "opening_hours": tags.get("opening_hours"),
+        "hours": hours,
+        "late_night": late_night,
+        "hours_error": hours_error,
+    }
+
+
+# Insert new OSM elements; existing ones (same osm_id) are updated in place
+UPSERT_SQL = f"""
+    INSERT INTO spots (osm_id, name, category, latitude, longitude, cuisine, brand, osm_tags,
+                       opening_hours, hours, tag_bits)
+    VALUES (:osm_id, :name, :category, :latitude, :longitude, :cuisine, :brand, :osm_tags,
+            :opening_hours, :hours, COALESCE(:late_night, 0) * {LATE_NIGHT_BIT})
+    ON CONFLICT (osm_id) DO UPDATE SET
+        name = excluded.name,
+        category = excluded.category,
+        latitude = excluded.latitude,
+        longitude = excluded.longitude,
+        cuisine = excluded.cuisine,
+        brand = excluded.brand,
+        osm_tags = excluded.osm_tags,
+        opening_hours = excluded.opening_hours,
+        hours = excluded.hours,
+        tag_bits = {LATE_NIGHT_TAG_BITS_SQL}
+"""
+
+# Diff mode: skip the update (and the index triggers it fires) when nothing changed
+DIFF_CONDITION = """
+    WHERE spots.name IS NOT excluded.name
+       OR spots.category IS NOT excluded.category
+       OR spots.latitude IS NOT excluded.latitude
+       OR spots.longitude IS NOT excluded.longitude
+       OR spots.cuisine IS NOT excluded.cuisine
+       OR spots.brand IS NOT excluded.brand
+       OR spots.osm_tags IS NOT excluded.osm_tags
+       OR spots.hours IS NOT excluded.hours
+"""
+
+# Earlier versions of this script did not store osm_id. Link one of those rows
+# to its element instead of inserting a duplicate; running the old script twice
+# left several identical rows, and the rest are merged into it afterwards.
+ADOPT_SQL = """
+    UPDATE spots SET osm_id = :osm_id
+    WHERE id = (
+        SELECT MIN(id) FROM spots
+        WHERE osm_id IS NULL AND name = :name AND latitude = :latitude AND longitude = :longitude
+    )
+    AND NOT EXISTS (SELECT 1 FROM spots WHERE osm_id = :osm_id)
+"""
+
+# Legacy rows identical to a spot that has its osm_id, and that spot
+DUPLICATES_SQL = """
+    SELECT duplicate.id, MIN(adopted.id)
+    FROM spots AS duplicate
+    JOIN spots AS adopted
+      ON adopted.name = duplicate.name
+     AND adopted.latitude = duplicate.latitude
+     AND adopted.longitude = duplicate.longitude
+     AND adopted.osm_id IS NOT NULL
+    WHERE duplicate.osm_id IS NULL
+    GROUP BY duplicate.id
+"""
+
+
+# Triggers on spots that only maintain derived tables, keyed by name prefix, with
+# the rebuild.py target that recreates the same data in one set-based pass
+BULK_TRIGGERS = {
+    "spot_stats_spot_": "stats",
+    "spots_rtree_": "rtree",
+    "spots_fts_": "search",
+    "spot_clusters_": "clusters",
+    "leaderboard_spot_": "stats",      # rebuilding stats reranks the leaderboards too
+    "spot_changes_spot_": "changes",   # clients start over instead of syncing every row
+}
+
+
+def drop_bulk_triggers(db):
+    """Drop the derived-table triggers on spots; returns their SQL to recreate them."""
+    saved = []
+    rows = db.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'spots'"
+    ).fetchall()
+    for name, sql in rows:
+        if any(name.startswith(prefix) for prefix in BULK_TRIGGERS):
+            db.execute(f"DROP TRIGGER {name}")
+            saved.append(sql)
+    return saved
+
+
+def merge_duplicates(db):
+    """Fold legacy duplicates into the spot their element adopted; returns how many.
+
+    Their reviews and favorites move to the adopted spot (a user who favorited
+    both keeps one favorite), then the duplicate is deleted.
+    """
+    pairs = db.execute(DUPLICATES_SQL).fetchall()
+    for duplicate, adopted in pairs:
+        db.execute("UPDATE reviews SET spot_id = ? WHERE spot_id = ?", (adopted, duplicate))
+        db.execute(
+            "INSERT OR IGNORE INTO favorites (user_id, spot_id) SELECT user_id, ? FROM favorites WHERE spot_id = ?",
+            (adopted, duplicate),
+        )
+        db.execute("DELETE FROM favorites WHERE spot_id = ?", (duplicate,))
+        db.execute("DELETE FROM spots WHERE id = ?", (duplicate,))
+    return len(pairs)
+
+
+def import_elements(db, elements, diff=False, bulk=False, batch_size=BATCH_SIZE,
+                    progress_every=PROGRESS_EVERY):
+    """Upsert spots for the elements in batches inside a single transaction.
+
+    With bulk=True the per-row index triggers are dropped for the load and the
+    derived tables are rebuilt afterwards, all in the same transaction, so other
+    connections never see them out of sync.
+
+    Returns counts of processed, inserted, updated, unchanged and skipped elements,
+    how many legacy duplicates were merged, how many spots' derived tags changed, and (osm_id, name, opening_hours, error)
+    for each spot whose hours don't parse.
+    """
+    upsert = UPSERT_SQL + (DIFF_CONDITION if diff else "")
+    adopt = db.execute("SELECT 1 FROM spots WHERE osm_id IS NULL LIMIT 1").fetchone() is not None
+    spots_before = db.execute("SELECT COUNT(*) FROM spots").fetchone()[0]
+
+    counts = {"processed": 0, "written": 0, "skipped": 0}
+    bad_hours = []
+    start = time.perf_counter()
+    batch = []
+
+    def flush():
+        if adopt:
+            db.executemany(ADOPT_SQL, batch)
+        cursor = db.executemany(upsert, batch)
+        counts["written"] += cursor.rowcount
+        batch.clear()
+
+    db.execute("BEGIN")
+    try:
+        saved_triggers = drop_bulk_triggers(db) if bulk else []
+        queue_input_changes(db)
+
+        for el in elements:
+            counts["processed"] += 1
+            row = spot_row(el)
+            if row is None:
+                counts["skipped"] += 1
+            else:
+                if row["hours_error"]:
+                    bad_hours.append((row["osm_id"], row["name"], row["opening_hours"], row["hours_error"]))
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    flush()
+
+            if progress_every and counts["processed"] % progress_every == 0:
+                elapsed = time.perf_counter() - start
+                print(f"  {counts['processed']} elements ({counts['processed'] / elapsed:.0f}/s)")
+
+        if batch:
+            flush()
+        counts["merged"] = merge_duplicates(db) if adopt else 0
+
+        # close, sweet_treat, ... from the coordinates and OSM tags, for the spots
+        # this import added or moved or whose OSM data changed. New anchors or
+        # rules need python rebuild.py tags, which derives every spot
+        counts["tagged"] = derive_queued(db)
+
+        if bulk:
+            for sql in saved_triggers:
+                db.execute(sql)
+            for target in dict.fromkeys(BULK_TRIGGERS.values()):
+                print(f"  rebuilding {target}")
+                REBUILDERS[target](db)
+
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+    spots_after = db.execute("SELECT COUNT(*) FROM spots").fetchone()[0]
+    inserted = spots_after - spots_before + counts["merged"]
+    return {
+        "processed": counts["processed"],
+        "inserted": inserted,
+        "updated": counts["written"] - inserted,
+        "unchanged": counts["processed"] - counts["skipped"] - counts["written"],
+        "skipped": counts["skipped"],
+        "merged": counts["merged"],
+        "tagged": counts["tagged"],
+        "bad_hours": bad_hours,
+        "seconds": time.perf_counter() - start,
+    }
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Import OSM spots from an Overpass JSON extract.")
+    parser.add_argument("path", nargs="?", default=OSM_JSON_PATH)
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="only write spots whose OSM data changed since the last import",
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="rebuild the search/map/rating indexes once at the end instead of row by row "
+             "(much faster for large extracts)",
+    )
+    args = parser.parse_args()
+
     print("Current working directory:", os.getcwd())
-    print("Looking for JSON at:", OSM_JSON_PATH)
-    if not os.path.exists(OSM_JSON_PATH):
+    print("Looking for JSON at:", args.path)
+    if not os.path.exists(args.path):
         print("ERROR: JSON file not found.")
         return
 
-    # Load OSM data
-    print("Loading JSON...")
-    with open(OSM_JSON_PATH, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    elements = data.get("elements", [])
-    print("Total elements in JSON:", len(elements))
-
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    inserted = 0
-
-    for el in elements:
-        tags = el.get("tags", {})
-        name = tags.get("name")
-        if not name:
-            continue  # skip things without a name
-
-        # Get lat/lon
-        if el["type"] == "node":
-            lat = el.get("lat")
-            lon = el.get("lon")
-        else:
-            center = el.get("center")
-            if not center:
-                continue
-            lat = center.get("lat")
-            lon = center.get("lon")
-
-        if lat is None or lon is None:
-            continue
-
-        category = classify_category(tags)
-
-        cur.execute(
-            """
-            INSERT INTO spots (name, category, latitude, longitude)
-            VALUES (?, ?, ? ,?)
-            """,
-            (name, category, lat, lon),
+    db = connect(args.db)
+    with open(args.path, "r", encoding="utf-8") as f:
+        result = import_elements(
+            db,
+            iter_elements(f),
+            diff=args.diff,
+            bulk=args.bulk,
+            batch_size=args.batch_size,
         )
-        inserted += 1
+    db.close()
 
-    conn.commit()
-    conn.close()
+    rate = result["processed"] / result["seconds"] if result["seconds"] else 0
+    print(
+        f"Processed {result['processed']} elements in {result['seconds']:.2f}s ({rate:.0f}/s): "
+        f"{result['inserted']} inserted, {result['updated']} updated, "
+        f"{result['unchanged']} unchanged, {result['skipped']} skipped, "
+        f"{result['merged']} duplicate old rows merged; "
+        f"derived tags changed on {result['tagged']} spots"
+    )
 
-    print(f"Inserted {inserted} spots")
+    # Spots whose hours don't parse are still imported, just without hours
+    bad_hours = result["bad_hours"]
+    if bad_hours:
+        print(f"{len(bad_hours)} spots have opening_hours that don't parse (no open-now data for them):")
+        for osm_id, name, text, error in bad_hours[:REPORT_BAD_HOURS]:
+            print(f"  {osm_id} {name}: {text!r} ({error})")
+        if len(bad_hours) > REPORT_BAD_HOURS:
+            print(f"  ... and {len(bad_hours) - REPORT_BAD_HOURS} more (python opening_hours.py lists them all)")
 
 
 if __name__ == "__main__":
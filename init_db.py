@@ -1,17 +1,16 @@
-import sqlite3
 import os
 
-print("Running init_db.py from:", os.getcwd())
-
-connection = sqlite3.connect("spots.db")
+from database import connect
+from migrate import migrate
 
-with open("schema.sql") as f:
-    sql = f.read()
-    print("Loaded schema.sql:")
-    print(sql)
-    connection.executescript(sql)
+print("Running init_db.py from:", os.getcwd())
 
-connection.commit()
+# Creates spots.db from schema.sql, or upgrades an existing one with any
+# migrations it hasn't had yet (see migrate.py)
+connection = connect("spots.db")
+applied = migrate(connection)
 connection.close()
 
-print("Database initialized.")
\ No newline at end of file
+if applied:
+    print("Applied migrations:", ", ".join(f"{m.version:04d}_{m.name}" for m in applied))
+print("Database initialized.")
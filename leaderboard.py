@@ -0,0 +1,39 @@
+from tags import TAGS_BY_KEY
+
+# Most spots one leaderboard request can return
+MAX_LIMIT = 100
+
+
+def board_name(category=None, tag=None):
+    """Leaderboard name for a category or tag key (see leaderboard in schema.sql).
+
+    Raises KeyError for an unknown tag key.
+    """
+    if tag:
+        return f"tag:{TAGS_BY_KEY[tag].bit}"
+    if category:
+        return f"category:{category}"
+    return "all"
+
+
+def top_spots(db, board="all", limit=5):
+    """The best ranked spots on a board, best first."""
+    return db.execute(
+        """
+        SELECT
+            spots.id,
+            spots.name,
+            spots.category,
+            spots.tag_bits,
+            spot_stats.avg_rating,
+            spot_stats.rating_count AS review_count,
+            leaderboard.score
+        FROM leaderboard
+        JOIN spots ON spots.id = leaderboard.spot_id
+        JOIN spot_stats ON spot_stats.spot_id = leaderboard.spot_id
+        WHERE leaderboard.board = ?
+        ORDER BY leaderboard.score DESC, leaderboard.spot_id
+        LIMIT ?
+        """,
+        (board, limit),
+    ).fetchall()
@@ -0,0 +1,356 @@
+import bisect
+import functools
+import hashlib
+import hmac
+import re
+import threading
+import time
+
+from flask import current_app, g, request
+
+DEFAULTS = {
+    "METRICS_ENABLED": True,     # time requests and queries, served at /metrics
+    "SLOW_QUERY_MS": None,       # log queries slower than this with their query plan (None = off)
+    "METRICS_TOKEN": None,       # scrapers may send "Authorization: Bearer <token>" (None = off)
+    "METRICS_ALLOWED_IPS": (),   # scraper addresses allowed without the token
+}
+
+# Histogram bucket upper bounds
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """Prometheus histogram with one series per combination of label values."""
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, values, amount):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, amount)] += 1
+        series[-1] += amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for values, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{_labels(self.labels, values, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, values)} {series[-1]}"
+            yield f"{self.name}_count{_labels(self.labels, values)} {cumulative}"
+
+
+class Counter:
+    def __init__(self, name, help, labels, type="counter"):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.type = type
+        self.series = {}
+
+    def inc(self, values, amount=1):
+        self.series[values] = self.series.get(values, 0) + amount
+
+    def set(self, values, amount):
+        self.series[values] = amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for values, amount in self.series.items():
+            yield f"{self.name}{_labels(self.labels, values)} {amount}"
+
+
+ROUTE = ("route", "method", "status")
+
+request_seconds = Histogram(
+    "http_request_duration_seconds", "Time to handle a request.", ROUTE, SECONDS_BUCKETS
+)
+request_queries = Histogram(
+    "http_request_sql_queries", "SQL statements run per request.", ("route",), QUERY_COUNT_BUCKETS
+)
+request_sql_seconds = Histogram(
+    "http_request_sql_seconds", "Time spent in SQLite per request.", ("route",), SECONDS_BUCKETS
+)
+request_rows = Histogram(
+    "http_request_sql_rows", "Rows fetched from SQLite per request.", ("route",), ROW_BUCKETS
+)
+query_seconds = Histogram(
+    "sql_query_duration_seconds",
+    "Time per SQL statement (execute plus fetching its rows), by query fingerprint.",
+    ("query",),
+    SECONDS_BUCKETS,
+)
+query_rows = Counter("sql_query_rows_total", "Rows fetched, by query fingerprint.", ("query",))
+query_info = Counter(
+    "sql_query_info", "Normalized SQL text of each query fingerprint.", ("query", "sql"), type="gauge"
+)
+
+write_batch_size = Histogram(
+    "write_batch_size", "Writes committed together by the group-commit thread.", (),
+    QUERY_COUNT_BUCKETS,
+)
+write_batch_seconds = Histogram(
+    "write_batch_seconds", "Time to commit one group-commit batch.", (), SECONDS_BUCKETS
+)
+write_queue_depth = Counter(
+    "write_queue_depth", "Writes waiting for the group-commit thread.", (), type="gauge"
+)
+
+METRICS = [request_seconds, request_queries, request_sql_seconds, request_rows,
+           query_seconds, query_rows, query_info,
+           write_batch_size, write_batch_seconds, write_queue_depth]
+
+_lock = threading.Lock()
+
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\b(IN\s*)\(\s*\?(?:\s*,\s*\?)+\s*\)", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=2048)
+def normalize_sql(sql):
+    """SQL with literals replaced by ? and whitespace collapsed, and its fingerprint.
+
+    Statements that only differ in their literal values or the length of an
+    IN (?, ?, ...) list share one fingerprint.
+    """
+    text = _STRING_RE.sub("?", sql)
+    text = _NUMBER_RE.sub("?", text)
+    text = _IN_LIST_RE.sub(r"\1(?+)", text)
+    text = _SPACE_RE.sub(" ", text).strip()
+    return text, hashlib.blake2b(text.encode(), digest_size=4).hexdigest()
+
+
+class QueryRecord:
+    __slots__ = ("sql", "parameters", "seconds", "rows")
+
+    def __init__(self, sql, parameters, seconds):
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = seconds
+        self.rows = 0
+
+
+class InstrumentedCursor:
+    """Cursor wrapper that adds fetch time and row counts to its QueryRecord.
+
+    SQLite produces rows as they are fetched, so most of a SELECT's time is
+    spent here rather than in execute().
+    """
+
+    def __init__(self, cursor, record):
+        self._cursor = cursor
+        self._record = record
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._record.seconds += time.perf_counter() - start
+        if row is not None:
+            self._record.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        self._record.seconds += time.perf_counter() - start
+        self._record.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._record.seconds += time.perf_counter() - start
+        self._record.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = next(self._cursor)
+        finally:
+            self._record.seconds += time.perf_counter() - start
+        self._record.rows += 1
+        return row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection:
+    """Connection wrapper that records every statement run through it."""
+
+    def __init__(self, connection, records):
+        self._connection = connection
+        self._records = records
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        cursor = self._connection.execute(sql, parameters)
+        record = QueryRecord(sql, parameters, time.perf_counter() - start)
+        self._records.append(record)
+        return InstrumentedCursor(cursor, record)
+
+    def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        cursor = self._connection.executemany(sql, parameters)
+        self._records.append(QueryRecord(sql, None, time.perf_counter() - start))
+        return cursor
+
+    def __enter__(self):
+        self._connection.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._connection.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def wrap_db(connection):
+    if not current_app.config["METRICS_ENABLED"]:
+        return connection
+    return InstrumentedConnection(connection, g.setdefault("sql_queries", []))
+
+
+def query_plan(connection, record):
+    rows = connection.execute("EXPLAIN QUERY PLAN " + record.sql, record.parameters).fetchall()
+    # Each row is (id, parent, notused, detail); indent children under their parent
+    depth = {0: 0}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, 0) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return "\n".join(lines)
+
+
+def log_slow_queries(records, threshold_ms):
+    connection = g.get("db_connection")
+    for record in records:
+        if record.seconds * 1000 < threshold_ms:
+            continue
+        plan = ""
+        if connection is not None and record.parameters is not None:
+            try:
+                plan = "\n" + query_plan(connection, record)
+            except Exception as error:  # the plan is best effort; never fail the request
+                plan = f"\n  (no query plan: {error})"
+        current_app.logger.warning(
+            "Slow query (%.1f ms, %d rows) on %s %s: %s%s",
+            record.seconds * 1000,
+            record.rows,
+            request.method,
+            request.path,
+            normalize_sql(record.sql)[0],
+            plan,
+        )
+
+
+def start_timer():
+    g.metrics_start = time.perf_counter()
+
+
+def record_status(response):
+    g.metrics_status = response.status_code
+    g.metrics_streamed = response.is_streamed
+    return response
+
+
+def record_request(exception=None):
+    """Fold the request's timings into the histograms once it is completely done.
+
+    Streamed responses are torn down twice, once when the view returns and
+    again when the body has been sent; they are recorded the second time so
+    the streaming and its queries are included.
+    """
+    if g.pop("metrics_streamed", False):
+        return
+    start = g.pop("metrics_start", None)
+    if start is None or not current_app.config["METRICS_ENABLED"]:
+        return
+    seconds = time.perf_counter() - start
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+    status = g.pop("metrics_status", 500 if exception else 0)
+    records = g.pop("sql_queries", [])
+
+    with _lock:
+        request_seconds.observe((route, request.method, str(status)), seconds)
+        request_queries.observe((route,), len(records))
+        request_sql_seconds.observe((route,), sum(record.seconds for record in records))
+        request_rows.observe((route,), sum(record.rows for record in records))
+        for record in records:
+            text, fingerprint = normalize_sql(record.sql)
+            query_seconds.observe((fingerprint,), record.seconds)
+            query_rows.inc((fingerprint,), record.rows)
+            query_info.set((fingerprint, text), 1)
+
+    threshold = current_app.config["SLOW_QUERY_MS"]
+    if threshold is not None:
+        log_slow_queries(records, threshold)
+
+
+def record_write_batch(size, seconds, queue_depth):
+    """Called by write_queue.py after each group commit."""
+    with _lock:
+        write_batch_size.observe((), size)
+        write_batch_seconds.observe((), seconds)
+        write_queue_depth.set((), queue_depth)
+
+
+def render():
+    """Every metric in Prometheus text exposition format.
+
+    Metrics are kept per worker process, so each worker reports its own.
+    """
+    with _lock:
+        lines = [line for metric in METRICS for line in metric.render()]
+    return "\n".join(lines) + "\n"
+
+
+def scraper_allowed():
+    """Whether this request comes from a scraper: it carries METRICS_TOKEN or
+    comes from an address in METRICS_ALLOWED_IPS."""
+    token = current_app.config["METRICS_TOKEN"]
+    if token:
+        sent = request.headers.get("Authorization", "").encode()
+        if hmac.compare_digest(sent, f"Bearer {token}".encode()):
+            return True
+    return request.remote_addr in current_app.config["METRICS_ALLOWED_IPS"]
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.extensions["wrap_db"] = wrap_db
+    app.before_request(start_timer)
+    app.after_request(record_status)
+    app.teardown_request(record_request)
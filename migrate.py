@@ -0,0 +1,180 @@
+"""Bring a database's schema up to date with numbered migrations.
+
+Usage: python migrate.py [--db spots.db] [status | up]
+
+Migrations live in migrations/ as NNNN_description.sql or .py files and run
+in order, each in its own transaction, recorded in the schema_version table.
+A .py migration defines upgrade(db) and may list REBUILD targets from
+rebuild.py to run afterwards.
+
+schema.sql always describes the complete current schema. A new database is
+created straight from it and stamped with every migration. An existing one
+gets its pending migrations first, which make the changes CREATE ... IF NOT
+EXISTS can't (new columns, backfills, dropped or changed triggers), and then
+schema.sql, which adds any new tables, indexes, views and triggers.
+
+Migrations are applied online: each takes the write lock with BEGIN
+IMMEDIATE (waiting out other writers through the busy timeout) while WAL
+readers carry on. They must keep working with the code that is already
+running - add columns and indexes, don't rename or drop what it uses.
+"""
+import argparse
+import importlib.util
+import os
+import re
+import sqlite3
+import time
+
+from database import connect
+from rebuild import REBUILDERS
+
+DB_PATH = "spots.db"
+SCHEMA_PATH = "schema.sql"
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+MIGRATION_RE = re.compile(r"^(\d{4})_(\w+)\.(sql|py)$")
+
+SCHEMA_VERSION_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+class Migration:
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+
+    def load_module(self):
+        spec = importlib.util.spec_from_file_location(f"migration_{self.version:04d}", self.path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """Every migration file, in version order."""
+    migrations = []
+    for filename in sorted(os.listdir(directory)):
+        match = MIGRATION_RE.match(filename)
+        if match:
+            migrations.append(
+                Migration(int(match.group(1)), match.group(2), os.path.join(directory, filename))
+            )
+    versions = [migration.version for migration in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Two migrations in {directory} share a version number")
+    return migrations
+
+
+def applied_versions(db):
+    db.execute(SCHEMA_VERSION_SQL)
+    return {row[0] for row in db.execute("SELECT version FROM schema_version")}
+
+
+def sql_statements(script):
+    """Split a SQL script into complete statements (trigger bodies included)."""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ""
+
+
+def apply(db, migration):
+    """Run one migration and record it, all in a single transaction.
+
+    Returns the rebuild targets it asks for.
+    """
+    rebuild = []
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if migration.path.endswith(".py"):
+            module = migration.load_module()
+            module.upgrade(db)
+            rebuild = list(getattr(module, "REBUILD", []))
+        else:
+            with open(migration.path) as f:
+                script = f.read()
+            # One statement at a time so the script stays in this transaction
+            # (executescript would commit first)
+            for statement in sql_statements(script):
+                db.execute(statement)
+        db.execute(
+            "INSERT INTO schema_version (version, name) VALUES (?, ?)",
+            (migration.version, migration.name),
+        )
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return rebuild
+
+
+def migrate(db, schema_path=SCHEMA_PATH, migrations=None):
+    """Create or upgrade the database; returns the migrations that were applied."""
+    migrations = load_migrations() if migrations is None else migrations
+    with open(schema_path) as f:
+        schema = f.read()
+
+    fresh = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'spots'"
+    ).fetchone() is None
+    done = applied_versions(db)
+
+    if fresh:
+        db.executescript(schema)
+        with db:
+            db.executemany(
+                "INSERT OR IGNORE INTO schema_version (version, name) VALUES (?, ?)",
+                [(migration.version, migration.name) for migration in migrations],
+            )
+        return []
+
+    applied = []
+    rebuild = []
+    for migration in migrations:
+        if migration.version in done:
+            continue
+        start = time.perf_counter()
+        print(f"Applying {migration.version:04d}_{migration.name}")
+        rebuild += apply(db, migration)
+        print(f"  done in {time.perf_counter() - start:.2f}s")
+        applied.append(migration)
+
+    # New tables, indexes, views and triggers; everything else is already there
+    db.executescript(schema)
+
+    for target in dict.fromkeys(rebuild):
+        print(f"Rebuilding {target}")
+        with db:
+            REBUILDERS[target](db)
+
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", nargs="?", choices=["status", "up"], default="up")
+    parser.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args()
+
+    db = connect(args.db)
+    if args.command == "status":
+        done = applied_versions(db)
+        for migration in load_migrations():
+            state = "applied" if migration.version in done else "pending"
+            print(f"{migration.version:04d}_{migration.name:<40} {state}")
+    else:
+        applied = migrate(db)
+        print(f"Applied {len(applied)} migration(s)" if applied else "Schema is up to date")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+# Columns added to the spots table after the first release: OSM details for
+# search and the importer (cuisine, brand, osm_id, osm_tags) and the tag_bits
+# mask that replaced the six tag columns. Databases created before this was a
+# migration may already have some of them, so each one is only added if missing.
+
+NEW_COLUMNS = [
+    ("spots", "cuisine", "TEXT", None),
+    ("spots", "brand", "TEXT", None),
+    ("spots", "osm_id", "TEXT", None),
+    ("spots", "osm_tags", "TEXT", None),
+    (
+        "spots",
+        "tag_bits",
+        "INTEGER NOT NULL DEFAULT 0",
+        """
+        UPDATE spots SET tag_bits =
+            COALESCE(late_night, 0)
+            | (COALESCE(fine_dining, 0) << 1)
+            | (COALESCE(health_conscious, 0) << 2)
+            | (COALESCE(affordable, 0) << 3)
+            | (COALESCE(sweet_treat, 0) << 4)
+            | (COALESCE(close, 0) << 5)
+        """,
+    ),
+]
+
+# The derived tables (ratings, map, search, leaderboards) may never have been
+# filled on these databases
+REBUILD = ["stats", "rtree", "search", "clusters"]
+
+
+def upgrade(db):
+    for table, column, declaration, backfill in NEW_COLUMNS:
+        existing = [row[1] for row in db.execute(f"PRAGMA table_info({table})")]
+        if column not in existing:
+            print(f"  adding column {table}.{column}")
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+            if backfill:
+                db.execute(backfill)
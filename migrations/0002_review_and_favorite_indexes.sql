@@ -0,0 +1,13 @@
+-- Indexes for the per-spot and per-user lookups, which all scanned the whole
+-- reviews or favorites table before.
+
+-- A spot's reviews: the spot page (newest first - entries are in rowid order
+-- within a spot, so ORDER BY reviews.id DESC needs no sort), deleting a spot,
+-- and the search triggers that rebuild a spot's review text
+CREATE INDEX IF NOT EXISTS reviews_by_spot ON reviews (spot_id);
+
+-- My Reviews: one user's reviews, newest first
+CREATE INDEX IF NOT EXISTS reviews_by_user ON reviews (user_id, created_at);
+
+-- Who favorited a spot (the UNIQUE (user_id, spot_id) index covers the other direction)
+CREATE INDEX IF NOT EXISTS favorites_by_spot ON favorites (spot_id, user_id);
@@ -0,0 +1,40 @@
+# Opening hours from the OSM tags, parsed into the weekly bitmap the "open now"
+# filter reads, with late_night worked out from them where they parse.
+
+from opening_hours import LATE_NIGHT_TAG_BITS_SQL, hours_columns
+
+NEW_COLUMNS = [
+    ("spots", "opening_hours", "TEXT"),
+    ("spots", "hours", "BLOB"),
+]
+
+
+def upgrade(db):
+    existing = [row[1] for row in db.execute("PRAGMA table_info(spots)")]
+    for table, column, declaration in NEW_COLUMNS:
+        if column not in existing:
+            print(f"  adding column {table}.{column}")
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+    rows = db.execute(
+        "SELECT id, json_extract(osm_tags, '$.opening_hours') FROM spots "
+        "WHERE json_extract(osm_tags, '$.opening_hours') IS NOT NULL"
+    ).fetchall()
+    unparseable = 0
+    updates = []
+    for spot_id, text in rows:
+        hours, late_night, error = hours_columns(text)
+        unparseable += error is not None
+        updates.append(
+            {"id": spot_id, "opening_hours": text, "hours": hours, "late_night": late_night}
+        )
+    db.executemany(
+        f"""
+        UPDATE spots SET opening_hours = :opening_hours, hours = :hours,
+                         tag_bits = {LATE_NIGHT_TAG_BITS_SQL}
+        WHERE id = :id
+        """,
+        updates,
+    )
+    print(f"  {len(rows)} spots with opening_hours, {unparseable} unparseable "
+          "(python opening_hours.py lists them)")
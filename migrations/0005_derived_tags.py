@@ -0,0 +1,8 @@
+# Spots never had their "close" tag computed, and imported spots got no tags
+# from their OSM data; derive them once for the spots already in the database.
+
+REBUILD = ["tags"]
+
+
+def upgrade(db):
+    pass
@@ -0,0 +1,8 @@
+# The spot change log and its triggers come from schema.sql; this fills it with
+# the spots already in the database, so a client's first sync gets all of them.
+
+REBUILD = ["changes"]
+
+
+def upgrade(db):
+    pass
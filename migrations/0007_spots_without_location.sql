@@ -0,0 +1,4 @@
+-- Spots without coordinates, which sorting by distance lists last. The
+-- located ones come from spots_rtree, so no distance page scans spots.
+CREATE INDEX IF NOT EXISTS spots_without_location ON spots (id)
+WHERE latitude IS NULL OR longitude IS NULL;
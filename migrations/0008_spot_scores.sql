@@ -0,0 +1,3 @@
+-- leaderboard_entries now reads the score from the new spot_scores view, which
+-- schema.sql creates along with the new leaderboard_entries.
+DROP VIEW IF EXISTS leaderboard_entries;
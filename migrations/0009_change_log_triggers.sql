@@ -0,0 +1,6 @@
+-- The change log triggers used INSERT OR REPLACE, which fails inside the
+-- importer's upsert. schema.sql recreates them as a delete and an insert.
+DROP TRIGGER IF EXISTS spot_changes_spot_insert;
+DROP TRIGGER IF EXISTS spot_changes_spot_update;
+DROP TRIGGER IF EXISTS spot_changes_spot_delete;
+DROP TRIGGER IF EXISTS spot_changes_rating_update;
@@ -0,0 +1,10 @@
+# Tags an admin unticks on the edit form are remembered in spots.tags_removed,
+# so deriving the tags from OSM data no longer turns them back on. Nothing
+# has been unticked yet, so every spot starts at 0.
+
+
+def upgrade(db):
+    existing = [row[1] for row in db.execute("PRAGMA table_info(spots)")]
+    if "tags_removed" not in existing:
+        print("  adding column spots.tags_removed")
+        db.execute("ALTER TABLE spots ADD COLUMN tags_removed INTEGER NOT NULL DEFAULT 0")
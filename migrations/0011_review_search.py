@@ -0,0 +1,22 @@
+# Review text moves out of spots_fts into reviews_fts, one row per review, so
+# a review write no longer re-indexes every review of its spot. spots_fts
+# loses its reviews column, which an FTS5 table can only do by being made
+# again: drop it and the triggers that write it, and let schema.sql create
+# the new tables and triggers and rebuild.py fill them.
+
+REBUILD = ["search"]
+
+DROPPED_TRIGGERS = [
+    "spots_fts_insert",
+    "spots_fts_update",
+    "spots_fts_delete",
+    "spots_fts_review_insert",
+    "spots_fts_review_delete",
+    "spots_fts_review_update",
+]
+
+
+def upgrade(db):
+    for name in DROPPED_TRIGGERS:
+        db.execute(f"DROP TRIGGER IF EXISTS {name}")
+    db.execute("DROP TABLE IF EXISTS spots_fts")
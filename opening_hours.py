@@ -0,0 +1,252 @@
+"""Parse OSM opening_hours into a weekly bitmap, and report spots whose hours don't parse.
+
+Usage: python opening_hours.py [--db spots.db]
+
+A spot's week is 7 days x 96 quarter hours = 672 bits, Monday 00:00 first,
+stored in spots.hours as 84 little-endian bytes. Bit day * 96 + quarter is set
+when the spot is open for any part of that quarter hour.
+
+The parser covers the opening_hours syntax that shows up in the extract: day
+ranges and lists ("Mo-Th,Su", "Su-We"), several time ranges per day, "off",
+"24/7", times past midnight (which spill into the next day) and ";" rules
+overriding earlier ones for the same days. Public holidays (PH/SH) are ignored.
+Anything else - month or week selectors, sunrise, comments, typos - raises
+HoursError, and the spot is listed by this script instead of guessed at.
+"""
+import functools
+import re
+from datetime import datetime
+
+from tags import tag_mask
+
+DAYS = ["Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"]
+SLOTS_PER_DAY = 96
+WEEK_SLOTS = 7 * SLOTS_PER_DAY
+HOURS_BYTES = WEEK_SLOTS // 8
+
+# Every spot is around Boston, so "now" means now in Boston
+TIMEZONE_NAME = "America/New_York"
+
+# A spot is "late night" if it is still open at some point between midnight and 4am
+LATE_NIGHT_SLOTS = range(0, 4 * 4)
+LATE_NIGHT_MASK = sum(
+    1 << (day * SLOTS_PER_DAY + slot) for day in range(7) for slot in LATE_NIGHT_SLOTS
+)
+
+# SQL for spots.tag_bits with late_night set from the :late_night parameter
+# (1, 0, or NULL to keep whatever the spot had, for spots without hours)
+LATE_NIGHT_BIT = tag_mask(["late_night"])
+LATE_NIGHT_TAG_BITS_SQL = f"""
+    CASE WHEN :late_night IS NULL THEN tag_bits
+         ELSE (tag_bits & ~{LATE_NIGHT_BIT}) | (:late_night * {LATE_NIGHT_BIT}) END
+"""
+
+TOKEN_RE = re.compile(
+    r"""\s*(?:
+        (?P<time>(\d{1,2}):(\d\d)\s*-\s*(\d{1,2}):(\d\d))(?![\d:])
+      | (?P<day>Mo|Tu|We|Th|Fr|Sa|Su)\b
+      | (?P<holiday>PH|SH)\b
+      | (?P<off>off|closed)\b
+      | (?P<always>24/7)
+      | (?P<sep>[;,])
+      | (?P<dash>-)
+    )""",
+    re.VERBOSE,
+)
+
+
+class HoursError(ValueError):
+    pass
+
+
+def tokenize(text):
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = TOKEN_RE.match(text, pos)
+        if not match:
+            raise HoursError(f"can't read {text[pos:].strip()[:20]!r}")
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == "time":
+            start_h, start_m, end_h, end_m = (int(match.group(n)) for n in range(2, 6))
+            if start_m >= 60 or end_m >= 60 or start_h > 24 or end_h > 48:
+                raise HoursError(f"bad time {match.group('time')!r}")
+            yield kind, (start_h * 60 + start_m, end_h * 60 + end_m)
+        else:
+            yield kind, match.group(kind)
+
+
+class Rule:
+    def __init__(self, additive=False):
+        self.days = []
+        self.holiday = False
+        self.ranges = []
+        self.off = False
+        self.additive = additive  # "," between rules adds hours, ";" replaces them
+
+    def has_times(self):
+        return bool(self.ranges) or self.off
+
+
+def parse_rules(text):
+    tokens = list(tokenize(text))
+    rules = []
+    rule = Rule()
+    separator = None
+    i = 0
+    while i < len(tokens):
+        kind, value = tokens[i]
+        if kind in ("day", "holiday") and rule.has_times():
+            # Days after times start the next rule
+            rules.append(rule)
+            rule = Rule(additive=separator == ",")
+        if kind == "day":
+            first = DAYS.index(value)
+            if i + 2 < len(tokens) and tokens[i + 1][0] == "dash" and tokens[i + 2][0] == "day":
+                last = DAYS.index(tokens[i + 2][1])
+                rule.days.extend((first + n) % 7 for n in range((last - first) % 7 + 1))
+                i += 2
+            else:
+                rule.days.append(first)
+        elif kind == "holiday":
+            rule.holiday = True
+        elif kind == "time":
+            rule.ranges.append(value)
+        elif kind == "off":
+            rule.off = True
+        elif kind == "always":
+            rule.ranges.append((0, 24 * 60))
+        elif kind == "sep":
+            separator = value
+            if value == ";":
+                if rule.has_times():
+                    rules.append(rule)
+                rule = Rule()
+            i += 1
+            continue
+        else:
+            raise HoursError("'-' without a day or time on both sides")
+        separator = None
+        i += 1
+    if rule.has_times():
+        rules.append(rule)
+    elif rule.days or rule.holiday:
+        raise HoursError("days without hours at the end")
+    if not rules:
+        raise HoursError("no hours")
+    return rules
+
+
+def parse(text):
+    """The weekly bitmap (an int of WEEK_SLOTS bits) for an opening_hours string."""
+    week = {day: [] for day in range(7)}
+    for rule in parse_rules(text):
+        if rule.holiday and not rule.days:
+            continue  # holiday-only rules, e.g. "PH off"
+        for day in rule.days or range(7):
+            if rule.additive:
+                week[day] = week[day] + ([] if rule.off else rule.ranges)
+            else:
+                week[day] = [] if rule.off else list(rule.ranges)
+
+    bitmap = 0
+    for day, ranges in week.items():
+        for start, end in ranges:
+            if end <= start:
+                end += 24 * 60  # "18:00-02:00" closes the next morning; "10:00-10:00" is all day
+            first = day * SLOTS_PER_DAY + start // 15
+            last = day * SLOTS_PER_DAY + -(-end // 15)  # round up: open for part of the quarter
+            for slot in range(first, last):
+                bitmap |= 1 << (slot % WEEK_SLOTS)
+    return bitmap
+
+
+def to_blob(bitmap):
+    return bitmap.to_bytes(HOURS_BYTES, "little")
+
+
+def from_blob(blob):
+    return int.from_bytes(blob, "little") if blob is not None else None
+
+
+def is_late_night(bitmap):
+    return bool(bitmap & LATE_NIGHT_MASK)
+
+
+def hours_columns(opening_hours):
+    """(hours blob, late_night 0/1, error) for a spot's opening_hours text.
+
+    All three are None when there is no text; on a parse error only the error is set.
+    """
+    if not opening_hours:
+        return None, None, None
+    try:
+        bitmap = parse(opening_hours)
+    except HoursError as error:
+        return None, None, str(error)
+    return to_blob(bitmap), int(is_late_night(bitmap)), None
+
+
+def slot_at(moment):
+    return moment.weekday() * SLOTS_PER_DAY + (moment.hour * 60 + moment.minute) // 15
+
+
+@functools.lru_cache(maxsize=None)
+def timezone():
+    # zoneinfo is imported on first use: only the open-now filter needs it,
+    # and loading it is a noticeable part of a new worker's import time
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(TIMEZONE_NAME)
+
+
+def requested_slot(args, now=None):
+    """The week slot a /spots "open" filter asks about, or None without one.
+
+    ?open_now=1 means the current quarter hour; ?open_at=HH:MM (with an
+    optional ?open_day=Mo..Su, default today) picks another time.
+    Raises ValueError for a time or day that doesn't parse.
+    """
+    open_at = args.get("open_at")
+    if not open_at and not args.get("open_now"):
+        return None
+    now = now or datetime.now(timezone())
+    if not open_at:
+        return slot_at(now)
+
+    match = re.fullmatch(r"(\d{1,2}):(\d\d)", open_at.strip())
+    if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+        raise ValueError("open_at must be a time like 21:30")
+    day = args.get("open_day") or DAYS[now.weekday()]
+    if day not in DAYS:
+        raise ValueError("open_day must be one of " + ", ".join(DAYS))
+    minutes = int(match.group(1)) * 60 + int(match.group(2))
+    return DAYS.index(day) * SLOTS_PER_DAY + minutes // 15
+
+
+def main():
+    import argparse
+
+    from database import connect
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="spots.db")
+    args = parser.parse_args()
+
+    db = connect(args.db)
+    rows = db.execute(
+        "SELECT id, osm_id, name, opening_hours FROM spots "
+        "WHERE opening_hours IS NOT NULL AND hours IS NULL ORDER BY id"
+    ).fetchall()
+    known = db.execute("SELECT COUNT(*) FROM spots WHERE hours IS NOT NULL").fetchone()[0]
+    db.close()
+
+    for row in rows:
+        _, _, error = hours_columns(row["opening_hours"])
+        print(f"{row['id']:>7} {row['osm_id'] or '-':<16} {row['name'][:30]:<30} "
+              f"{row['opening_hours']!r}: {error or 'parses now - re-run the importer'}")
+    print(f"{known} spots with hours, {len(rows)} with opening_hours that don't parse")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+DEFAULTS = {
+    # Written out in full, the way it starts every stored hash; users whose
+    # hash was made with anything else get a new one when they next log in
+    "PASSWORD_HASH_METHOD": "scrypt:32768:8:1",
+    "PASSWORD_HASH_WORKERS": max(1, (os.cpu_count() or 2) // 2),  # 0 = hash on the request thread
+    "PASSWORD_HASH_QUEUE": 8,           # hashes running or waiting per worker process before 503s
+    "PASSWORD_HASH_TIMEOUT": 5.0,       # seconds to wait for a hash before giving up with a 503
+    "PASSWORD_HASH_NICE": 5,            # lower the hashing processes' CPU priority below page requests
+    "LOGIN_FAILURE_WINDOW": 300,        # seconds failed logins are remembered
+    "LOGIN_MAX_FAILURES": 5,            # per username within the window, then 429s
+    "LOGIN_MAX_FAILURES_PER_IP": 50,    # per client address within the window, then 429s
+}
+
+
+class HashingUnavailable(Exception):
+    """The hashing pool is full or not answering; the caller should try again shortly."""
+
+
+class HashPool:
+    """A few processes that run password key derivation off the request threads.
+
+    scrypt is meant to be slow, and a burst of logins hashing on the request
+    threads takes every CPU away from people browsing. Here at most `workers`
+    hashes run at once, and at most `limit` wait for one; past that, callers
+    get HashingUnavailable straight away instead of joining a growing queue.
+    A hash whose caller gave up waiting keeps its slot until it finishes.
+    """
+
+    def __init__(self, workers, limit, timeout, nice=0):
+        # Imported here rather than at the top: a worker only needs them once
+        # someone logs in, and they are slow to import
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # spawn rather than fork: forking a threaded server can copy a held lock.
+        # Windows has no os.nice, so there the processes keep normal priority
+        self._executor = ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=os.nice if hasattr(os, "nice") else None,
+            initargs=(nice,) if hasattr(os, "nice") else (),
+        )
+        # Start the processes now, so the first logins don't spend their timeout waiting for them
+        for future in [self._executor.submit(int) for _ in range(workers)]:
+            future.result()
+        self._slots = threading.BoundedSemaphore(limit)
+        self.timeout = timeout
+        self.pid = os.getpid()
+
+    def run(self, fn, *args):
+        from concurrent.futures import TimeoutError as FutureTimeout
+        from concurrent.futures.process import BrokenProcessPool
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingUnavailable("Too many password hashes in progress")
+        try:
+            future = self._executor.submit(fn, *args)
+        except BrokenProcessPool as error:
+            self._slots.release()
+            raise HashingUnavailable(str(error) or type(error).__name__) from error
+        # The slot is free once the hash is, not when the caller stops waiting:
+        # a timed-out hash still holds a process until it finishes
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except (FutureTimeout, BrokenProcessPool) as error:
+            # One still waiting for a process needn't run at all
+            future.cancel()
+            raise HashingUnavailable(str(error) or type(error).__name__) from error
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(app=None):
+    """This process's hashing pool for the app, or None to hash inline."""
+    app = app or current_app._get_current_object()
+    if not app.config["PASSWORD_HASH_WORKERS"]:
+        return None
+    pool = _pools.get(app)
+    if pool is None or pool.pid != os.getpid():
+        with _pools_lock:
+            pool = _pools.get(app)
+            if pool is None or pool.pid != os.getpid():
+                pool = HashPool(
+                    app.config["PASSWORD_HASH_WORKERS"],
+                    app.config["PASSWORD_HASH_QUEUE"],
+                    app.config["PASSWORD_HASH_TIMEOUT"],
+                    app.config["PASSWORD_HASH_NICE"],
+                )
+                _pools[app] = pool
+    return pool
+
+
+def _run(fn, *args):
+    pool = get_pool()
+    return fn(*args) if pool is None else pool.run(fn, *args)
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, current_app.config["PASSWORD_HASH_METHOD"])
+
+
+def check_password(stored_hash, password):
+    return _run(check_password_hash, stored_hash, password)
+
+
+def needs_rehash(stored_hash):
+    return stored_hash.split("$", 1)[0] != current_app.config["PASSWORD_HASH_METHOD"]
+
+
+# Failed login times by ("user", username) and ("ip", address), per worker process
+_failures = {}
+_failures_lock = threading.Lock()
+MAX_TRACKED = 10000
+
+
+def _recent(key, now, window):
+    times = _failures.get(key)
+    if times is None:
+        return 0
+    while times and times[0] <= now - window:
+        times.popleft()
+    if not times:
+        del _failures[key]
+        return 0
+    return len(times)
+
+
+def login_retry_after(username, address):
+    """Seconds until this username/address may try again, or 0 if it may now."""
+    config = current_app.config
+    window = config["LOGIN_FAILURE_WINDOW"]
+    now = time.monotonic()
+    limits = [(("user", username), config["LOGIN_MAX_FAILURES"]),
+              (("ip", address), config["LOGIN_MAX_FAILURES_PER_IP"])]
+    wait = 0
+    with _failures_lock:
+        for key, limit in limits:
+            if _recent(key, now, window) >= limit:
+                # Allowed again once the oldest remembered failure expires
+                wait = max(wait, _failures[key][0] + window - now)
+    return int(wait) + 1 if wait else 0
+
+
+def record_login_failure(username, address):
+    now = time.monotonic()
+    with _failures_lock:
+        # Forget expired entries now and then so made-up usernames can't pile up
+        if len(_failures) > MAX_TRACKED:
+            for key in list(_failures):
+                _recent(key, now, current_app.config["LOGIN_FAILURE_WINDOW"])
+        for key in [("user", username), ("ip", address)]:
+            _failures.setdefault(key, deque()).append(now)
+
+
+def clear_login_failures(username):
+    with _failures_lock:
+        _failures.pop(("user", username), None)
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
@@ -0,0 +1,145 @@
+import argparse
+import time
+
+from changes import rebuild_changes
+from database import connect
+from derived_tags import derive_tags
+from recommend import rebuild_recommendations
+
+DB_PATH = "spots.db"
+
+
+def rebuild_tags(db):
+    """Recompute the derived tags (close, and those implied by OSM data) of every spot."""
+    derive_tags(db)
+
+
+def rebuild_stats(db):
+    """Recompute spot_stats from the reviews table in one pass."""
+    db.execute("DELETE FROM spot_stats")
+    db.execute(
+        """
+        INSERT INTO spot_stats
+            (spot_id, rating_sum, rating_count,
+             stars_1, stars_2, stars_3, stars_4, stars_5, avg_rating)
+        SELECT
+            spots.id,
+            COALESCE(SUM(reviews.rating), 0),
+            COUNT(reviews.id),
+            COALESCE(SUM(reviews.rating = 1), 0),
+            COALESCE(SUM(reviews.rating = 2), 0),
+            COALESCE(SUM(reviews.rating = 3), 0),
+            COALESCE(SUM(reviews.rating = 4), 0),
+            COALESCE(SUM(reviews.rating = 5), 0),
+            ROUND(AVG(reviews.rating), 1)
+        FROM spots
+        LEFT JOIN reviews ON reviews.spot_id = spots.id
+        GROUP BY spots.id
+        """
+    )
+    # Rebuilding skips the per-row triggers, so tell the worker caches directly,
+    # and log every spot so they and the browsers' copies pick up the new ratings
+    db.execute("UPDATE data_versions SET version = version + 1 WHERE name = 'ratings'")
+    db.execute("INSERT OR REPLACE INTO spot_changes (spot_id) SELECT id FROM spots ORDER BY id")
+    # ... and rerank the leaderboards, which the same triggers keep in step
+    rebuild_leaderboard(db)
+
+
+def rebuild_leaderboard(db):
+    """Rerank every leaderboard from spot_stats."""
+    db.execute("DELETE FROM leaderboard")
+    db.execute(
+        """
+        INSERT INTO leaderboard (board, score, spot_id)
+        SELECT board, score, spot_id FROM leaderboard_entries
+        """
+    )
+
+
+def rebuild_rtree(db):
+    """Reload the spatial index from the spots coordinates."""
+    db.execute("DELETE FROM spots_rtree")
+    db.execute(
+        """
+        INSERT INTO spots_rtree
+        SELECT id, latitude, latitude, longitude, longitude
+        FROM spots
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        """
+    )
+
+
+def rebuild_search(db):
+    """Reindex every spot and every review in the full-text search tables."""
+    db.execute("DELETE FROM spots_fts")
+    db.execute(
+        """
+        INSERT INTO spots_fts (rowid, name, category, tags)
+        SELECT
+            spots.id,
+            spots.name,
+            spots.category,
+            TRIM(COALESCE(spots.cuisine, '') || ' ' || COALESCE(spots.brand, ''))
+        FROM spots
+        """
+    )
+    db.execute("INSERT INTO spots_fts (spots_fts) VALUES ('optimize')")
+    # reviews_fts reads the text from reviews itself
+    db.execute("INSERT INTO reviews_fts (reviews_fts) VALUES ('rebuild')")
+    db.execute("INSERT INTO reviews_fts (reviews_fts) VALUES ('optimize')")
+
+
+def rebuild_clusters(db):
+    """Recount the map clusters for every zoom level from the spot coordinates."""
+    db.execute("DELETE FROM spot_clusters")
+    db.execute(
+        """
+        INSERT INTO spot_clusters (zoom, cell_x, cell_y, spot_count, lat_sum, lon_sum)
+        SELECT
+            cluster_zooms.zoom,
+            CAST((spots.longitude + 180) * cluster_zooms.cells_per_degree AS INTEGER) AS cell_x,
+            CAST((spots.latitude + 90) * cluster_zooms.cells_per_degree AS INTEGER) AS cell_y,
+            COUNT(*),
+            SUM(spots.latitude),
+            SUM(spots.longitude)
+        FROM spots
+        CROSS JOIN cluster_zooms
+        WHERE spots.latitude IS NOT NULL AND spots.longitude IS NOT NULL
+        GROUP BY cluster_zooms.zoom, cell_x, cell_y
+        """
+    )
+
+
+# Every derived table that can be rebuilt, in the order "all" runs them
+REBUILDERS = {
+    "tags": rebuild_tags,
+    "stats": rebuild_stats,
+    "leaderboard": rebuild_leaderboard,
+    "rtree": rebuild_rtree,
+    "search": rebuild_search,
+    "clusters": rebuild_clusters,
+    "recommendations": rebuild_recommendations,
+    "changes": rebuild_changes,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild derived tables from the source data.")
+    parser.add_argument("target", choices=[*REBUILDERS, "all"])
+    parser.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args()
+
+    targets = list(REBUILDERS) if args.target == "all" else [args.target]
+
+    db = connect(args.db)
+    for name in targets:
+        start = time.perf_counter()
+        # Each rebuild runs in its own transaction so readers never see a half-built table
+        with db:
+            REBUILDERS[name](db)
+        print(f"Rebuilt {name} in {time.perf_counter() - start:.2f}s")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+"""Keep the "similar spots" and "for you" recommendation tables up to date.
+
+Usage: python recommend.py [--db spots.db] [update | rebuild]
+
+update folds the reviews and favorites queued since the last run into the
+tables (the app does this by itself a moment after each write, unless
+RECOMMEND_UPDATES is off, in which case run it from cron). rebuild recomputes
+everything from the reviews and favorites tables, the same as
+python rebuild.py recommendations.
+
+Updates are incremental: a new like adjusts the pair counts with the user's
+other recent likes, recomputes that spot's neighbours and slots it into each
+partner's list, and refreshes that user's suggestions. Other users' lists and
+the similarity of unrelated pairs drift slightly as like counts change, so run
+a rebuild now and then (nightly is plenty).
+"""
+import os
+import threading
+import time
+
+from flask import current_app
+
+from database import connect
+
+DB_PATH = "spots.db"
+
+DEFAULTS = {
+    "RECOMMEND_UPDATES": True,     # update the tables in a background thread after writes
+    "RECOMMEND_DELAY": 1.0,        # seconds to let writes queue up before updating
+}
+
+LIKED_RATING = 4           # reviews with at least this many stars count as a like
+MAX_USER_LIKES = 100       # only a user's most recent likes form pairs
+NEIGHBOURS = 20            # similar spots kept per spot
+USER_RECOMMENDATIONS = 20  # suggestions kept per user
+QUEUE_BATCH = 500          # queued changes applied per transaction
+
+# When (if at all) the user likes the spot now: their latest good review, or
+# now for a favorite, which has no date of its own
+LIKED_AT_SQL = f"""
+    SELECT MAX(liked_at) FROM (
+        SELECT COALESCE(MAX(created_at), CURRENT_TIMESTAMP) AS liked_at
+        FROM reviews
+        WHERE user_id = :user_id AND spot_id = :spot_id AND rating >= {LIKED_RATING}
+        HAVING COUNT(*) > 0
+        UNION ALL
+        SELECT CURRENT_TIMESTAMP FROM favorites WHERE user_id = :user_id AND spot_id = :spot_id
+    )
+"""
+
+
+def refresh_spot(db, spot_id):
+    """Recompute one spot's top NEIGHBOURS from its pair counts."""
+    db.execute("DELETE FROM similar_spots WHERE spot_id = ?", (spot_id,))
+    db.execute(
+        """
+        INSERT INTO similar_spots (spot_id, score, similar_id)
+        SELECT spot_id, score, similar_id FROM spot_similarity
+        WHERE spot_id = ?
+        ORDER BY score DESC, similar_id
+        LIMIT ?
+        """,
+        (spot_id, NEIGHBOURS),
+    )
+
+
+def refresh_pair(db, spot_id, other_id):
+    """Move other_id within spot_id's neighbours after their pair count went up."""
+    db.execute(
+        "DELETE FROM similar_spots WHERE spot_id = ? AND similar_id = ?", (spot_id, other_id)
+    )
+    db.execute(
+        """
+        INSERT INTO similar_spots (spot_id, score, similar_id)
+        SELECT spot_id, score, similar_id FROM spot_similarity
+        WHERE spot_id = ? AND similar_id = ?
+        """,
+        (spot_id, other_id),
+    )
+    db.execute(
+        """
+        DELETE FROM similar_spots
+        WHERE spot_id = :spot_id AND (score, similar_id) NOT IN (
+            SELECT score, similar_id FROM similar_spots
+            WHERE spot_id = :spot_id
+            ORDER BY score DESC, similar_id
+            LIMIT :limit
+        )
+        """,
+        {"spot_id": spot_id, "limit": NEIGHBOURS},
+    )
+
+
+def refresh_user(db, user_id):
+    """Recompute one user's suggestions: the neighbours of what they like, best first."""
+    db.execute("DELETE FROM recommendations WHERE user_id = ?", (user_id,))
+    db.execute(
+        """
+        INSERT INTO recommendations (user_id, score, spot_id)
+        SELECT :user_id, SUM(similar_spots.score) AS total, similar_spots.similar_id
+        FROM spot_likes
+        JOIN similar_spots ON similar_spots.spot_id = spot_likes.spot_id
+        WHERE spot_likes.user_id = :user_id
+          AND similar_spots.similar_id NOT IN (
+              SELECT spot_id FROM spot_likes WHERE user_id = :user_id
+          )
+        GROUP BY similar_spots.similar_id
+        ORDER BY total DESC, similar_spots.similar_id
+        LIMIT :limit
+        """,
+        {"user_id": user_id, "limit": USER_RECOMMENDATIONS},
+    )
+
+
+def apply_like(db, user_id, spot_id):
+    """Bring the tables in line with whether user_id likes spot_id now.
+
+    Returns the spots whose neighbours were recomputed, empty if nothing changed.
+    """
+    key = {"user_id": user_id, "spot_id": spot_id}
+    liked_at = db.execute(LIKED_AT_SQL, key).fetchone()[0]
+    was_liked = db.execute(
+        "SELECT 1 FROM spot_likes WHERE user_id = :user_id AND spot_id = :spot_id", key
+    ).fetchone() is not None
+    if (liked_at is not None) == was_liked:
+        return set()
+
+    # The pairs this like makes (or made) with the user's other recent likes
+    others = [row[0] for row in db.execute(
+        """
+        SELECT spot_id FROM spot_likes
+        WHERE user_id = ? AND spot_id != ?
+        ORDER BY liked_at DESC
+        LIMIT ?
+        """,
+        (user_id, spot_id, MAX_USER_LIKES - 1),
+    )]
+    if liked_at is not None:
+        delta = 1
+        db.execute(
+            "INSERT INTO spot_likes (user_id, spot_id, liked_at) VALUES (?, ?, ?)",
+            (user_id, spot_id, liked_at),
+        )
+    else:
+        delta = -1
+        db.execute("DELETE FROM spot_likes WHERE user_id = :user_id AND spot_id = :spot_id", key)
+
+    db.execute(
+        """
+        INSERT INTO spot_like_counts (spot_id, likes) VALUES (?, ?)
+        ON CONFLICT (spot_id) DO UPDATE SET likes = likes + excluded.likes
+        """,
+        (spot_id, delta),
+    )
+    db.executemany(
+        """
+        INSERT INTO spot_pairs (spot_id, other_id, together) VALUES (?, ?, ?)
+        ON CONFLICT (spot_id, other_id) DO UPDATE SET together = together + excluded.together
+        """,
+        [pair for other in others for pair in [(spot_id, other, delta), (other, spot_id, delta)]],
+    )
+    if delta < 0:
+        db.execute("DELETE FROM spot_like_counts WHERE spot_id = ? AND likes <= 0", (spot_id,))
+        db.executemany(
+            "DELETE FROM spot_pairs WHERE spot_id = ? AND other_id = ? AND together <= 0",
+            [pair for other in others for pair in [(spot_id, other), (other, spot_id)]],
+        )
+
+    refresh_spot(db, spot_id)
+    for other in others:
+        if delta > 0:
+            refresh_pair(db, other, spot_id)
+        else:
+            # A weaker pair may drop out of the list, so the next best has to be found
+            refresh_spot(db, other)
+    return {spot_id, *others}
+
+
+def bump_versions(db, names):
+    """Bump (or start) the data_versions counters of the pages these changes show on."""
+    db.executemany(
+        """
+        INSERT INTO data_versions (name, version) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1
+        """,
+        [(name,) for name in names],
+    )
+
+
+def update(db, batch=QUEUE_BATCH):
+    """Apply everything in recommendation_queue; returns how many entries it took."""
+    done = 0
+    while True:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            queued = db.execute(
+                "SELECT user_id, spot_id FROM recommendation_queue LIMIT ?", (batch,)
+            ).fetchall()
+            changed_users = set()
+            changed_spots = set()
+            for user_id, spot_id in queued:
+                spots = apply_like(db, user_id, spot_id)
+                if spots:
+                    changed_users.add(user_id)
+                    changed_spots |= spots
+            for user_id in changed_users:
+                refresh_user(db, user_id)
+            db.executemany(
+                "DELETE FROM recommendation_queue WHERE user_id = ? AND spot_id = ?",
+                [tuple(row) for row in queued],
+            )
+            # Only these users' "For You" lists and these spots' neighbours
+            # changed, so only their pages go stale
+            bump_versions(
+                db,
+                [f"recommendations:{user_id}" for user_id in sorted(changed_users)]
+                + [f"similar_spots:{spot_id}" for spot_id in sorted(changed_spots)],
+            )
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        done += len(queued)
+        if len(queued) < batch:
+            return done
+
+
+def rebuild_recommendations(db):
+    """Recompute likes, pair counts, neighbours and suggestions from scratch."""
+    for table in ["recommendation_queue", "spot_likes", "spot_like_counts", "spot_pairs",
+                  "similar_spots", "recommendations"]:
+        db.execute(f"DELETE FROM {table}")
+
+    db.execute(
+        f"""
+        INSERT INTO spot_likes (user_id, spot_id, liked_at)
+        SELECT likes.user_id, likes.spot_id, MAX(likes.liked_at)
+        FROM (
+            SELECT user_id, spot_id, COALESCE(created_at, CURRENT_TIMESTAMP) AS liked_at
+            FROM reviews
+            WHERE rating >= {LIKED_RATING} AND user_id IS NOT NULL
+            UNION ALL
+            SELECT user_id, spot_id, CURRENT_TIMESTAMP FROM favorites
+        ) AS likes
+        JOIN spots ON spots.id = likes.spot_id
+        GROUP BY likes.user_id, likes.spot_id
+        """
+    )
+
+    # Pairs and counts only use each user's MAX_USER_LIKES latest likes, as updates do
+    db.execute("DROP TABLE IF EXISTS temp.recent_likes")
+    db.execute(
+        """
+        CREATE TEMP TABLE recent_likes AS
+        SELECT user_id, spot_id FROM (
+            SELECT user_id, spot_id,
+                   ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY liked_at DESC, spot_id) AS n
+            FROM spot_likes
+        )
+        WHERE n <= ?
+        """,
+        (MAX_USER_LIKES,),
+    )
+    db.execute("CREATE INDEX temp.recent_likes_by_user ON recent_likes (user_id, spot_id)")
+    db.execute(
+        """
+        INSERT INTO spot_like_counts (spot_id, likes)
+        SELECT spot_id, COUNT(*) FROM recent_likes GROUP BY spot_id
+        """
+    )
+    db.execute(
+        """
+        INSERT INTO spot_pairs (spot_id, other_id, together)
+        SELECT mine.spot_id, theirs.spot_id, COUNT(*)
+        FROM recent_likes AS mine
+        JOIN recent_likes AS theirs
+          ON theirs.user_id = mine.user_id AND theirs.spot_id != mine.spot_id
+        GROUP BY mine.spot_id, theirs.spot_id
+        """
+    )
+    db.execute("DROP TABLE temp.recent_likes")
+
+    db.execute(
+        """
+        INSERT INTO similar_spots (spot_id, score, similar_id)
+        SELECT spot_id, score, similar_id FROM (
+            SELECT spot_id, score, similar_id,
+                   ROW_NUMBER() OVER (PARTITION BY spot_id ORDER BY score DESC, similar_id) AS n
+            FROM spot_similarity
+        )
+        WHERE n <= ?
+        """,
+        (NEIGHBOURS,),
+    )
+    db.execute(
+        """
+        INSERT INTO recommendations (user_id, score, spot_id)
+        SELECT user_id, total, spot_id FROM (
+            SELECT spot_likes.user_id,
+                   similar_spots.similar_id AS spot_id,
+                   SUM(similar_spots.score) AS total,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY spot_likes.user_id
+                       ORDER BY SUM(similar_spots.score) DESC, similar_spots.similar_id
+                   ) AS n
+            FROM spot_likes
+            JOIN similar_spots ON similar_spots.spot_id = spot_likes.spot_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM spot_likes AS liked
+                WHERE liked.user_id = spot_likes.user_id AND liked.spot_id = similar_spots.similar_id
+            )
+            GROUP BY spot_likes.user_id, similar_spots.similar_id
+        )
+        WHERE n <= ?
+        """,
+        (USER_RECOMMENDATIONS,),
+    )
+    # Every list may have changed; the per-user and per-spot counters are kept
+    # for the incremental updates
+    db.execute("UPDATE data_versions SET version = version + 1 WHERE name = 'recommendations'")
+
+
+def similar_spots(db, spot_id, limit=6):
+    """The spots most often liked by the people who like this one."""
+    return db.execute(
+        """
+        SELECT spots.id, spots.name, spots.category
+        FROM similar_spots
+        JOIN spots ON spots.id = similar_spots.similar_id
+        WHERE similar_spots.spot_id = ?
+        ORDER BY similar_spots.score DESC, similar_spots.similar_id
+        LIMIT ?
+        """,
+        (spot_id, limit),
+    ).fetchall()
+
+
+def recommended_spots(db, user_id, limit=10):
+    """Spots like the ones the user likes that they haven't liked yet."""
+    return db.execute(
+        """
+        SELECT spots.id, spots.name, spots.category
+        FROM recommendations
+        JOIN spots ON spots.id = recommendations.spot_id
+        WHERE recommendations.user_id = ?
+        ORDER BY recommendations.score DESC, recommendations.spot_id
+        LIMIT ?
+        """,
+        (user_id, limit),
+    ).fetchall()
+
+
+class Updater:
+    """Background thread that runs update() shortly after it is woken."""
+
+    def __init__(self, path, config, delay, logger):
+        self.path = path
+        self.config = config
+        self.delay = delay
+        self.logger = logger
+        self.pid = os.getpid()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="recommendations", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        db = connect(self.path, self.config)
+        while True:
+            self._wake.wait()
+            # Let a burst of writes queue up so they go in one batch
+            time.sleep(self.delay)
+            self._wake.clear()
+            try:
+                update(db)
+            except Exception:
+                self.logger.exception("Updating recommendations failed")
+
+
+_updaters = {}
+_updaters_lock = threading.Lock()
+
+
+def schedule_update():
+    """Have this process's updater thread fold in the queue shortly."""
+    app = current_app._get_current_object()
+    if not app.config["RECOMMEND_UPDATES"]:
+        return
+    updater = _updaters.get(app)
+    if updater is None or updater.pid != os.getpid():
+        with _updaters_lock:
+            updater = _updaters.get(app)
+            if updater is None or updater.pid != os.getpid():
+                updater = Updater(
+                    app.config["DATABASE"], app.config, app.config["RECOMMEND_DELAY"], app.logger
+                )
+                _updaters[app] = updater
+    updater.wake()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", nargs="?", choices=["update", "rebuild"], default="update")
+    parser.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args()
+
+    db = connect(args.db)
+    start = time.perf_counter()
+    if args.command == "update":
+        done = update(db)
+        print(f"Applied {done} queued change(s) in {time.perf_counter() - start:.2f}s")
+    else:
+        with db:
+            rebuild_recommendations(db)
+        print(f"Rebuilt recommendations in {time.perf_counter() - start:.2f}s")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
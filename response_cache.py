@@ -0,0 +1,116 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, make_response, request, session
+
+from database import data_version, get_db
+
+DEFAULTS = {
+    "RESPONSE_CACHE_SIZE": 256,   # rendered pages kept per worker
+    "RESPONSE_CACHE_TTL": 300,    # seconds before a page is rendered again regardless
+}
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+
+class CachedPage:
+    def __init__(self, versions, body, mimetype):
+        self.versions = versions
+        self.body = body
+        self.mimetype = mimetype
+        self.rendered_at = time.time()
+
+
+def _get(key, versions):
+    ttl = current_app.config["RESPONSE_CACHE_TTL"]
+    with _lock:
+        page = _entries.get(key)
+        if page is None:
+            return None
+        if page.versions != versions or time.time() - page.rendered_at > ttl:
+            del _entries[key]
+            return None
+        _entries.move_to_end(key)
+        return page
+
+
+def _put(key, page):
+    size = current_app.config["RESPONSE_CACHE_SIZE"]
+    with _lock:
+        _entries[key] = page
+        _entries.move_to_end(key)
+        while len(_entries) > size:
+            _entries.popitem(last=False)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+def cached(*depends_on, vary=None):
+    """Cache a GET view's rendered page until the data it shows changes.
+
+    depends_on names data_versions counters; "{user_id}" is filled in with the
+    logged-in user, e.g. "favorites:{user_id}", and other names in braces with
+    the view's URL arguments, e.g. "similar_spots:{spot_id}". The page is
+    cached per route, query string and user, and its ETag is derived from the
+    counters, so a revalidating browser gets a 304 without the view or
+    template running.
+    vary is an optional function whose result is added to the cache key, for
+    pages that also depend on something else, such as the time of day.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            user_id = session.get("user_id")
+            key = (
+                request.endpoint,
+                tuple(sorted(kwargs.items())),
+                tuple(sorted(request.args.items(multi=True))),
+                user_id,
+                bool(session.get("is_admin")),
+                vary() if vary else None,
+            )
+            names = [name.format(user_id=user_id, **kwargs) for name in depends_on]
+            versions = data_version(get_db(), *names)
+            etag = hashlib.blake2b(repr((key, versions)).encode(), digest_size=12).hexdigest()
+
+            page = _get(key, versions)
+            if request.if_none_match.contains_weak(etag) or (
+                page is not None
+                and not request.if_none_match
+                and request.if_modified_since is not None
+                and request.if_modified_since.timestamp() >= int(page.rendered_at)
+            ):
+                response = make_response("", 304)
+            elif page is not None:
+                response = make_response(page.body)
+                response.mimetype = page.mimetype
+            else:
+                response = make_response(view(*args, **kwargs))
+                # Only successful pages are cached; redirects and errors run every time
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                page = CachedPage(versions, response.get_data(), response.mimetype)
+                _put(key, page)
+
+            response.set_etag(etag)
+            if page is not None:
+                response.last_modified = page.rendered_at
+            response.headers["Cache-Control"] = "private, no-cache" if user_id else "no-cache"
+            response.vary.add("Cookie")
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
@@ -18,15 +18,45 @@ CREATE TABLE IF NOT EXISTS spots (
     latitude REAL,
     longitude REAL,
 
-    -- Food classification tags (1 = true)
+    -- Food classification tags, one bit per tag in tags.py (bit 0 = late_night, ...)
+    tag_bits INTEGER NOT NULL DEFAULT 0,
+
+    -- Original one-column-per-tag flags (1 = true). Superseded by tag_bits and
+    -- no longer read or written by the app; kept so old databases load unchanged.
     late_night INTEGER DEFAULT 0,
     fine_dining INTEGER DEFAULT 0,
     health_conscious INTEGER DEFAULT 0,
     affordable INTEGER DEFAULT 0,
     sweet_treat INTEGER DEFAULT 0,
-    close INTEGER DEFAULT 0            -- computed via distance to Harvard Yard
+    close INTEGER DEFAULT 0,           -- computed via distance to Harvard Yard
+
+    -- Extra OSM details used by search
+    cuisine TEXT,                      -- OSM cuisine tag, e.g. "thai" or "coffee_shop;donut"
+    brand TEXT,                        -- OSM brand tag, e.g. "Dunkin'"
+
+    -- Source element for spots loaded by import_spots.py (NULL for spots added by users)
+    osm_id TEXT,                       -- "node/480692709", "way/123", ...
+    osm_tags TEXT,                     -- all the element's OSM tags as JSON
+
+    -- OSM opening_hours and the week it describes (see opening_hours.py): 672
+    -- quarter-hour bits, Monday 00:00 first. NULL when missing or unparseable.
+    opening_hours TEXT,
+    hours BLOB,
+
+    -- Tag bits an admin unticked on the edit form; derived_tags.py never sets them
+    tags_removed INTEGER NOT NULL DEFAULT 0
 );
 
+-- Re-running the importer updates spots by osm_id instead of duplicating them
+CREATE UNIQUE INDEX IF NOT EXISTS spots_osm_id ON spots (osm_id);
+
+-- /spots lists spots alphabetically and pages through them by (name, id)
+CREATE INDEX IF NOT EXISTS spots_by_name ON spots (name);
+
+-- Sorting by distance reads located spots from spots_rtree, then these last
+CREATE INDEX IF NOT EXISTS spots_without_location ON spots (id)
+WHERE latitude IS NULL OR longitude IS NULL;
+
 -- REVIEWS TABLE ------------------------------------
 -- Stores user reviews for each spot
 CREATE TABLE IF NOT EXISTS reviews (
@@ -41,6 +71,10 @@ CREATE TABLE IF NOT EXISTS reviews (
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
 
+-- A spot's reviews in id order (spot page, search triggers) and a user's by date
+CREATE INDEX IF NOT EXISTS reviews_by_spot ON reviews (spot_id);
+CREATE INDEX IF NOT EXISTS reviews_by_user ON reviews (user_id, created_at);
+
 -- FAVORITES TABLE ----------------------------------
 -- Many-to-many: which users bookmarked which spots
 CREATE TABLE IF NOT EXISTS favorites (
@@ -51,3 +85,608 @@ CREATE TABLE IF NOT EXISTS favorites (
     FOREIGN KEY (user_id) REFERENCES users(id),
     FOREIGN KEY (spot_id) REFERENCES spots(id)
 );
+
+CREATE INDEX IF NOT EXISTS favorites_by_spot ON favorites (spot_id, user_id);
+
+-- SPOT STATS TABLE ---------------------------------
+-- Rating aggregates per spot, kept current by the triggers below so pages
+-- never have to run AVG/COUNT over the whole reviews table.
+-- Rebuild from scratch with: python rebuild.py stats
+CREATE TABLE IF NOT EXISTS spot_stats (
+    spot_id INTEGER PRIMARY KEY,
+    rating_sum INTEGER NOT NULL DEFAULT 0,
+    rating_count INTEGER NOT NULL DEFAULT 0,
+    stars_1 INTEGER NOT NULL DEFAULT 0,  -- histogram: number of 1★ reviews
+    stars_2 INTEGER NOT NULL DEFAULT 0,
+    stars_3 INTEGER NOT NULL DEFAULT 0,
+    stars_4 INTEGER NOT NULL DEFAULT 0,
+    stars_5 INTEGER NOT NULL DEFAULT 0,
+    avg_rating REAL,                     -- ROUND(rating_sum / rating_count, 1), NULL without reviews
+
+    FOREIGN KEY (spot_id) REFERENCES spots(id)
+);
+
+-- Top rated spots and the min rating filter read this index instead of aggregating
+CREATE INDEX IF NOT EXISTS spot_stats_by_rating
+    ON spot_stats (avg_rating DESC, rating_count DESC);
+
+CREATE TRIGGER IF NOT EXISTS spot_stats_spot_insert AFTER INSERT ON spots
+BEGIN
+    INSERT OR IGNORE INTO spot_stats (spot_id) VALUES (NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS spot_stats_spot_delete AFTER DELETE ON spots
+BEGIN
+    DELETE FROM spot_stats WHERE spot_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS spot_stats_review_insert AFTER INSERT ON reviews
+BEGIN
+    INSERT OR IGNORE INTO spot_stats (spot_id) VALUES (NEW.spot_id);
+    UPDATE spot_stats SET
+        rating_sum = rating_sum + NEW.rating,
+        rating_count = rating_count + 1,
+        stars_1 = stars_1 + (NEW.rating = 1),
+        stars_2 = stars_2 + (NEW.rating = 2),
+        stars_3 = stars_3 + (NEW.rating = 3),
+        stars_4 = stars_4 + (NEW.rating = 4),
+        stars_5 = stars_5 + (NEW.rating = 5),
+        avg_rating = ROUND(CAST(rating_sum + NEW.rating AS REAL) / (rating_count + 1), 1)
+    WHERE spot_id = NEW.spot_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS spot_stats_review_delete AFTER DELETE ON reviews
+BEGIN
+    UPDATE spot_stats SET
+        rating_sum = rating_sum - OLD.rating,
+        rating_count = rating_count - 1,
+        stars_1 = stars_1 - (OLD.rating = 1),
+        stars_2 = stars_2 - (OLD.rating = 2),
+        stars_3 = stars_3 - (OLD.rating = 3),
+        stars_4 = stars_4 - (OLD.rating = 4),
+        stars_5 = stars_5 - (OLD.rating = 5),
+        avg_rating = CASE
+            WHEN rating_count > 1
+            THEN ROUND(CAST(rating_sum - OLD.rating AS REAL) / (rating_count - 1), 1)
+        END
+    WHERE spot_id = OLD.spot_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS spot_stats_review_update AFTER UPDATE OF spot_id, rating ON reviews
+BEGIN
+    UPDATE spot_stats SET
+        rating_sum = rating_sum - OLD.rating,
+        rating_count = rating_count - 1,
+        stars_1 = stars_1 - (OLD.rating = 1),
+        stars_2 = stars_2 - (OLD.rating = 2),
+        stars_3 = stars_3 - (OLD.rating = 3),
+        stars_4 = stars_4 - (OLD.rating = 4),
+        stars_5 = stars_5 - (OLD.rating = 5),
+        avg_rating = CASE
+            WHEN rating_count > 1
+            THEN ROUND(CAST(rating_sum - OLD.rating AS REAL) / (rating_count - 1), 1)
+        END
+    WHERE spot_id = OLD.spot_id;
+    INSERT OR IGNORE INTO spot_stats (spot_id) VALUES (NEW.spot_id);
+    UPDATE spot_stats SET
+        rating_sum = rating_sum + NEW.rating,
+        rating_count = rating_count + 1,
+        stars_1 = stars_1 + (NEW.rating = 1),
+        stars_2 = stars_2 + (NEW.rating = 2),
+        stars_3 = stars_3 + (NEW.rating = 3),
+        stars_4 = stars_4 + (NEW.rating = 4),
+        stars_5 = stars_5 + (NEW.rating = 5),
+        avg_rating = ROUND(CAST(rating_sum + NEW.rating AS REAL) / (rating_count + 1), 1)
+    WHERE spot_id = NEW.spot_id;
+END;
+
+-- SPATIAL INDEX ------------------------------------
+-- R*Tree over spot coordinates (points stored as zero-size boxes) so map and
+-- "near me" queries only touch spots inside the requested area
+CREATE VIRTUAL TABLE IF NOT EXISTS spots_rtree USING rtree(
+    id,
+    min_lat, max_lat,
+    min_lon, max_lon
+);
+
+CREATE TRIGGER IF NOT EXISTS spots_rtree_insert AFTER INSERT ON spots
+WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL
+BEGIN
+    INSERT INTO spots_rtree VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+END;
+
+CREATE TRIGGER IF NOT EXISTS spots_rtree_update AFTER UPDATE OF latitude, longitude ON spots
+BEGIN
+    DELETE FROM spots_rtree WHERE id = OLD.id;
+    INSERT INTO spots_rtree
+        SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+        WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+END;
+
+CREATE TRIGGER IF NOT EXISTS spots_rtree_delete AFTER DELETE ON spots
+BEGIN
+    DELETE FROM spots_rtree WHERE id = OLD.id;
+END;
+
+-- FULL-TEXT SEARCH ---------------------------------
+-- One FTS5 row per spot (rowid = spots.id) holding its name, category and OSM
+-- cuisine/brand, and one row per review (rowid = reviews.id) in reviews_fts.
+-- Searches group the review matches by spot (search.py), so writing a review
+-- only indexes that review. Triggers keep both in sync;
+-- rebuild with: python rebuild.py search
+CREATE VIRTUAL TABLE IF NOT EXISTS spots_fts USING fts5(
+    name,
+    category,
+    tags,                              -- cuisine and brand
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'                     -- fast prefix matching for short search terms
+);
+
+CREATE TRIGGER IF NOT EXISTS spots_fts_insert AFTER INSERT ON spots
+BEGIN
+    INSERT INTO spots_fts (rowid, name, category, tags)
+    VALUES (NEW.id, NEW.name, NEW.category, TRIM(COALESCE(NEW.cuisine, '') || ' ' || COALESCE(NEW.brand, '')));
+END;
+
+CREATE TRIGGER IF NOT EXISTS spots_fts_update AFTER UPDATE OF name, category, cuisine, brand ON spots
+BEGIN
+    UPDATE spots_fts SET
+        name = NEW.name,
+        category = NEW.category,
+        tags = TRIM(COALESCE(NEW.cuisine, '') || ' ' || COALESCE(NEW.brand, ''))
+    WHERE rowid = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS spots_fts_delete AFTER DELETE ON spots
+BEGIN
+    DELETE FROM spots_fts WHERE rowid = OLD.id;
+END;
+
+-- External content: the text stays in reviews and only the index is stored
+-- here. FTS5 needs a deleted row's old text to remove its words.
+CREATE VIRTUAL TABLE IF NOT EXISTS reviews_fts USING fts5(
+    text,
+    content = 'reviews',
+    content_rowid = 'id',
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS reviews_fts_insert AFTER INSERT ON reviews
+BEGIN
+    INSERT INTO reviews_fts (rowid, text) VALUES (NEW.id, NEW.text);
+END;
+
+CREATE TRIGGER IF NOT EXISTS reviews_fts_delete AFTER DELETE ON reviews
+BEGIN
+    INSERT INTO reviews_fts (reviews_fts, rowid, text) VALUES ('delete', OLD.id, OLD.text);
+END;
+
+-- Moving a review to another spot needs nothing: searches look its spot up
+CREATE TRIGGER IF NOT EXISTS reviews_fts_update AFTER UPDATE OF text ON reviews
+WHEN OLD.text IS NOT NEW.text
+BEGIN
+    INSERT INTO reviews_fts (reviews_fts, rowid, text) VALUES ('delete', OLD.id, OLD.text);
+    INSERT INTO reviews_fts (rowid, text) VALUES (NEW.id, NEW.text);
+END;
+
+-- MAP CLUSTERS -------------------------------------
+-- Marker clusters for the map, precomputed for every zoom level. At zoom z a
+-- 256px map tile spans 360 / 2^z degrees; it is split into 4x4 grid cells of
+-- about 64px, and each cell stores how many spots fall in it and the sum of
+-- their coordinates (for the cluster's centre). Triggers on spots keep the
+-- counts current; rebuild with: python rebuild.py clusters
+CREATE TABLE IF NOT EXISTS cluster_zooms (
+    zoom INTEGER PRIMARY KEY,
+    cells_per_degree REAL NOT NULL     -- 4 * 2^zoom / 360
+);
+
+INSERT OR IGNORE INTO cluster_zooms (zoom, cells_per_degree) VALUES
+    (0, 4 / 360.0),
+    (1, 8 / 360.0),
+    (2, 16 / 360.0),
+    (3, 32 / 360.0),
+    (4, 64 / 360.0),
+    (5, 128 / 360.0),
+    (6, 256 / 360.0),
+    (7, 512 / 360.0),
+    (8, 1024 / 360.0),
+    (9, 2048 / 360.0),
+    (10, 4096 / 360.0),
+    (11, 8192 / 360.0),
+    (12, 16384 / 360.0),
+    (13, 32768 / 360.0),
+    (14, 65536 / 360.0),
+    (15, 131072 / 360.0),
+    (16, 262144 / 360.0);
+
+CREATE TABLE IF NOT EXISTS spot_clusters (
+    zoom INTEGER NOT NULL,
+    cell_x INTEGER NOT NULL,           -- (longitude + 180) * cells_per_degree
+    cell_y INTEGER NOT NULL,           -- (latitude + 90) * cells_per_degree
+    spot_count INTEGER NOT NULL,
+    lat_sum REAL NOT NULL,
+    lon_sum REAL NOT NULL,
+    PRIMARY KEY (zoom, cell_x, cell_y)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS spot_clusters_insert AFTER INSERT ON spots
+WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL
+BEGIN
+    INSERT INTO spot_clusters (zoom, cell_x, cell_y, spot_count, lat_sum, lon_sum)
+    SELECT
+        zoom,
+        CAST((NEW.longitude + 180) * cells_per_degree AS INTEGER),
+        CAST((NEW.latitude + 90) * cells_per_degree AS INTEGER),
+        1, NEW.latitude, NEW.longitude
+    FROM cluster_zooms WHERE true
+    ON CONFLICT (zoom, cell_x, cell_y) DO UPDATE SET
+        spot_count = spot_count + 1,
+        lat_sum = lat_sum + excluded.lat_sum,
+        lon_sum = lon_sum + excluded.lon_sum;
+END;
+
+CREATE TRIGGER IF NOT EXISTS spot_clusters_delete AFTER DELETE ON spots
+WHEN OLD.latitude IS NOT NULL AND OLD.longitude IS NOT NULL
+BEGIN
+    UPDATE spot_clusters SET
+        spot_count = spot_count - 1,
+        lat_sum = lat_sum - OLD.latitude,
+        lon_sum = lon_sum - OLD.longitude
+    WHERE (zoom, cell_x, cell_y) IN (
+        SELECT zoom,
+               CAST((OLD.longitude + 180) * cells_per_degree AS INTEGER),
+               CAST((OLD.latitude + 90) * cells_per_degree AS INTEGER)
+        FROM cluster_zooms
+    );
+    DELETE FROM spot_clusters
+    WHERE spot_count <= 0 AND (zoom, cell_x, cell_y) IN (
+        SELECT zoom,
+               CAST((OLD.longitude + 180) * cells_per_degree AS INTEGER),
+               CAST((OLD.latitude + 90) * cells_per_degree AS INTEGER)
+        FROM cluster_zooms
+    );
+END;
+
+-- A moved spot leaves its old cells (first trigger) and joins its new ones (second)
+CREATE TRIGGER IF NOT EXISTS spot_clusters_move_out AFTER UPDATE OF latitude, longitude ON spots
+WHEN OLD.latitude IS NOT NULL AND OLD.longitude IS NOT NULL
+BEGIN
+    UPDATE spot_clusters SET
+        spot_count = spot_count - 1,
+        lat_sum = lat_sum - OLD.latitude,
+        lon_sum = lon_sum - OLD.longitude
+    WHERE (zoom, cell_x, cell_y) IN (
+        SELECT zoom,
+               CAST((OLD.longitude + 180) * cells_per_degree AS INTEGER),
+               CAST((OLD.latitude + 90) * cells_per_degree AS INTEGER)
+        FROM cluster_zooms
+    );
+    DELETE FROM spot_clusters
+    WHERE spot_count <= 0 AND (zoom, cell_x, cell_y) IN (
+        SELECT zoom,
+               CAST((OLD.longitude + 180) * cells_per_degree AS INTEGER),
+               CAST((OLD.latitude + 90) * cells_per_degree AS INTEGER)
+        FROM cluster_zooms
+    );
+END;
+
+CREATE TRIGGER IF NOT EXISTS spot_clusters_move_in AFTER UPDATE OF latitude, longitude ON spots
+WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL
+BEGIN
+    INSERT INTO spot_clusters (zoom, cell_x, cell_y, spot_count, lat_sum, lon_sum)
+    SELECT
+        zoom,
+        CAST((NEW.longitude + 180) * cells_per_degree AS INTEGER),
+        CAST((NEW.latitude + 90) * cells_per_degree AS INTEGER),
+        1, NEW.latitude, NEW.longitude
+    FROM cluster_zooms WHERE true
+    ON CONFLICT (zoom, cell_x, cell_y) DO UPDATE SET
+        spot_count = spot_count + 1,
+        lat_sum = lat_sum + excluded.lat_sum,
+        lon_sum = lon_sum + excluded.lon_sum;
+END;
+
+-- LEADERBOARDS -------------------------------------
+-- Spots ranked by a Bayesian average: every spot starts with 5 imaginary
+-- 3-star reviews, so one 5-star review can't outrank a place with dozens of
+-- good ones. There is a board for all spots ('all'), one per category
+-- ('category:Cafe') and one per tag bit ('tag:0' = late_night, see tags.py).
+-- Only reviewed spots are ranked. Triggers move a spot's rows when its
+-- rating, category or tags change, so a review costs a few index updates and
+-- reading a top-N list is a short index scan however many spots there are.
+-- Rebuilt together with the stats: python rebuild.py stats
+CREATE TABLE IF NOT EXISTS leaderboard (
+    board TEXT NOT NULL,
+    score REAL NOT NULL,
+    spot_id INTEGER NOT NULL,
+    PRIMARY KEY (board, score DESC, spot_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS leaderboard_by_spot ON leaderboard (spot_id);
+
+-- Tag bits that get a board; keep in step with the bits used in tags.py
+CREATE TABLE IF NOT EXISTS tag_bit_numbers (
+    bit INTEGER PRIMARY KEY
+);
+
+INSERT OR IGNORE INTO tag_bit_numbers (bit) VALUES
+    (0), (1), (2), (3), (4), (5), (6), (7), (8), (9), (10), (11), (12), (13), (14), (15);
+
+-- Every board each spot belongs to
+CREATE VIEW IF NOT EXISTS spot_boards AS
+    SELECT id AS spot_id, 'all' AS board FROM spots
+    UNION ALL
+    SELECT id, 'category:' || category FROM spots WHERE category IS NOT NULL
+    UNION ALL
+    SELECT spots.id, 'tag:' || tag_bit_numbers.bit
+    FROM spots JOIN tag_bit_numbers ON spots.tag_bits >> tag_bit_numbers.bit & 1;
+
+-- Every spot's score, a Bayesian average that starts from 5 reviews of 3 stars;
+-- the one place the score formula lives
+CREATE VIEW IF NOT EXISTS spot_scores AS
+    SELECT
+        spots.id AS spot_id,
+        (COALESCE(spot_stats.rating_sum, 0) + 3.0 * 5)
+            / (COALESCE(spot_stats.rating_count, 0) + 5) AS score,
+        COALESCE(spot_stats.rating_count, 0) AS rating_count
+    FROM spots
+    LEFT JOIN spot_stats ON spot_stats.spot_id = spots.id;
+
+-- The rows the leaderboard should hold
+CREATE VIEW IF NOT EXISTS leaderboard_entries AS
+    SELECT spot_boards.board, spot_scores.score, spot_scores.spot_id
+    FROM spot_scores
+    JOIN spot_boards ON spot_boards.spot_id = spot_scores.spot_id
+    WHERE spot_scores.rating_count > 0;
+
+CREATE TRIGGER IF NOT EXISTS leaderboard_stats_update
+AFTER UPDATE OF rating_sum, rating_count ON spot_stats
+BEGIN
+    DELETE FROM leaderboard WHERE spot_id = NEW.spot_id;
+    INSERT INTO leaderboard (board, score, spot_id)
+        SELECT board, score, spot_id FROM leaderboard_entries WHERE spot_id = NEW.spot_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS leaderboard_spot_update AFTER UPDATE OF category, tag_bits ON spots
+BEGIN
+    DELETE FROM leaderboard WHERE spot_id = NEW.id;
+    INSERT INTO leaderboard (board, score, spot_id)
+        SELECT board, score, spot_id FROM leaderboard_entries WHERE spot_id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS leaderboard_spot_delete AFTER DELETE ON spots
+BEGIN
+    DELETE FROM leaderboard WHERE spot_id = OLD.id;
+END;
+
+-- DATA VERSIONS ------------------------------------
+-- Counters bumped by triggers whenever a kind of data changes. In-memory caches
+-- in each worker (tag filter bitsets, cached pages, ...) compare them to know
+-- when to reload. Per-user counters are named "reviews:<user_id>" and
+-- "favorites:<user_id>" and created on the user's first write.
+-- recommend.py keeps "recommendations:<user_id>" and "similar_spots:<spot_id>"
+-- for its incremental updates; "recommendations" only moves on a rebuild.
+CREATE TABLE IF NOT EXISTS data_versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+INSERT OR IGNORE INTO data_versions (name) VALUES ('spots'), ('ratings'), ('reviews'), ('recommendations');
+
+CREATE TRIGGER IF NOT EXISTS data_versions_spot_insert AFTER INSERT ON spots
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'spots';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_versions_spot_update AFTER UPDATE ON spots
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'spots';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_versions_spot_delete AFTER DELETE ON spots
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'spots';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_versions_rating_update AFTER UPDATE ON spot_stats
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'ratings';
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_versions_review_insert AFTER INSERT ON reviews
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'reviews';
+    INSERT INTO data_versions (name, version) VALUES ('reviews:' || NEW.user_id, 1)
+    ON CONFLICT (name) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_versions_review_update AFTER UPDATE ON reviews
+BEGIN
+    UPDATE data_versions SET version = version + 1
+    WHERE name IN ('reviews', 'reviews:' || OLD.user_id);
+    INSERT INTO data_versions (name, version) VALUES ('reviews:' || NEW.user_id, 1)
+    ON CONFLICT (name) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_versions_review_delete AFTER DELETE ON reviews
+BEGIN
+    UPDATE data_versions SET version = version + 1
+    WHERE name IN ('reviews', 'reviews:' || OLD.user_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_versions_favorite_insert AFTER INSERT ON favorites
+BEGIN
+    INSERT INTO data_versions (name, version) VALUES ('favorites:' || NEW.user_id, 1)
+    ON CONFLICT (name) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS data_versions_favorite_delete AFTER DELETE ON favorites
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'favorites:' || OLD.user_id;
+END;
+
+-- CHANGE LOG ---------------------------------------
+-- What changed in the spot list, for /api/changes: browsers keep a copy of
+-- every spot and ask only for what changed after the last seq they saw.
+-- A spot has at most one row, its latest change: the triggers delete the old
+-- one and AUTOINCREMENT gives the new one a seq higher than any before, so the
+-- log never holds more rows than spots plus deletions. (Not INSERT OR REPLACE:
+-- inside the importer's upsert, SQLite applies the upsert's conflict handling
+-- to the trigger's insert too, and it fails on the old row.) Rows for deleted
+-- spots (tombstones) are pruned after a while by changes.compact_changes, which
+-- raises spot_changes_floor; a client whose cursor is below the floor may have
+-- missed a deletion and starts over. Restart the log with:
+-- python rebuild.py changes
+CREATE TABLE IF NOT EXISTS spot_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    spot_id INTEGER NOT NULL UNIQUE,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS spot_changes_tombstones ON spot_changes (seq) WHERE deleted;
+
+CREATE TABLE IF NOT EXISTS spot_changes_floor (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    seq INTEGER NOT NULL
+);
+
+INSERT OR IGNORE INTO spot_changes_floor (id, seq) VALUES (1, 0);
+
+CREATE TRIGGER IF NOT EXISTS spot_changes_spot_insert AFTER INSERT ON spots
+BEGIN
+    DELETE FROM spot_changes WHERE spot_id = NEW.id;
+    INSERT INTO spot_changes (spot_id) VALUES (NEW.id);
+END;
+
+-- Only the fields clients keep; an import rewriting unchanged rows logs nothing
+CREATE TRIGGER IF NOT EXISTS spot_changes_spot_update
+AFTER UPDATE OF name, category, latitude, longitude, tag_bits ON spots
+WHEN OLD.name IS NOT NEW.name
+  OR OLD.category IS NOT NEW.category
+  OR OLD.latitude IS NOT NEW.latitude
+  OR OLD.longitude IS NOT NEW.longitude
+  OR OLD.tag_bits IS NOT NEW.tag_bits
+BEGIN
+    DELETE FROM spot_changes WHERE spot_id = NEW.id;
+    INSERT INTO spot_changes (spot_id) VALUES (NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS spot_changes_spot_delete AFTER DELETE ON spots
+BEGIN
+    DELETE FROM spot_changes WHERE spot_id = OLD.id;
+    INSERT INTO spot_changes (spot_id, deleted) VALUES (OLD.id, 1);
+END;
+
+CREATE TRIGGER IF NOT EXISTS spot_changes_rating_update
+AFTER UPDATE OF avg_rating, rating_count ON spot_stats
+WHEN (OLD.avg_rating IS NOT NEW.avg_rating OR OLD.rating_count != NEW.rating_count)
+  AND EXISTS (SELECT 1 FROM spots WHERE id = NEW.spot_id)
+BEGIN
+    DELETE FROM spot_changes WHERE spot_id = NEW.spot_id;
+    INSERT INTO spot_changes (spot_id) VALUES (NEW.spot_id);
+END;
+
+-- RECOMMENDATIONS ----------------------------------
+-- Item-item collaborative filtering over "likes": a favorite, or a review of 4
+-- stars or more. spot_pairs counts how many users like both of two spots and
+-- spot_similarity turns that into a cosine similarity (shrunk towards 0 when
+-- only a couple of users are behind it). The top neighbours of every spot and
+-- the top suggestions for every user are kept in similar_spots and
+-- recommendations, so pages read them with one short index scan.
+-- Reviews and favorites only queue the (user, spot) pairs they touch here;
+-- recommend.py folds the queue into the tables in batches, and rebuilds all
+-- of them from scratch with: python rebuild.py recommendations
+CREATE TABLE IF NOT EXISTS spot_likes (
+    user_id INTEGER NOT NULL,
+    spot_id INTEGER NOT NULL,
+    liked_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, spot_id)
+) WITHOUT ROWID;
+
+-- A user's likes, most recent first (only the latest few count towards pairs)
+CREATE INDEX IF NOT EXISTS spot_likes_by_user ON spot_likes (user_id, liked_at);
+
+CREATE TABLE IF NOT EXISTS spot_like_counts (
+    spot_id INTEGER PRIMARY KEY,
+    likes INTEGER NOT NULL
+);
+
+-- Stored both ways round, so a spot's partners are one range of the key
+CREATE TABLE IF NOT EXISTS spot_pairs (
+    spot_id INTEGER NOT NULL,
+    other_id INTEGER NOT NULL,
+    together INTEGER NOT NULL,
+    PRIMARY KEY (spot_id, other_id)
+) WITHOUT ROWID;
+
+CREATE VIEW IF NOT EXISTS spot_similarity AS
+    SELECT
+        spot_pairs.spot_id,
+        spot_pairs.other_id AS similar_id,
+        spot_pairs.together / sqrt(1.0 * mine.likes * theirs.likes)
+            * spot_pairs.together / (spot_pairs.together + 2.0) AS score
+    FROM spot_pairs
+    JOIN spot_like_counts AS mine ON mine.spot_id = spot_pairs.spot_id
+    JOIN spot_like_counts AS theirs ON theirs.spot_id = spot_pairs.other_id;
+
+CREATE TABLE IF NOT EXISTS similar_spots (
+    spot_id INTEGER NOT NULL,
+    score REAL NOT NULL,
+    similar_id INTEGER NOT NULL,
+    PRIMARY KEY (spot_id, score DESC, similar_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS recommendations (
+    user_id INTEGER NOT NULL,
+    score REAL NOT NULL,
+    spot_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, score DESC, spot_id)
+) WITHOUT ROWID;
+
+-- (user, spot) pairs whose like may have changed since recommend.py last ran
+CREATE TABLE IF NOT EXISTS recommendation_queue (
+    user_id INTEGER NOT NULL,
+    spot_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, spot_id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS recommendation_review_insert AFTER INSERT ON reviews
+WHEN NEW.user_id IS NOT NULL
+BEGIN
+    INSERT OR IGNORE INTO recommendation_queue (user_id, spot_id) VALUES (NEW.user_id, NEW.spot_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS recommendation_review_update AFTER UPDATE OF rating, user_id, spot_id ON reviews
+BEGIN
+    INSERT OR IGNORE INTO recommendation_queue (user_id, spot_id)
+    SELECT OLD.user_id, OLD.spot_id WHERE OLD.user_id IS NOT NULL
+    UNION ALL
+    SELECT NEW.user_id, NEW.spot_id WHERE NEW.user_id IS NOT NULL;
+END;
+
+CREATE TRIGGER IF NOT EXISTS recommendation_review_delete AFTER DELETE ON reviews
+WHEN OLD.user_id IS NOT NULL
+BEGIN
+    INSERT OR IGNORE INTO recommendation_queue (user_id, spot_id) VALUES (OLD.user_id, OLD.spot_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS recommendation_favorite_insert AFTER INSERT ON favorites
+BEGIN
+    INSERT OR IGNORE INTO recommendation_queue (user_id, spot_id) VALUES (NEW.user_id, NEW.spot_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS recommendation_favorite_delete AFTER DELETE ON favorites
+BEGIN
+    INSERT OR IGNORE INTO recommendation_queue (user_id, spot_id) VALUES (OLD.user_id, OLD.spot_id);
+END;
+
+-- SCHEMA VERSION -----------------------------------
+-- Which numbered migrations (migrations/NNNN_*.sql|py) this database has had;
+-- managed by migrate.py
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,125 @@
+import re
+import unicodedata
+
+from markupsafe import Markup, escape
+
+# snippet() wraps matches in these control characters; highlight() turns them
+# into <mark> tags only after the surrounding text has been HTML-escaped
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+# bm25 weights per spots_fts column: name, category, tags
+BM25_WEIGHTS = (10.0, 4.0, 4.0)
+
+# Review matches score REVIEW_WEIGHT * n / (n + REVIEW_SATURATION) for a spot
+# with n matching reviews, like bm25's term frequency part: more reviews
+# mentioning a word count for more, up to a limit.
+REVIEW_WEIGHT = 1.0
+REVIEW_SATURATION = 1.2
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def search_words(text):
+    """The words of what the user typed, or None if there is nothing to search."""
+    words = WORD_RE.findall(text or "")
+    return words or None
+
+
+def fts_term(word):
+    """FTS5 query for one word as a prefix, so "thai noo" finds reviews mentioning
+    noodles. Quoting it makes operators like OR, NEAR or * typed by the user plain text."""
+    return f'"{word}"*'
+
+
+def match_sql(words):
+    """(sql, params) for the spots matching every word, with their rank and a matching review.
+
+    A word matches a spot if it is in the spot's name, category or tags
+    (spots_fts) or in one of its reviews (reviews_fts, grouped by spot here).
+    The rank adds up bm25 for the spot's own text and the review score above;
+    lower is better, as with bm25. bm25 isn't worked out per review, which
+    for a common word would mean tens of thousands of them. review_id is the
+    newest review matching any word, for the snippet, or NULL if none does.
+    """
+    weights = ", ".join(str(weight) for weight in BM25_WEIGHTS)
+    hits = []
+    params = []
+    for number, word in enumerate(words):
+        hits.append(
+            f"""
+            SELECT rowid AS spot_id, {number} AS word, bm25(spots_fts, {weights}) AS rank,
+                   NULL AS review_id
+            FROM spots_fts WHERE spots_fts MATCH ?
+            UNION ALL
+            SELECT reviews.spot_id, {number},
+                   -{REVIEW_WEIGHT} * COUNT(*) / (COUNT(*) + {REVIEW_SATURATION}), MAX(reviews.id)
+            FROM reviews_fts JOIN reviews ON reviews.id = reviews_fts.rowid
+            WHERE reviews_fts MATCH ?
+            GROUP BY reviews.spot_id
+            """
+        )
+        params += [fts_term(word), fts_term(word)]
+    sql = f"""
+        SELECT spot_id, SUM(rank) AS rank, MAX(review_id) AS review_id
+        FROM ({" UNION ALL ".join(hits)})
+        GROUP BY spot_id
+        HAVING COUNT(DISTINCT word) = {len(words)}
+    """
+    return sql, params
+
+
+def spot_snippet_sql(words, tokens=12):
+    """(sql, params) for the snippets of the spots in a JSON array of ids that match
+    any of the words in their name, category or tags."""
+    sql = f"""
+        SELECT rowid AS id,
+               snippet(spots_fts, -1, '{MATCH_START}', '{MATCH_END}', '…', {int(tokens)}) AS snippet
+        FROM spots_fts
+        WHERE spots_fts MATCH ? AND rowid IN (SELECT value FROM json_each(?))
+    """
+    return sql, [" OR ".join(fts_term(word) for word in words)]
+
+
+def _fold(word):
+    """A token the way reviews_fts's tokenizer indexes it: lowercase, without accents."""
+    word = word.casefold()
+    if not word.isascii():
+        word = unicodedata.normalize("NFKD", word)
+        word = "".join(c for c in word if not unicodedata.combining(c))
+    return word
+
+
+def review_snippet(text, words, tokens=12):
+    """snippet() for a review's text, made here rather than by FTS5.
+
+    Every lookup of one review in reviews_fts reads the whole list of reviews
+    holding the word, which for a common word takes over a millisecond, while
+    the text itself is short. Shows the `tokens` words with the most matches,
+    marking each word that starts with one of the searched words.
+    """
+    prefixes = tuple(_fold(word) for word in words)
+    found = [(match.span(), _fold(match.group()).startswith(prefixes))
+             for match in WORD_RE.finditer(text or "")]
+    if not found:
+        return None
+    matched = [hit for _, hit in found]
+    first = max(range(max(len(found) - tokens, 0) + 1), key=lambda i: sum(matched[i:i + tokens]))
+    shown = found[first:first + tokens]
+    parts = ["…" if first > 0 else ""]
+    position = shown[0][0][0]
+    for (start, end), hit in shown:
+        parts.append(text[position:start])
+        parts.append(MATCH_START + text[start:end] + MATCH_END if hit else text[start:end])
+        position = end
+    end_of_text = first + tokens >= len(found)
+    parts.append(text[position:] if end_of_text else "…")
+    return "".join(parts)
+
+
+def highlight(snippet):
+    """Escape a snippet() result and mark the matched words with <mark>."""
+    if not snippet:
+        return ""
+    html = str(escape(snippet))
+    return Markup(html.replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>"))
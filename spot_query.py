@@ -0,0 +1,500 @@
+import base64
+import json
+import math
+
+from catalog import get_catalog
+from geo import EARTH_RADIUS_KM, bounding_box, haversine_km
+from opening_hours import requested_slot
+from search import highlight, match_sql, review_snippet, search_words, spot_snippet_sql
+from tag_index import get_tag_index
+from tags import TAG_KEYS, has_tag
+
+# Fields an /api/spots caller can ask for with ?fields=a,b,c
+FIELDS = [
+    "id",
+    "name",
+    "category",
+    "latitude",
+    "longitude",
+    "avg_rating",
+    "review_count",
+    "tag_bits",
+    *TAG_KEYS,
+    "distance",
+    "snippet",
+]
+
+# Sort key of the spots without coordinates, which go last when sorting by distance
+UNLOCATED_DISTANCE = 1e9
+
+# How results are ordered, and the outer-query expression used as the keyset sort key.
+# Every sort is made unique by id, so (sort_key, id) is a stable cursor.
+SORT_KEYS = {
+    "name": "name",
+    "distance": f"COALESCE(distance, {UNLOCATED_DISTANCE:g})",
+    "relevance": "rank",                     # bm25, lower is better
+}
+
+
+class BadCursor(ValueError):
+    pass
+
+
+class BadFilter(ValueError):
+    """A /spots filter that doesn't parse. The message names the parameter and
+    never repeats its value, so it can be shown to the user as it is."""
+
+
+def encode_cursor(sort, row):
+    data = json.dumps([sort, row["sort_key"], row["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(sort, cursor):
+    """Return (sort_key, id) from a cursor made by encode_cursor for the same sort."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_sort, key, spot_id = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise BadCursor("Invalid cursor")
+    if cursor_sort != sort:
+        raise BadCursor("Cursor belongs to a different sort order")
+    return key, spot_id
+
+
+def distance_origin(args):
+    """(lat, lon) to sort by distance from, or None to sort some other way."""
+    # "Sort by distance from me" - the browser sends the user's location
+    near_lat = args.get("lat", type=float)
+    near_lon = args.get("lon", type=float)
+    if args.get("sort") == "distance" and near_lat is not None and near_lon is not None:
+        return near_lat, near_lon
+    return None
+
+
+def parse_min_rating(args):
+    """The min_rating filter as a number, or None without one."""
+    text = args.get("min_rating")
+    if not text:
+        return None
+    try:
+        min_rating = float(text)
+    except ValueError:
+        min_rating = None
+    # NaN fails both comparisons
+    if min_rating is None or not 1 <= min_rating <= 5:
+        raise BadFilter("min_rating must be a number between 1 and 5")
+    return min_rating
+
+
+def matching_ids(db, args):
+    """Ids of the spots passing the tag, minimum rating and opening hours filters,
+    or None when none of those filters is set."""
+    # These are answered by the in-memory bitset index, which hands back the
+    # ids of the spots that pass all of them at once
+    min_rating = parse_min_rating(args)
+    checked_tags = [key for key in TAG_KEYS if args.get(key)]
+    try:
+        open_slot = requested_slot(args)
+    except ValueError as error:
+        # requested_slot's messages are fixed ones, one for each parameter
+        raise BadFilter(str(error))
+    if not (checked_tags or min_rating is not None or open_slot is not None):
+        return None
+    return get_tag_index(db).matching(checked_tags, min_rating, open_slot)
+
+
+# Distance pages search the R*Tree in a circle this big first, growing it
+# until the page is full; half the Earth's circumference covers it all
+DISTANCE_START_KM = 0.1
+DISTANCE_MAX_KM = EARTH_RADIUS_KM * math.pi
+
+
+def build_spot_query(db, args, box=None, skip_box=None, unlocated=False, candidates=None):
+    """Turn /spots query args into (sql, params, sort) for the filtered spot list.
+
+    The SQL selects every FIELDS column but snippet, plus rank and review_id;
+    callers wrap it to page through it, and add_snippets adds the snippets.
+    box limits it to the spots inside (min_lat, max_lat, min_lon, max_lon),
+    skip_box leaves out the ones inside a smaller box within it, and unlocated
+    limits it to the spots without coordinates.
+    candidates is matching_ids(db, args), for callers that have it already.
+    """
+    # Query parameters from the URL (search box)
+    q = args.get("q")
+    origin = distance_origin(args)
+    by_distance = origin is not None
+
+    # Base query selects spots and aggregated rating info
+    query = """
+        SELECT
+            spots.id,
+            spots.name,
+            spots.category,
+            spots.latitude,
+            spots.longitude,
+            spots.tag_bits,
+            spot_stats.avg_rating,
+            COALESCE(spot_stats.rating_count, 0) AS review_count,
+            {distance} AS distance,
+            {rank} AS rank,
+            {review} AS review_id
+        FROM {source}
+        LEFT JOIN spot_stats ON spot_stats.spot_id = spots.id
+    """
+
+    conditions = []
+    params = []
+
+    # Text search - full-text match on name, category, cuisine/brand and review text
+    search = search_words(q)
+
+    if by_distance:
+        distance_sql = "distance_km(spots.latitude, spots.longitude, ?, ?)"
+        params.extend(origin)
+    else:
+        distance_sql = "NULL"
+
+    if search:
+        match, match_params = match_sql(search)
+        query = query.format(
+            distance=distance_sql,
+            rank="matched.rank",
+            review="matched.review_id",
+            source=f"({match}) AS matched JOIN spots ON spots.id = matched.spot_id",
+        )
+        params.extend(match_params)
+    else:
+        query = query.format(distance=distance_sql, rank="NULL", review="NULL", source="spots")
+
+    # Tag, minimum rating and "open now/at" filters
+    if candidates is None:
+        candidates = matching_ids(db, args)
+    if candidates is not None:
+        conditions.append("spots.id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(candidates))
+
+    if box is not None and conditions:
+        # The search or filters find the spots; checking their coordinates is
+        # cheaper than listing every spot in the box
+        conditions.append("spots.latitude BETWEEN ? AND ? AND spots.longitude BETWEEN ? AND ?")
+        params.extend(box)
+    elif box is not None:
+        min_lat, max_lat, min_lon, max_lon = box
+        skip = ""
+        if skip_box is not None:
+            skip = "AND NOT (min_lat > ? AND max_lat < ? AND min_lon > ? AND max_lon < ?)"
+        conditions.append(
+            f"""
+            spots.id IN (
+                SELECT id FROM spots_rtree
+                WHERE min_lat <= ? AND max_lat >= ? AND min_lon <= ? AND max_lon >= ?
+                {skip}
+            )
+            """
+        )
+        params.extend([max_lat, min_lat, max_lon, min_lon])
+        if skip_box is not None:
+            params.extend(skip_box)
+
+    # Matches the partial index spots_without_location
+    if unlocated:
+        conditions.append("(spots.latitude IS NULL OR spots.longitude IS NULL)")
+
+    # If there are any filters, add a WHERE clause
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    # Order by distance, by search relevance, or alphabetically by name
+    if by_distance:
+        sort = "distance"
+    elif search:
+        sort = "relevance"
+    else:
+        sort = "name"
+
+    return query, params, sort
+
+
+def add_snippets(db, rows, args):
+    """A page's rows as dicts, with the search snippet of each (None without a search).
+
+    Only the page's rows get one, so a search matching thousands of spots
+    doesn't make thousands of snippets.
+    """
+    rows = [dict(row) for row in rows]
+    words = search_words(args.get("q"))
+    if not words:
+        for row in rows:
+            row["snippet"] = None
+        return rows
+
+    review_ids = [row["review_id"] for row in rows if row["review_id"] is not None]
+    texts = dict(db.execute(
+        "SELECT id, text FROM reviews WHERE id IN (SELECT value FROM json_each(?))",
+        (json.dumps(review_ids),),
+    ).fetchall())
+    spot_ids = [row["id"] for row in rows if row["review_id"] is None]
+    sql, params = spot_snippet_sql(words)
+    snippets = dict(db.execute(sql, params + [json.dumps(spot_ids)]).fetchall()) if spot_ids else {}
+    for row in rows:
+        if row["review_id"] is not None:
+            row["snippet"] = review_snippet(texts.get(row["review_id"]), words)
+        else:
+            row["snippet"] = snippets.get(row["id"])
+    return rows
+
+
+def spot_page(db, args, limit, cursor=None):
+    """One page of filtered spots plus the cursor for the next page (None on the last page).
+
+    Keyset pagination: instead of OFFSET, each page starts strictly after the
+    (sort_key, id) of the previous page's last row, so deep pages cost the same
+    as the first one and rows never shift between pages.
+
+    The plain name-ordered list (no search, no distance sort) is read from the
+    memory-mapped catalog when it is up to date, without running any SQL on spots.
+    """
+    if not search_words(args.get("q")) and distance_origin(args) is None:
+        catalog = get_catalog(db)
+        if catalog is not None:
+            return catalog_page(catalog, db, args, limit, cursor)
+
+    if distance_origin(args) is not None:
+        after = decode_cursor("distance", cursor) if cursor else None
+        rows = distance_rows(db, args, limit + 1, after)
+        next_cursor = encode_cursor("distance", rows[limit - 1]) if len(rows) > limit else None
+        return add_snippets(db, rows[:limit], args), next_cursor
+
+    query, params, sort = build_spot_query(db, args)
+    key = SORT_KEYS[sort]
+
+    paged = f"SELECT results.*, {key} AS sort_key FROM ({query}) AS results"
+    if cursor:
+        after_key, after_id = decode_cursor(sort, cursor)
+        paged += f" WHERE ({key}, id) > (?, ?)"
+        params = params + [after_key, after_id]
+    # Fetch one extra row to find out whether there is a next page
+    paged += f" ORDER BY {key}, id LIMIT ?"
+    params = params + [limit + 1]
+
+    rows = db.execute(paged, params).fetchall()
+    next_cursor = encode_cursor(sort, rows[limit - 1]) if len(rows) > limit else None
+    return add_snippets(db, rows[:limit], args), next_cursor
+
+
+def distance_rows(db, args, count, after=None):
+    """The next `count` spots by (distance, id) after the cursor key `after`.
+
+    Rather than working out the distance to every spot, this reads the spots
+    in a circle around the origin (through the R*Tree, unless a search or
+    filter picks the spots), like geo.nearest_spots.
+    Rows beyond the cursor and inside the circle are final, since every spot
+    outside it is further away; if there are fewer than `count` of them, the
+    circle grows by as much as the spots found so far suggest it must, and the
+    query runs again. Spots without coordinates come last, in id order,
+    through the spots_without_location index.
+    """
+    lat, lon = distance_origin(args)
+    key = SORT_KEYS["distance"]
+    after_key, after_id = after if after else (0, -1)
+    if not isinstance(after_key, (int, float)) or not isinstance(after_id, int):
+        raise BadCursor("Invalid cursor")
+
+    candidates = matching_ids(db, args)
+    rows = []
+    if after_key < UNLOCATED_DISTANCE:
+        # Later pages skip a box of spots that are all nearer than the cursor,
+        # so a deep page doesn't work out the distance to every spot before it
+        skip_box = None
+        if after_key > 0:
+            # A box that doesn't reach a pole or wrap around the Earth is
+            # nearest the origin inside and furthest away at its corners
+            skip_box = bounding_box(lat, lon, after_key * 0.7)
+            min_lat, max_lat, min_lon, max_lon = skip_box
+            corners = [(a, b) for a in (min_lat, max_lat) for b in (min_lon, max_lon)]
+            if (
+                min_lat <= -90 or max_lat >= 90 or min_lon <= -180 or max_lon >= 180
+                or max(haversine_km(lat, lon, a, b) for a, b in corners) >= after_key
+            ):
+                skip_box = None
+        reach = DISTANCE_START_KM
+        while True:
+            radius = min(after_key + reach, DISTANCE_MAX_KM)
+            box = bounding_box(lat, lon, radius)
+            if box[2] <= -180 and box[3] >= 180:
+                # A box around every longitude leaves out too little to be worth
+                # it, so go straight to the whole Earth
+                radius = DISTANCE_MAX_KM
+                box = None
+            query, params, _ = build_spot_query(
+                db, args, box=box, skip_box=skip_box, candidates=candidates
+            )
+            rows = db.execute(
+                f"""
+                SELECT results.*, {key} AS sort_key FROM ({query}) AS results
+                WHERE {key} <= ? AND ({key}, id) > (?, ?)
+                ORDER BY {key}, id
+                LIMIT ?
+                """,
+                params + [radius, after_key, after_id, count],
+            ).fetchall()
+            if len(rows) == count or radius >= DISTANCE_MAX_KM:
+                break
+            # Aim for twice the area the rows found so far say the page needs
+            reach *= min(16, max(2, math.sqrt(2 * count / max(len(rows), 1))))
+        after_id = -1
+
+    if len(rows) < count:
+        query, params, _ = build_spot_query(db, args, unlocated=True, candidates=candidates)
+        rows += db.execute(
+            f"""
+            SELECT results.*, {key} AS sort_key FROM ({query}) AS results
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+            """,
+            params + [after_id, count - len(rows)],
+        ).fetchall()
+    return rows
+
+
+def catalog_page(catalog, db, args, limit, cursor=None):
+    """spot_page for the name order, served from the catalog snapshot."""
+    after = None
+    if cursor:
+        after = decode_cursor("name", cursor)
+        if not isinstance(after[0], str):
+            raise BadCursor("Invalid cursor")
+    candidates = matching_ids(db, args)
+    rows = catalog.page_by_name(
+        limit + 1, after, None if candidates is None else set(candidates)
+    )
+    next_cursor = encode_cursor("name", rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def spot_fields(row, fields=FIELDS):
+    """JSON-ready dict with the requested fields of a spot_page row."""
+    spot = {}
+    for field in fields:
+        if field == "snippet":
+            spot["snippet"] = str(highlight(row["snippet"])) if row["snippet"] else None
+        elif field in TAG_KEYS:
+            spot[field] = has_tag(row["tag_bits"], field)
+        else:
+            spot[field] = row[field]
+    return spot
+
+
+def parse_fields(text):
+    """Validate ?fields=a,b,c against FIELDS; no fields means all of them."""
+    if not text:
+        return FIELDS
+    fields = [f.strip() for f in text.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in FIELDS]
+    if unknown:
+        raise ValueError("Unknown fields: " + ", ".join(unknown))
+    return fields
+
+
+# Most ids one /api/spots/batch call can ask for
+MAX_BATCH = 500
+
+# Stands in for "no cursor" in the review page's id < :before, so the same
+# index range scan serves the first page and the later ones
+NO_REVIEW_CURSOR = 2 ** 63 - 1
+
+
+def spot_with_reviews(db, spot_id, user_id, limit, before=None):
+    """The spot page in one query: (spot, reviews, cursor for the next reviews).
+
+    spot carries the rating stats and is_favorite for user_id; it is None if
+    there is no such spot. reviews are newest first, starting after the review
+    id `before` (keyset: id < before), and read through reviews_by_spot, so a
+    spot with thousands of reviews costs the same as one with none. Every row
+    repeats the spot's columns next to one review; the LEFT JOIN keeps one row
+    for a spot without any.
+    """
+    rows = db.execute(
+        """
+        SELECT
+            spots.id,
+            spots.name,
+            spots.category,
+            spots.latitude,
+            spots.longitude,
+            spots.tag_bits,
+            spot_stats.avg_rating,
+            COALESCE(spot_stats.rating_count, 0) AS review_count,
+            EXISTS (
+                SELECT 1 FROM favorites
+                WHERE favorites.user_id = :user_id AND favorites.spot_id = spots.id
+            ) AS is_favorite,
+            page.id AS review_id,
+            page.rating,
+            page.text,
+            users.username
+        FROM spots
+        LEFT JOIN spot_stats ON spot_stats.spot_id = spots.id
+        LEFT JOIN (
+            SELECT id, user_id, rating, text
+            FROM reviews
+            WHERE spot_id = :spot_id AND id < :before
+            ORDER BY id DESC
+            LIMIT :limit
+        ) AS page ON 1
+        LEFT JOIN users ON users.id = page.user_id
+        WHERE spots.id = :spot_id
+        ORDER BY page.id DESC
+        """,
+        {
+            "spot_id": spot_id,
+            "user_id": user_id,
+            "before": NO_REVIEW_CURSOR if before is None else before,
+            # One extra review to find out whether there is another page
+            "limit": limit + 1,
+        },
+    ).fetchall()
+    if not rows:
+        return None, [], None
+
+    reviews = [row for row in rows if row["review_id"] is not None]
+    next_cursor = reviews[limit - 1]["review_id"] if len(reviews) > limit else None
+    return rows[0], reviews[:limit], next_cursor
+
+
+def parse_ids(text):
+    """Spot ids from ?ids=1,2,3, without duplicates, in the order given."""
+    try:
+        ids = [int(part) for part in (text or "").split(",") if part.strip()]
+    except ValueError:
+        raise ValueError("ids must be a comma-separated list of spot ids")
+    if len(ids) > MAX_BATCH:
+        raise ValueError(f"At most {MAX_BATCH} ids at a time")
+    return list(dict.fromkeys(ids))
+
+
+def spot_summaries(db, spot_ids):
+    """Summary rows for many spots in one query, in the order of spot_ids.
+
+    Ids that don't exist (e.g. deleted spots) are left out.
+    """
+    return db.execute(
+        """
+        SELECT
+            spots.id,
+            spots.name,
+            spots.category,
+            spots.latitude,
+            spots.longitude,
+            spots.tag_bits,
+            spot_stats.avg_rating,
+            COALESCE(spot_stats.rating_count, 0) AS review_count
+        FROM json_each(?) AS wanted
+        JOIN spots ON spots.id = wanted.value
+        LEFT JOIN spot_stats ON spot_stats.spot_id = spots.id
+        ORDER BY wanted.key
+        """,
+        (json.dumps(spot_ids),),
+    ).fetchall()
@@ -0,0 +1,169 @@
+"""Get a newly started worker ready before its first requests instead of during them.
+
+Usage: python startup.py [--db spots.db]
+
+Hosts like PythonAnywhere recycle workers often, and a new worker used to do
+all its one-off work on the first requests it served: compile each Jinja
+template it rendered, read the hot pages of the database from disk, prepare
+the same SQL statements, build its in-memory indexes and start the password
+hashing processes.
+
+Compiled templates are kept in a bytecode cache on disk (TEMPLATE_CACHE_DIR),
+so a new worker loads a template's code instead of compiling its source; Jinja
+compares the source's checksum, so an edited template is compiled afresh.
+warm_up(app) does the rest of the work up front. Call it from the WSGI file,
+after importing the app and before the worker takes requests:
+
+    from app import app as application
+    from startup import warm_up
+    warm_up(application)
+
+Otherwise the first request a worker gets starts it in a background thread
+(STARTUP_WARM_UP). This script compiles every template into the cache, e.g.
+as a deploy step next to python assets.py build, and times a warm-up.
+"""
+import os
+import threading
+import time
+
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.datastructures import MultiDict
+
+from catalog import get_catalog
+from clusters import map_features
+from database import get_pool
+from leaderboard import top_spots
+from passwords import get_pool as get_hash_pool
+from spot_query import spot_page, spot_with_reviews
+from suggest import build_index
+from tag_index import get_tag_index
+
+DB_PATH = "spots.db"
+
+DEFAULTS = {
+    "TEMPLATE_CACHE_DIR": None,     # default: .jinja-cache next to app.py; "" turns it off
+    "STARTUP_WARM_UP": True,        # warm up in the background on a worker's first request
+}
+
+_warmed = {}
+_warmed_lock = threading.Lock()
+
+
+def compile_templates(app):
+    """Load every template, which compiles it into the bytecode cache if needed."""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def warm_queries(app):
+    """Run the read paths of the busiest pages once on a pooled connection.
+
+    That prepares their statements (the sqlite3 module keeps them per
+    connection), reads the pages they touch into SQLite's page cache and the
+    OS cache, and builds the worker's tag index and catalog mapping. The
+    connection goes back to the pool, and the LIFO pool hands it to the first
+    request. It is borrowed from the pool directly rather than through get_db,
+    so these queries don't show up in /metrics.
+    """
+    pool = get_pool(app)
+    db = pool.acquire()
+    try:
+        with app.app_context():
+            _run_hot_paths(app, db)
+    finally:
+        pool.release(db)
+
+
+def _run_hot_paths(app, db):
+    get_catalog(db)
+    get_tag_index(db)
+    build_index(app)
+    page_size = app.config["SPOTS_PAGE_SIZE"]
+    spot_page(db, MultiDict(), page_size)
+    spot_page(db, MultiDict({"q": "pizza"}), page_size)
+    best = top_spots(db, "all", 5)
+    if best:
+        spot_with_reviews(db, best[0]["id"], 0, app.config["REVIEWS_PAGE_SIZE"])
+    # The map's first view: the area around Harvard Square at the initial zoom
+    list(map_features(db, 14, 42.36, 42.39, -71.14, -71.08))
+
+
+def start_hash_pool(app):
+    get_hash_pool(app)
+
+
+def warm_up(app):
+    """Do a new worker's one-off work now; returns seconds taken per step."""
+    timings = {}
+    for name, step in [
+        ("templates", compile_templates),
+        ("queries", warm_queries),
+        ("hash_pool", start_hash_pool),
+    ]:
+        start = time.perf_counter()
+        try:
+            step(app)
+        except Exception:
+            # Warming up is only ever an optimization; the request path does the same work
+            app.logger.exception("Warm-up step %s failed", name)
+        timings[name] = time.perf_counter() - start
+    with _warmed_lock:
+        _warmed[app] = os.getpid()
+    return timings
+
+
+def start_warm_up():
+    """before_request hook: warm up this worker in the background if nothing has yet."""
+    app = current_app._get_current_object()
+    if not app.config["STARTUP_WARM_UP"] or _warmed.get(app) == os.getpid():
+        return
+    with _warmed_lock:
+        if _warmed.get(app) == os.getpid():
+            return
+        _warmed[app] = os.getpid()
+
+    def run():
+        timings = warm_up(app)
+        app.logger.info("Warmed up in %.2fs (%s)", sum(timings.values()),
+                        ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+
+    threading.Thread(target=run, name="warm-up", daemon=True).start()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    directory = app.config["TEMPLATE_CACHE_DIR"]
+    if directory is None:
+        directory = os.path.join(app.root_path, ".jinja-cache")
+    if directory:
+        try:
+            os.makedirs(directory, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+        except OSError as error:
+            app.logger.warning("No template bytecode cache in %s: %s", directory, error)
+    app.before_request(start_warm_up)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args()
+
+    from app import app  # app.py imports this module, so not at the top
+
+    app.config["DATABASE"] = args.db
+    start = time.perf_counter()
+    count = compile_templates(app)
+    print(f"Compiled {count} templates in {time.perf_counter() - start:.2f}s")
+    timings = warm_up(app)
+    print("Warm-up: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+// A copy of every spot kept in IndexedDB and brought up to date from
+// /api/changes, so a repeat visit downloads only the spots that changed.
+//
+// SpotSync.load() resolves to an array of spots ({id, name, category,
+// latitude, longitude, tag_bits, avg_rating, review_count}), or rejects if
+// the browser has no IndexedDB; callers then ask the server as before.
+const SpotSync = (function () {
+  const DB_NAME = "harvardeats";
+  const DB_VERSION = 1;
+  const SPOTS = "spots";
+  const META = "meta";
+
+  let loading = null;
+
+  function done(request) {
+    return new Promise(function (resolve, reject) {
+      request.onsuccess = function () { resolve(request.result); };
+      request.onerror = function () { reject(request.error); };
+    });
+  }
+
+  function finished(tx) {
+    return new Promise(function (resolve, reject) {
+      tx.oncomplete = function () { resolve(); };
+      tx.onerror = function () { reject(tx.error); };
+      tx.onabort = function () { reject(tx.error); };
+    });
+  }
+
+  function open() {
+    if (!window.indexedDB) {
+      return Promise.reject(new Error("IndexedDB is not available"));
+    }
+    const request = indexedDB.open(DB_NAME, DB_VERSION);
+    request.onupgradeneeded = function () {
+      const db = request.result;
+      db.createObjectStore(SPOTS, { keyPath: "id" });
+      db.createObjectStore(META);
+    };
+    return done(request);
+  }
+
+  // Apply one /api/changes page, and its cursor, in one transaction
+  function apply(db, page) {
+    const tx = db.transaction([SPOTS, META], "readwrite");
+    const spots = tx.objectStore(SPOTS);
+    if (page.reset) {
+      spots.clear();
+    }
+    page.changes.forEach(function (change) {
+      if (change.deleted) {
+        spots.delete(change.id);
+      } else {
+        spots.put(change);
+      }
+    });
+    tx.objectStore(META).put(page.cursor, "cursor");
+    return finished(tx);
+  }
+
+  function sync(db, cursor) {
+    return fetch("/api/changes?since=" + cursor)
+      .then(function (response) {
+        if (!response.ok) {
+          throw new Error("/api/changes returned " + response.status);
+        }
+        return response.json();
+      })
+      .then(function (page) {
+        return apply(db, page).then(function () {
+          return page.more ? sync(db, page.cursor) : null;
+        });
+      });
+  }
+
+  function load() {
+    if (!loading) {
+      loading = open().then(function (db) {
+        const tx = db.transaction(META, "readonly");
+        return done(tx.objectStore(META).get("cursor"))
+          .then(function (cursor) { return sync(db, cursor || 0); })
+          .then(function () {
+            return done(db.transaction(SPOTS, "readonly").objectStore(SPOTS).getAll());
+          });
+      });
+      // Let a later call try again
+      loading.catch(function () { loading = null; });
+    }
+    return loading;
+  }
+
+  return { load: load };
+})();
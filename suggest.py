@@ -0,0 +1,245 @@
+import bisect
+import functools
+import heapq
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+
+from flask import current_app
+
+from database import connect, data_version, get_db
+
+DEFAULTS = {
+    "SUGGEST_LIMIT": 8,               # suggestions returned per keystroke
+    "SUGGEST_CHECK_SECONDS": 1.0,     # how often a worker asks SQLite whether spots changed
+    "SUGGEST_MAX_AGE": 3600,          # rebuild this often anyway, to pick up rating changes
+}
+
+# A prefix matching more keys than this is answered from a list worked out at
+# build time instead of scanning its keys for the best spots
+SCAN_LIMIT = 500
+# How many spots those lists keep; requests can't ask for more
+MAX_LIMIT = 20
+
+_PUNCTUATION_RE = re.compile(r"[^\w]+")
+
+
+@functools.lru_cache(maxsize=4096)  # categories and cuisines repeat across many spots
+def normalize(text):
+    """Lowercase, without accents or punctuation: "Café Pamplona" -> "cafe pamplona"."""
+    text = text.casefold()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(c for c in text if not unicodedata.combining(c))
+    text = text.replace("'", "").replace("’", "").replace("_", " ")
+    return " ".join(_PUNCTUATION_RE.sub(" ", text).split())
+
+
+def word_suffixes(text):
+    """Every key a piece of text is found under: the whole of it, and from each later word on,
+    so "thai h" and "hut" both reach "Thai Hut"."""
+    words = normalize(text).split()
+    return [" ".join(words[i:]) for i in range(len(words))]
+
+
+class SuggestIndex:
+    """Spot names, categories and OSM cuisine/brand values as one sorted list of keys.
+
+    Spots are numbered best first (leaderboard score, then review count), and
+    each key remembers the spot it came from, so the best matches for a prefix
+    are the lowest numbers among the keys starting with it. Finding those keys
+    is a binary search. Prefixes that match more than SCAN_LIMIT keys, such as
+    a single letter, have their best spots worked out when the index is built.
+    """
+
+    def __init__(self, rows):
+        # rows: (id, name, category, cuisine, brand, avg_rating, review_count) best first
+        self.spots = [(row[0], row[1], row[2], row[5], row[6]) for row in rows]
+        entries = []
+        for position, (_, name, category, cuisine, brand, _, _) in enumerate(rows):
+            values = [(name, "name")]
+            if category:
+                values.append((category, "category"))
+            for value in (cuisine or "").split(";"):
+                if value.strip():
+                    values.append((value, "cuisine"))
+            if brand and normalize(brand) != normalize(name):
+                values.append((brand, "brand"))
+            for text, field in values:
+                for key in word_suffixes(text):
+                    entries.append((sys.intern(key), position, field))
+        entries.sort()
+        self.keys = [entry[0] for entry in entries]
+        self.positions = [entry[1] for entry in entries]
+        self.fields = [entry[2] for entry in entries]
+        self.hot = {}
+        self._precompute(0, len(self.keys), 1)
+
+    def _precompute(self, low, high, length):
+        """Store the best spots for every prefix of this length in keys[low:high]
+        that matches too many keys to scan, then do the same one character longer."""
+        start = low
+        while start < high:
+            # Keys shorter than the prefix come first in their group and can't extend it
+            if len(self.keys[start]) < length:
+                start += 1
+                continue
+            prefix = self.keys[start][:length]
+            end = bisect.bisect_left(self.keys, prefix + "\uffff", start, high)
+            if end - start > SCAN_LIMIT:
+                self.hot[prefix] = self._best(start, end, MAX_LIMIT)
+                self._precompute(start, end, length + 1)
+            start = end
+
+    def _best(self, low, high, limit):
+        """(position, field) of the best `limit` spots among keys[low:high], one per spot."""
+        best = heapq.nsmallest(limit, set(self.positions[low:high]))
+        # The field of the first key that brought each one in
+        return [(position, self.fields[self.positions.index(position, low, high)])
+                for position in best]
+
+    def suggest(self, query, limit):
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        best = self.hot.get(prefix)
+        if best is None:
+            low = bisect.bisect_left(self.keys, prefix)
+            high = bisect.bisect_left(self.keys, prefix + "\uffff", low)
+            best = self._best(low, high, limit)
+        results = []
+        for position, field in best[:limit]:
+            spot_id, name, category, avg_rating, review_count = self.spots[position]
+            results.append({
+                "id": spot_id,
+                "name": name,
+                "category": category,
+                "avg_rating": avg_rating,
+                "review_count": review_count,
+                "match": field,
+            })
+        return results
+
+    @classmethod
+    def load(cls, db):
+        rows = db.execute(
+            """
+            SELECT
+                spots.id, spots.name, spots.category, spots.cuisine, spots.brand,
+                spot_stats.avg_rating, COALESCE(spot_stats.rating_count, 0) AS review_count
+            FROM spots
+            LEFT JOIN spot_stats ON spot_stats.spot_id = spots.id
+            JOIN spot_scores ON spot_scores.spot_id = spots.id
+            ORDER BY spot_scores.score DESC, review_count DESC, spots.id
+            """
+        ).fetchall()
+        return cls([tuple(row) for row in rows])
+
+
+class Holder:
+    """A worker's current SuggestIndex, swapped for a new one built in the background."""
+
+    def __init__(self, path, config, logger):
+        self.path = path
+        self.config = config
+        self.logger = logger
+        self.pid = os.getpid()
+        self.index = None
+        self.version = None
+        self.built_at = 0.0
+        self.checked_at = 0.0
+        self._building = threading.Lock()
+
+    def build(self):
+        db = connect(self.path, self.config)
+        try:
+            # One read transaction, so the version matches what was loaded
+            db.execute("BEGIN")
+            version = data_version(db, "spots")
+            index = SuggestIndex.load(db)
+        finally:
+            db.close()
+        self.index, self.version, self.built_at = index, version, time.monotonic()
+
+    def rebuild_in_background(self):
+        if not self._building.acquire(blocking=False):
+            return  # already on it
+
+        def run():
+            try:
+                start = time.perf_counter()
+                self.build()
+                self.logger.info("Built the suggest index in %.2fs", time.perf_counter() - start)
+            except Exception:
+                self.logger.exception("Building the suggest index failed")
+            finally:
+                self._building.release()
+
+        threading.Thread(target=run, name="suggest", daemon=True).start()
+
+    def maybe_refresh(self):
+        """Start a rebuild if spots changed (checked at most every SUGGEST_CHECK_SECONDS)."""
+        now = time.monotonic()
+        if now - self.checked_at < self.config["SUGGEST_CHECK_SECONDS"]:
+            return
+        self.checked_at = now
+        if (data_version(get_db(), "spots") != self.version
+                or now - self.built_at > self.config["SUGGEST_MAX_AGE"]):
+            self.rebuild_in_background()
+
+
+_holders = {}
+_holders_lock = threading.Lock()
+
+
+def get_holder(app=None):
+    app = app or current_app._get_current_object()
+    holder = _holders.get(app)
+    if holder is None or holder.pid != os.getpid():
+        with _holders_lock:
+            holder = _holders.get(app)
+            if holder is None or holder.pid != os.getpid():
+                holder = Holder(app.config["DATABASE"], app.config, app.logger)
+                _holders[app] = holder
+    return holder
+
+
+def suggestions(query, limit):
+    """Spots whose name, category, cuisine or brand has a word starting with query.
+
+    Most calls never touch SQLite: only when the last check is more than
+    SUGGEST_CHECK_SECONDS old is the database asked whether spots have changed.
+    While a rebuild runs the previous index keeps answering.
+    """
+    limit = max(1, min(limit, MAX_LIMIT))
+    holder = get_holder()
+    if holder.index is None:
+        build_index()
+    else:
+        holder.maybe_refresh()
+    return holder.index.suggest(query, limit)
+
+
+def build_index(app=None):
+    """Build this worker's index now unless it has one (startup.warm_up calls this)."""
+    holder = get_holder(app)
+    if holder.index is None:
+        with holder._building:
+            if holder.index is None:
+                holder.build()
+
+
+def start_building():
+    """before_request hook: build the index in the background as soon as the worker starts serving."""
+    holder = get_holder()
+    if holder.index is None:
+        holder.rebuild_in_background()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.before_request(start_building)
@@ -0,0 +1,161 @@
+import bisect
+import threading
+from array import array
+
+from changes import last_seq
+from database import data_version
+from opening_hours import from_blob
+from tags import TAGS
+
+# Positions of the set bits in every possible byte, for turning a bitset back into ids
+_BYTE_BITS = [[bit for bit in range(8) if value >> bit & 1] for value in range(256)]
+
+
+class TagIndex:
+    """Every spot's tags and rating held as bitsets, for filtering without SQL.
+
+    Spots are numbered by position in id order. Each tag is a Python int whose
+    bit i is set when spot i has the tag, so a filter on several tags is a
+    chain of big-int ANDs done in C. Ratings are rounded to one decimal, so
+    there is one bitset per rating too, and "rating >= x" ORs the few at or
+    above x. A new review moves its spot from one rating's bitset to another's
+    (apply_ratings) instead of reloading the index, which only happens when
+    spots change. Opening hours work the same way as tags: the set of spots
+    open in a given quarter hour is one more bitset, worked out the first time
+    that quarter hour is asked about.
+    """
+
+    def __init__(self, rows, changes_seq=0):
+        # rows: (id, tag_bits, avg_rating, hours blob) sorted by id
+        rows = list(rows)
+        self.size = len(rows)
+        self.ids = array("q", (row[0] for row in rows))
+        # The change log entry the ratings are current up to (see apply_ratings)
+        self.changes_seq = changes_seq
+
+        # Each spot's week as an int (bit = quarter hour), 0 when its hours are unknown
+        self._hours = [from_blob(row[3]) or 0 for row in rows]
+        self._open_sets = {}
+        self._open_lock = threading.Lock()
+
+        # Set bits in a bytearray per tag and per rating, then turn each into one big int
+        tag_bytes = [bytearray((self.size + 7) // 8) for _ in TAGS]
+        rating_bytes = {}
+        self._ratings = [row[2] for row in rows]
+        for position, row in enumerate(rows):
+            bits = row[1]
+            if bits:
+                for i, tag in enumerate(TAGS):
+                    if bits >> tag.bit & 1:
+                        tag_bytes[i][position >> 3] |= 1 << (position & 7)
+            if row[2] is not None:
+                if row[2] not in rating_bytes:
+                    rating_bytes[row[2]] = bytearray((self.size + 7) // 8)
+                rating_bytes[row[2]][position >> 3] |= 1 << (position & 7)
+        self._tag_sets = {
+            tag.key: int.from_bytes(tag_bytes[i], "little") for i, tag in enumerate(TAGS)
+        }
+        self._rating_sets = {
+            rating: int.from_bytes(data, "little") for rating, data in rating_bytes.items()
+        }
+
+    @classmethod
+    def load(cls, db):
+        # Read before the spots, so a rating changed in between is applied again later
+        changes_seq = last_seq(db)
+        rows = db.execute(
+            """
+            SELECT spots.id, spots.tag_bits, spot_stats.avg_rating, spots.hours
+            FROM spots
+            LEFT JOIN spot_stats ON spot_stats.spot_id = spots.id
+            ORDER BY spots.id
+            """
+        ).fetchall()
+        return cls((tuple(row) for row in rows), changes_seq)
+
+    def apply_ratings(self, db):
+        """Bring the ratings up to date from the spot change log."""
+        changes_seq = last_seq(db)
+        rows = db.execute(
+            """
+            SELECT spot_changes.spot_id, spot_stats.avg_rating
+            FROM spot_changes
+            JOIN spot_stats ON spot_stats.spot_id = spot_changes.spot_id
+            WHERE spot_changes.seq > ?
+            """,
+            (self.changes_seq,),
+        ).fetchall()
+        # Readers keep using the old dict until the new one is complete
+        rating_sets = dict(self._rating_sets)
+        for spot_id, rating in rows:
+            position = bisect.bisect_left(self.ids, spot_id)
+            if position == self.size or self.ids[position] != spot_id:
+                continue  # a new spot, which reloads the whole index anyway
+            old = self._ratings[position]
+            if old == rating:
+                continue
+            bit = 1 << position
+            if old is not None:
+                rating_sets[old] &= ~bit
+            if rating is not None:
+                rating_sets[rating] = rating_sets.get(rating, 0) | bit
+            self._ratings[position] = rating
+        self._rating_sets = rating_sets
+        self.changes_seq = changes_seq
+
+    def open_at(self, slot):
+        """Bitset of the spots open during week slot (see opening_hours.py)."""
+        spots = self._open_sets.get(slot)
+        if spots is None:
+            # One pass over every spot's week picks out this slot's bit; the
+            # digits are written highest position first for int(..., 2)
+            digits = "".join("1" if hours >> slot & 1 else "0" for hours in reversed(self._hours))
+            spots = int(digits or "0", 2)
+            with self._open_lock:
+                self._open_sets[slot] = spots
+        return spots
+
+    def matching(self, tag_keys=(), min_rating=None, open_slot=None):
+        """Ids of spots that have every tag in tag_keys, at least min_rating and
+        (if open_slot is given) are open then."""
+        mask = (1 << self.size) - 1
+        for key in tag_keys:
+            mask &= self._tag_sets[key]
+        if min_rating is not None:
+            rated = 0
+            for rating, spots in self._rating_sets.items():
+                if rating >= min_rating:
+                    rated |= spots
+            mask &= rated
+        if open_slot is not None:
+            mask &= self.open_at(open_slot)
+        return self._ids_for(mask)
+
+    def _ids_for(self, mask):
+        ids = self.ids
+        found = []
+        for byte_index, byte in enumerate(mask.to_bytes((self.size + 7) // 8, "little")):
+            if byte:
+                base = byte_index * 8
+                found.extend(ids[base + bit] for bit in _BYTE_BITS[byte])
+        return found
+
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def get_tag_index(db):
+    """This worker's TagIndex: reloaded when a spot has changed, and its
+    ratings updated in place when only ratings have."""
+    global _index, _index_version
+    version = data_version(db, "spots", "ratings")
+    if _index is None or version != _index_version:
+        with _index_lock:
+            if _index is None or version[0] != _index_version[0]:
+                _index = TagIndex.load(db)
+            elif version != _index_version:
+                _index.apply_ratings(db)
+            _index_version = version
+    return _index
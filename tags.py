@@ -0,0 +1,46 @@
+from collections import namedtuple
+
+# Food classification tags. Each tag is one bit of spots.tag_bits, so adding a
+# tag only means adding a line here with the next free bit - no schema change,
+# and every form, filter and template picks it up from this list.
+# Never reuse or renumber a bit: existing spots store them. Bits past 15 also
+# need rows in tag_bit_numbers (schema.sql) to get a leaderboard.
+# Computed tags are worked out by the app, so the add spot form doesn't offer them.
+Tag = namedtuple("Tag", ["key", "label", "bit", "computed"], defaults=[False])
+
+TAGS = [
+    Tag("late_night", "Late Night", 0),
+    Tag("fine_dining", "Fine Dining", 1),
+    Tag("health_conscious", "Health Conscious", 2),
+    Tag("affordable", "Affordable", 3),
+    Tag("sweet_treat", "Sweet Treat", 4),
+    Tag("close", "Close to Harvard Yard", 5, computed=True),
+]
+
+TAGS_BY_KEY = {tag.key: tag for tag in TAGS}
+
+TAG_KEYS = [tag.key for tag in TAGS]
+
+COMPUTED_BITS = sum(1 << tag.bit for tag in TAGS if tag.computed)
+
+
+def tag_mask(keys):
+    """Bitmask with the bits of the given tag keys set."""
+    mask = 0
+    for key in keys:
+        mask |= 1 << TAGS_BY_KEY[key].bit
+    return mask
+
+
+def tags_from_form(form):
+    """Bitmask for the tag checkboxes that are ticked in a form or query string."""
+    return tag_mask(tag.key for tag in TAGS if form.get(tag.key))
+
+
+def has_tag(bits, key):
+    return bool((bits or 0) >> TAGS_BY_KEY[key].bit & 1)
+
+
+def tag_labels(bits):
+    """Labels of the tags set in bits, in TAGS order."""
+    return [tag.label for tag in TAGS if (bits or 0) >> tag.bit & 1]
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from database import connect  # noqa: E402
+from migrate import migrate  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """A fresh database with the full schema."""
+    connection = connect(str(tmp_path / "spots.db"))
+    migrate(connection, schema_path=os.path.join(ROOT, "schema.sql"))
+    yield connection
+    connection.close()
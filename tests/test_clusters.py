@@ -0,0 +1,34 @@
+from clusters import map_features
+
+ZOOM = 16
+
+
+def test_single_spot_cells_on_either_side_of_an_edge(db):
+    cells_per_degree = db.execute(
+        "SELECT cells_per_degree FROM cluster_zooms WHERE zoom = ?", (ZOOM,)
+    ).fetchone()[0]
+    # A cell edge near Harvard Square, with one spot a hair to each side of it:
+    # closer than float32 can tell apart, so the R*Tree boxes of both spots
+    # overlap both cells
+    cell_x = int((-71.1190 + 180) * cells_per_degree)
+    edge = cell_x / cells_per_degree - 180
+    spots = {"West": edge - 1e-9, "East": edge + 1e-9}
+    for name, longitude in spots.items():
+        db.execute(
+            "INSERT INTO spots (name, category, latitude, longitude) VALUES (?, 'Cafe', 42.3736, ?)",
+            (name, longitude),
+        )
+    db.commit()
+    cells = {
+        int((longitude + 180) * cells_per_degree) for longitude in spots.values()
+    }
+    assert len(cells) == 2
+
+    features = list(map_features(db, ZOOM, 42.37, 42.38, -71.13, -71.11))
+
+    found = {
+        feature["properties"]["name"]: feature["geometry"]["coordinates"][0]
+        for feature in features
+    }
+    assert len(features) == 2
+    assert found == spots
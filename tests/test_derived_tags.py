@@ -0,0 +1,39 @@
+import json
+
+from derived_tags import derive_tags
+from tags import tag_mask
+
+
+def add_spot(db, name, latitude, longitude, osm_tags, tag_bits=0, tags_removed=0):
+    cursor = db.execute(
+        """
+        INSERT INTO spots (name, category, latitude, longitude, osm_tags, tag_bits, tags_removed)
+        VALUES (?, 'Restaurant', ?, ?, ?, ?, ?)
+        """,
+        (name, latitude, longitude, json.dumps(osm_tags), tag_bits, tags_removed),
+    )
+    return cursor.lastrowid
+
+
+def tag_bits(db, spot_id):
+    return db.execute("SELECT tag_bits FROM spots WHERE id = ?", (spot_id,)).fetchone()[0]
+
+
+def test_unticked_tags_stay_off_and_ticked_tags_stay_on(db):
+    ice_cream = {"amenity": "ice_cream"}
+    derived = add_spot(db, "Derived", 42.3750, -71.1170, ice_cream)
+    unticked = add_spot(
+        db, "Unticked", 42.3750, -71.1170, ice_cream,
+        tags_removed=tag_mask(["sweet_treat"]),
+    )
+    far = add_spot(
+        db, "Far", 42.4000, -71.1170, {"amenity": "restaurant"},
+        tag_bits=tag_mask(["fine_dining", "close"]),
+    )
+
+    assert derive_tags(db) == 3
+
+    assert tag_bits(db, derived) == tag_mask(["sweet_treat", "close"])
+    assert tag_bits(db, unticked) == tag_mask(["close"])
+    assert tag_bits(db, far) == tag_mask(["fine_dining"])
+    assert derive_tags(db) == 0
@@ -0,0 +1,50 @@
+from import_spots import import_elements
+
+ELEMENT = {
+    "type": "node",
+    "id": 42,
+    "lat": 42.3736,
+    "lon": -71.119,
+    "tags": {"name": "Pinocchio's", "amenity": "restaurant", "cuisine": "pizza"},
+}
+
+
+def add_legacy_spot(db):
+    """A row as the old importer wrote it, without osm_id."""
+    return db.execute(
+        "INSERT INTO spots (name, category, latitude, longitude) VALUES (?, 'Restaurant', ?, ?)",
+        (ELEMENT["tags"]["name"], ELEMENT["lat"], ELEMENT["lon"]),
+    ).lastrowid
+
+
+def test_duplicated_legacy_rows_are_adopted_once_and_merged(db):
+    db.executemany(
+        "INSERT INTO users (id, email, username, hash) VALUES (?, ?, ?, 'x')",
+        [(1, "a@college.harvard.edu", "a"), (2, "b@college.harvard.edu", "b")],
+    )
+    # The old importer ran twice, and people used both copies
+    first, second = add_legacy_spot(db), add_legacy_spot(db)
+    db.execute("INSERT INTO reviews (spot_id, user_id, rating, text) VALUES (?, 1, 5, 'great')", (first,))
+    db.execute("INSERT INTO reviews (spot_id, user_id, rating, text) VALUES (?, 2, 3, 'fine')", (second,))
+    db.executemany(
+        "INSERT INTO favorites (user_id, spot_id) VALUES (?, ?)",
+        [(1, first), (1, second), (2, second)],
+    )
+    db.commit()
+
+    result = import_elements(db, [ELEMENT], progress_every=0)
+
+    assert result["merged"] == 1
+    assert result["inserted"] == 0
+    spots = db.execute("SELECT id, osm_id FROM spots").fetchall()
+    assert [tuple(row) for row in spots] == [(first, "node/42")]
+    reviews = db.execute("SELECT spot_id, rating FROM reviews ORDER BY rating").fetchall()
+    assert [tuple(row) for row in reviews] == [(first, 3), (first, 5)]
+    favorites = db.execute("SELECT user_id, spot_id FROM favorites ORDER BY user_id").fetchall()
+    assert [tuple(row) for row in favorites] == [(1, first), (2, first)]
+    stats = db.execute("SELECT rating_count, avg_rating FROM spot_stats WHERE spot_id = ?", (first,)).fetchone()
+    assert tuple(stats) == (2, 4.0)
+
+    # Importing again finds the adopted row and changes nothing
+    again = import_elements(db, [ELEMENT], progress_every=0)
+    assert (again["inserted"], again["merged"]) == (0, 0)
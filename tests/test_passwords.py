@@ -0,0 +1,20 @@
+import time
+
+import pytest
+
+from passwords import HashingUnavailable, HashPool
+
+
+def test_timed_out_hashes_keep_their_slots_until_they_finish():
+    pool = HashPool(workers=1, limit=2, timeout=0.2)
+
+    # Both time out, the second still waiting behind the first
+    for seconds in (0.6, 0):
+        with pytest.raises(HashingUnavailable):
+            pool.run(time.sleep, seconds)
+    # Both are still running or queued, so they still hold the two slots
+    with pytest.raises(HashingUnavailable, match="Too many"):
+        pool.run(abs, -3)
+
+    time.sleep(0.8)
+    assert pool.run(abs, -3) == 3
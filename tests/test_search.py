@@ -0,0 +1,41 @@
+from werkzeug.datastructures import MultiDict
+
+from search import MATCH_END, MATCH_START
+from spot_query import spot_page
+
+
+def search(db, text):
+    rows, _ = spot_page(db, MultiDict({"q": text}), 20)
+    return {row["name"]: row["snippet"] for row in rows}
+
+
+def test_reviews_are_indexed_one_row_each(db):
+    user_id = db.execute(
+        "INSERT INTO users (email, username, hash) VALUES ('a@college.harvard.edu', 'a', 'x')"
+    ).lastrowid
+    spot_ids = {}
+    for name in ("Thai Hut", "Pho Place"):
+        spot_ids[name] = db.execute(
+            "INSERT INTO spots (name, category, cuisine) VALUES (?, 'Restaurant', 'thai')", (name,)
+        ).lastrowid
+    review_id = db.execute(
+        "INSERT INTO reviews (user_id, spot_id, rating, text) VALUES (?, ?, 5, 'Great noodles, slow service')",
+        (user_id, spot_ids["Thai Hut"]),
+    ).lastrowid
+    db.commit()
+
+    # Every word must match, in the spot's own text or in one of its reviews
+    assert search(db, "thai noo") == {
+        "Thai Hut": f"Great {MATCH_START}noodles{MATCH_END}, slow service",
+    }
+    assert search(db, "pho") == {"Pho Place": f"{MATCH_START}Pho{MATCH_END} Place"}
+
+    db.execute("UPDATE reviews SET text = 'Spicy curry' WHERE id = ?", (review_id,))
+    assert search(db, "noodles") == {}
+    assert list(search(db, "curry")) == ["Thai Hut"]
+
+    db.execute("UPDATE reviews SET spot_id = ? WHERE id = ?", (spot_ids["Pho Place"], review_id))
+    assert list(search(db, "curry")) == ["Pho Place"]
+
+    db.execute("DELETE FROM reviews WHERE id = ?", (review_id,))
+    assert search(db, "curry") == {}
@@ -0,0 +1,17 @@
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from spot_query import BadFilter, matching_ids
+
+
+@pytest.mark.parametrize("args, message", [
+    ({"min_rating": "<b>x</b>"}, "min_rating must be a number between 1 and 5"),
+    ({"min_rating": "nan"}, "min_rating must be a number between 1 and 5"),
+    ({"min_rating": "6"}, "min_rating must be a number between 1 and 5"),
+    ({"open_at": "<b>x</b>"}, "open_at must be a time like 21:30"),
+    ({"open_at": "21:30", "open_day": "<b>x</b>"}, "open_day must be one of Mo, Tu, We, Th, Fr, Sa, Su"),
+])
+def test_bad_filters_get_a_fixed_message(db, args, message):
+    with pytest.raises(BadFilter) as error:
+        matching_ids(db, MultiDict(args))
+    assert str(error.value) == message
@@ -0,0 +1,139 @@
+import os
+import queue
+import threading
+import time
+
+from flask import current_app
+
+from database import connect, get_db
+from metrics import record_write_batch
+
+DEFAULTS = {
+    "WRITE_BEHIND": False,          # send small writes through the group-commit thread
+    "WRITE_BATCH_MAX": 200,         # most writes committed in one transaction
+    "WRITE_BATCH_DELAY_MS": 2,      # how long a batch waits for more writes to join it
+    "WRITE_TIMEOUT": 10.0,          # seconds a request waits for its write to commit
+}
+
+
+class PendingWrite:
+    __slots__ = ("sql", "parameters", "done", "error")
+
+    def __init__(self, sql, parameters):
+        self.sql = sql
+        self.parameters = parameters
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommitWriter:
+    """One thread per worker process that commits queued writes in batches.
+
+    SQLite has a single writer, so many request threads each committing one
+    INSERT queue up behind each other's fsyncs. Here the writes collect in a
+    queue for a few milliseconds (or until there are batch_max of them) and go
+    into the database as one transaction. Each write gets its own savepoint,
+    so a failing statement only fails its own request.
+    """
+
+    def __init__(self, path, config=None, batch_max=200, delay=0.002):
+        self.path = path
+        self.config = config
+        self.batch_max = batch_max
+        self.delay = delay
+        self.pid = os.getpid()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, sql, parameters=(), timeout=10.0):
+        """Queue a write and block until it is committed (re-raising its error)."""
+        write = PendingWrite(sql, parameters)
+        self._queue.put(write)
+        if not write.done.wait(timeout):
+            raise TimeoutError("Timed out waiting for the write to commit")
+        if write.error is not None:
+            raise write.error
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.delay
+        while len(batch) < self.batch_max:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, db, batch):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for write in batch:
+                db.execute("SAVEPOINT write")
+                try:
+                    db.execute(write.sql, write.parameters)
+                    db.execute("RELEASE write")
+                except Exception as error:
+                    db.execute("ROLLBACK TO write")
+                    db.execute("RELEASE write")
+                    write.error = error
+            db.commit()
+        except Exception as error:
+            db.rollback()
+            for write in batch:
+                write.error = write.error or error
+
+    def _run(self):
+        db = connect(self.path, self.config)
+        # Transactions are managed by hand, with savepoints inside them
+        db.isolation_level = None
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+            self._commit(db, batch)
+            record_write_batch(len(batch), time.perf_counter() - start, self._queue.qsize())
+            for write in batch:
+                write.done.set()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(app=None):
+    """This process's writer thread for the app, started on first use."""
+    app = app or current_app._get_current_object()
+    writer = _writers.get(app)
+    # Threads don't survive a fork, so a forked worker starts its own
+    if writer is None or writer.pid != os.getpid():
+        with _writers_lock:
+            writer = _writers.get(app)
+            if writer is None or writer.pid != os.getpid():
+                writer = GroupCommitWriter(
+                    app.config["DATABASE"],
+                    config=app.config,
+                    batch_max=app.config["WRITE_BATCH_MAX"],
+                    delay=app.config["WRITE_BATCH_DELAY_MS"] / 1000,
+                )
+                _writers[app] = writer
+    return writer
+
+
+def execute_write(sql, parameters=()):
+    """Run and commit one write statement for the current request.
+
+    With WRITE_BEHIND on it goes through the group-commit thread; either way it
+    has been committed when this returns.
+    """
+    if current_app.config["WRITE_BEHIND"]:
+        get_writer().submit(sql, parameters, timeout=current_app.config["WRITE_TIMEOUT"])
+    else:
+        db = get_db()
+        db.execute(sql, parameters)
+        db.commit()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)